@@ -0,0 +1,114 @@
+"""
+This file contains a benchmark of the pipeline stages on synthetic data sets of increasing size (see `synthetic.py`).
+
+Each stage is timed separately, and the empirical scaling exponent b of its run time t ~ n**b with the number of data sets n is reported.
+A stage whose exponent grows between versions of the code scales worse than before.
+
+Run the file from the terminal: `python benchmark.py`.
+"""
+
+import contextlib
+import io
+import time
+
+import matplotlib
+import numpy as np
+import pandas as pd
+
+from cache import convert_types
+from calculate import (calculate_alpha, calculate_free_travel_time,
+                       calculate_rho_and_J, calculate_slopes, filter_by_AP,
+                       identify_ncs, init_analyses, perform_welchs_test)
+from synthetic import generate_traces
+from trace_table import TraceTable
+
+stages = ['filter_by_AP', 'identify_ncs', 'calculate_slopes', 'calculate_free_travel_time', 'calculate_rho_and_J',
+          'calculate_alpha', 'perform_welchs_test']
+# The calibration coefficient used in `main.py`
+I_est = 25.28255294491828
+
+
+def time_pipeline(data, workers=1, rng=0):
+    """
+    Run the pipeline of `main.py` without figures on the input table `data` and time each stage.
+
+    Return:
+    dictionary {stage: run time in seconds}
+    """
+    timings = {}
+
+    @contextlib.contextmanager
+    def timed(stage):
+        start = time.perf_counter()
+        # Silence the printouts and the progress bars of the stages
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            yield
+        timings[stage] = time.perf_counter() - start
+
+    table = TraceTable(data)
+    with timed('filter_by_AP'):
+        filtered_table = filter_by_AP(table)
+    with timed('identify_ncs'):
+        table_with_ncs, nc_limits = identify_ncs(filtered_table)
+
+    analyses = init_analyses(table, nc_limits)
+    with timed('calculate_slopes'):
+        analyses = calculate_slopes(table_with_ncs, analyses, save_figures=False, workers=workers)
+    analyses['count'] = analyses.groupby(by=['gene', 'construct', 'nc']).Tstart.transform('count')
+    with timed('calculate_free_travel_time'):
+        analyses = calculate_free_travel_time(analyses)
+    with timed('calculate_rho_and_J'):
+        analyses = calculate_rho_and_J(analyses, I_est)
+    with timed('calculate_alpha'):
+        analyses = calculate_alpha(analyses, rng=rng)
+    with timed('perform_welchs_test'):
+        perform_welchs_test(analyses)
+    return timings
+
+
+def get_scaling_exponents(timings):
+    """
+    Fit the run times of each stage with a power law t = c * n**b of the size n.
+
+    Parameters:
+    timings -   data frame of run times indexed by the size, one column per stage
+
+    Return:
+    series of the exponents b of the stages
+    """
+    log_sizes = np.log(timings.index.values.astype(float))
+    return pd.Series({stage: np.polyfit(log_sizes, np.log(timings[stage].values), 1)[0] for stage in timings},
+                     name='exponent')
+
+
+def run_benchmarks(sizes=(6, 12, 24, 48), traces=50, repeats=3, workers=1, rng=0):
+    """
+    Time the pipeline stages on synthetic data with increasing numbers of data sets `sizes`, each with `traces` traces.
+    The minimal time of `repeats` runs is kept for each size to reduce the influence of the system load.
+
+    Return:
+    timings     -   data frame of the run times in seconds, indexed by the number of data sets, one column per stage. The number of data rows is in the `rows` column
+    exponents   -   the scaling exponents of the stages (see `get_scaling_exponents`)
+    """
+    rows = []
+    rows_len = []
+    for size in sizes:
+        data, _ = generate_traces(datasets=size, traces=traces, rng=rng)
+        data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+        data = convert_types(data)
+        rows_len.append(len(data))
+        runs = pd.DataFrame([time_pipeline(data, workers=workers, rng=rng) for _ in range(repeats)])
+        rows.append(runs.min().rename(size))
+    timings = pd.DataFrame(rows)[stages]
+    timings.index.name = 'datasets'
+    exponents = get_scaling_exponents(timings)
+    timings['rows'] = rows_len
+    return timings, exponents
+
+
+if __name__ == '__main__':
+    matplotlib.use('Agg')
+    timings, exponents = run_benchmarks()
+    with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 200, 'display.max_columns', None):
+        print('Run times, s:\n', timings)
+        print('\nScaling exponents with the number of data sets:\n', exponents)
@@ -0,0 +1,127 @@
+"""
+This file contains the functions loading the input data table through a typed binary cache.
+
+On the first load, the `.csv` file is parsed and converted into a `.npz` file stored next to it.
+Text columns are stored as categorical codes, identifiers as int32 and measurements as float32.
+The time is kept in double precision, because the nc limits are found by exact comparisons with the regular time mesh.
+The mean AP of each trace (`ap_mean`) is precomputed.
+The cache is rebuilt when the modification time or the contents hash of the source file change.
+A `.npz` file in the cache format, e.g. written by `compiled_particles.import_compiled_particles`, can also be loaded directly.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+cache_version = 1
+categorical_columns = ['gene', 'construct', 'dataset']
+int_columns = ['trace_id', 'dataset_id', 'gene_id', 'construct_id', 'frame']
+float_columns = ['intensity', 'ap', 'ap_mean']
+
+
+def get_cache_path(filepath):
+    return filepath + '.cache.npz'
+
+
+def hash_file(filepath, block_size=2**20):
+    """
+    Calculate the sha256 hash of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_data(filepath, use_cache=True):
+    """
+    Load the input data table and calculate the mean AP position for each trace.
+
+    If `use_cache` is True, the data are read from the binary cache if it is up to date.
+    Otherwise, the `.csv` file is parsed and the cache is (re)created.
+    If `filepath` is a `.npz` file, it is read as a cache file without checking its source.
+    """
+    if filepath.endswith('.npz'):
+        data = read_cache(filepath)
+        if data is None:
+            raise ValueError(f'The cache file `{filepath}` was written by a different version of the code')
+        return data
+
+    cache_path = get_cache_path(filepath)
+    mtime = os.path.getmtime(filepath)
+
+    if use_cache and os.path.isfile(cache_path):
+        data = read_cache(cache_path, filepath, mtime)
+        if data is not None:
+            return data
+
+    data = pd.read_csv(filepath, sep=',', encoding='utf-8')
+
+    # Calculate the mean AP position for each trace
+    data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+    data = convert_types(data)
+
+    if use_cache:
+        write_cache(data, cache_path, source_hash=hash_file(filepath), source_mtime=mtime)
+    return data
+
+
+def convert_types(data):
+    """
+    Convert the columns of the input table to compact types
+    """
+    data = data.copy()
+    for column in data.columns:
+        if column in categorical_columns or data[column].dtype == object:
+            data[column] = data[column].astype('category')
+        elif column in int_columns and not data[column].isna().any():
+            data[column] = data[column].astype(np.int32)
+        elif column in float_columns:
+            data[column] = data[column].astype(np.float32)
+    return data
+
+
+def write_cache(data, cache_path, source_hash, source_mtime):
+    """
+    Save the table into a `.npz` file. Categorical columns are saved as codes and categories
+    """
+    arrays = {'_version': np.array(cache_version),
+              '_columns': np.array(data.columns, dtype=str),
+              '_source_hash': np.array(source_hash),
+              '_source_mtime': np.array(source_mtime)}
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            arrays['codes:' + column] = data[column].cat.codes.values
+            arrays['categories:' + column] = np.array(data[column].cat.categories, dtype=str)
+        else:
+            arrays['values:' + column] = data[column].values
+
+    # Write to a temporary file first so that an interrupted write does not leave a broken cache
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def read_cache(cache_path, filepath=None, mtime=None):
+    """
+    Load the table from the cache file.
+    Return None if the cache does not correspond to the current source file. The source is not checked if `filepath` is None
+    """
+    with np.load(cache_path, allow_pickle=False) as arrays:
+        if int(arrays['_version']) != cache_version:
+            return None
+        if filepath is not None and (float(arrays['_source_mtime']) != mtime
+                                     or str(arrays['_source_hash']) != hash_file(filepath)):
+            return None
+
+        data = {}
+        for column in arrays['_columns']:
+            if 'codes:' + column in arrays:
+                data[column] = pd.Categorical.from_codes(
+                    arrays['codes:' + column], categories=arrays['categories:' + column])
+            else:
+                data[column] = arrays['values:' + column]
+    return pd.DataFrame(data)
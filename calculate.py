@@ -1,73 +1,68 @@
 
 
-import copy
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.interpolate import interp1d
 from scipy.stats import shapiro
-from scipy.stats import t as student
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 from constants import (LV, AP_hist_folder, L, default_intensity_threshold,
                        dt_new, gene_labels, intensity_thresholds, k, kV, l, lV,
-                       output_slopes_folder, slope_length_mins)
-from support import J_over_k_MC, bayesian_linear_fit, mixed_estimator_2
+                       mc_quantiles, mc_samples, output_slopes_folder,
+                       slope_length_mins)
+from propagation import propagate, propagate_mc
+from support import (J_over_k_MC, J_over_k_MC_from_l, alpha_over_k_from_JoK,
+                     alpha_over_k_from_rho, bayes_factor,
+                     bayesian_linear_fit_batch, grouped_linear_fit,
+                     mixed_estimator_grouped, permutation_tests,
+                     rho_MC_from_l)
 from support import rho_MC as rho_MC_func
 from support import set_figure_size, welchs_test
+from trace_table import TraceTable
 
 
 def alpha_over_k_J(JoK, JoKV):
     """
     Calculate mean and variance of alpha/k from J/k
     """
-    alpha_over_k = (1
-                    - JoK * (l - 1)
-                    - np.sqrt(1 + JoK**2 * (l - 1) **
-                              2 - 2 * JoK * (l + 1))
-                    ) / 2
-    partial_JoK = (1 / 2) * (1 - l - (2 * JoK * (-1 + l)**2 - 2 * (1 + l)) /
-                             (2 * np.sqrt(1 + JoK ** 2 * (-1 + l)**2 - 2 * JoK * (1 + l))))
-    partial_l = (1 / 2) * (-JoK - (-2 * JoK + 2 * JoK**2 * (-1 + l)) /
-                           (2 * np.sqrt(1 + JoK**2 * (-1 + l)**2 - 2 * JoK * (1 + l))))
-    alpha_over_kV = partial_l**2 * lV + partial_JoK**2 * JoKV
-    return alpha_over_k, alpha_over_kV
+    return propagate(alpha_over_k_from_JoK, [JoK, l], [JoKV, lV])
 
 
 def alpha_over_k_rho(rho, rhoV):
     """
     Calculate mean and variance of alpha/k from rho
     """
-    alpha_over_k = rho / (l - rho * (l - 1))
-    partial_l = -(((1 - rho) * rho) / (l - (-1 + l) * rho)**2)
-    partial_rho = l / (l + rho - l * rho)**2
+    return propagate(alpha_over_k_from_rho, [rho, l], [rhoV, lV])
 
-    alpha_over_kV = partial_l**2 * lV + partial_rho**2 * rhoV
 
-    return alpha_over_k, alpha_over_kV
-
-
-def calculate_alpha(analyses_in):
+def calculate_alpha(analyses_in, rng=None, propagation='delta', I_est=None, IV_est=0):
     """
     Calculates alpha/k based on experimental slopes and steady state N.
     For alpha estimates, we use rho and JoK estimates that are already averaged over differnt embryos of the same group.
     Each group corresponds to a different gene-construct-nc combination.
     After that we construct a mixed estimator based on the two following the method described in Lavancier and Rocher (2016).
+    The mixed estimators of all groups are bootstrapped at once with `mixed_estimator_grouped`.
 
     The variance of individual alpha estimators is calculated as a sum of squares of variances with partial derivatives:
     V = \sum_i (d alpha / d \theta_i)**2 * var(theta_i)
+
+    With `propagation='mc'`, the variances of the individual alpha/k estimators are calculated by Monte Carlo sampling instead (see `save_mc_results`).
+    The measured slopes and max. polymerase numbers, T, l, k and the calibration coefficient `I_est` with its variance `IV_est` are sampled and pushed through `alpha_over_k_from_measurements`.
+    This keeps the correlation of J/k and rho, which depend on the same k and I, so `I_est` must be the value given to `calculate_rho_and_J`.
+
+    `rng` is a `numpy.random.Generator` or a seed used for the bootstrap of the mixed estimators and the Monte Carlo sampling.
     """
 
+    check_propagation(propagation)
     analyses = analyses_in.copy()
     significance_level = 0.05
-
-    genes = set(analyses.gene)
-    constructs = set(analyses.construct)
-    ncs = set(analyses.index.get_level_values(1))
+    rng = np.random.default_rng(rng)
 
     # Load alphas obtained from J/k
     JoK = analyses.JoK
@@ -81,65 +76,74 @@ def calculate_alpha(analyses_in):
     analyses['alpha_over_k_rho'], analyses['alpha_over_k_rhoV'] = alpha_over_k_rho(rho, rhoV)
     analyses['alpha_rho'] = analyses['alpha_over_k_rho'] * k
 
+    if propagation == 'mc':
+        if I_est is None:
+            raise ValueError("The calibration coefficient `I_est` is required with propagation='mc'")
+        results = propagate_mc(
+            alpha_over_k_from_measurements,
+            [analyses['max'], analyses['slope'], analyses['T'], l, k, I_est],
+            [analyses['maxV'], analyses['slopeV'], analyses.TV, lV, kV, IV_est],
+            samples=mc_samples, quantiles=mc_quantiles, rng=rng)
+        save_mc_results(analyses, ['alpha_over_k_J', 'alpha_over_k_rho'], results)
+
     # I use aoK to denote alpha/k
     def tau(aoK):
         # Invert alpha to get tau and recalculate into seconds
         tau = 1 / aoK / k * 60
         return tau
 
-    refuted_shapiro_alpha = []
-    refuted_shapiro_tau = []
-    for gene in genes:
-        for construct in constructs:
-            indices = (analyses.gene == gene) & (
-                analyses.construct == construct)
-            for nc in ncs:
-                # %% Mixed estimator for alpha/k
-                # Drop nans
-                T1 = drop_nan(analyses.loc[(indices, nc), 'alpha_over_k_rho'].values)
-                T2 = drop_nan(analyses.loc[(indices, nc), 'alpha_over_k_J'].values)
-
-                # Calculate the mixed estimator
-                aoK_mixed, aoK_V, weights = mixed_estimator_2(T1=T1, T2=T2)
-
-                # Save to analyses
-                analyses.loc[(indices, nc), 'alpha_over_k_comb'] = aoK_mixed
-                analyses.loc[(indices, nc), 'alpha_over_k_combV'] = aoK_V
-                analyses.loc[(indices, nc),
-                             'kappa'] = weights[0]
-                analyses.loc[(indices, nc), 'alpha_comb'] = aoK_mixed * k
-                analyses.loc[(indices, nc), 'alpha_combV'] = aoK_V * k**2
-
-                # Perform Shapiro-Wilk's normality test to see whether alpha or tau are more appropriate for comparison with other conditions. 1st part
-                # Save to analyses for later re-use
-                data_mixed = weights[0] * T1 + weights[1] * T2
-                if len(data_mixed) >= 3:
-                    shap_W, shap_p = shapiro(data_mixed)
-                    analyses.loc[(indices, nc), 'shap_alpha_W'] = shap_W
-                    analyses.loc[(indices, nc), 'shap_alpha_p'] = shap_p
-                    refuted_shapiro_alpha.append(shap_p < significance_level)
-
-                # %% Mixed estimator for tau
-                # Calculate, then save to analyses
-                T1 = drop_nan(tau(analyses.loc[(indices, nc), 'alpha_over_k_rho'].values))
-                T2 = drop_nan(tau(analyses.loc[(indices, nc), 'alpha_over_k_J'].values))
-                tau_mixed, tau_V, weights = mixed_estimator_2(T1=T1, T2=T2)
-                analyses.loc[(indices, nc), 'tau'] = tau_mixed
-                analyses.loc[(indices, nc), 'tauV'] = tau_V
-                analyses.loc[(indices, nc),
-                             'kappa_tau'] = weights[0]
-
-                # Perform Shapiro-Wilk's normality test for the mixed estimator
-                data_mixed = weights[0] * T1 + weights[1] * T2
-                if len(data_mixed) >= 3:
-                    shap_W, shap_p = shapiro(data_mixed)
-                    analyses.loc[(indices, nc), 'shap_tau_W'] = shap_W
-                    analyses.loc[(indices, nc), 'shap_tau_p'] = shap_p
-                    refuted_shapiro_tau.append(shap_p < significance_level)
-
-                # Print the mixed estimator for the current gene-construct-nc combination
-                print(
-                    f'{gene}, {construct}, nc{nc}: tau = {tau_mixed:.1f} +- {np.sqrt(tau_V):.1f} s, alpha = {aoK_mixed*k:.1f} +- {np.sqrt(aoK_V*k**2):.1f} min^{-1}')
+    # %% Sort the rows by gene, construct and nc, so that each group occupies a contiguous block
+    table = analyses[['gene', 'construct', 'alpha_over_k_rho', 'alpha_over_k_J']].reset_index(
+        drop=True).assign(nc=analyses.index.get_level_values(1).values)
+    table = table.sort_values(['gene', 'construct', 'nc'], kind='stable')
+    group_sizes = table.groupby(['gene', 'construct', 'nc'], sort=True, dropna=False).size()
+    offsets = np.concatenate([[0], np.cumsum(group_sizes.values)])
+    groups_len = len(group_sizes)
+
+    # Calculate the mixed estimators of all groups at once
+    aoKs = table[['alpha_over_k_rho', 'alpha_over_k_J']].values.T.astype(float)
+    taus = tau(aoKs)
+    aoK_mixed, aoK_V, aoK_weights = mixed_estimator_grouped(aoKs, offsets, rng=rng)
+    tau_mixed, tau_V, tau_weights = mixed_estimator_grouped(taus, offsets, rng=rng)
+
+    # Perform Shapiro-Wilk's normality test for the mixed estimators to see whether alpha or tau are more appropriate for comparison with other conditions
+    shapiro_results = {label: np.full((groups_len, 2), np.nan) for label in ['alpha', 'tau']}
+    refuted_shapiro = {'alpha': [], 'tau': []}
+    for group in range(groups_len):
+        rows = slice(offsets[group], offsets[group + 1])
+        for label, Ts, weights in [('alpha', aoKs, aoK_weights), ('tau', taus, tau_weights)]:
+            T1, T2 = Ts[:, rows]
+            not_nans = ~np.isnan(T1) & ~np.isnan(T2)
+            data_mixed = weights[group, 0] * T1[not_nans] + weights[group, 1] * T2[not_nans]
+            if len(data_mixed) >= 3:
+                shapiro_results[label][group] = shap_W, shap_p = shapiro(data_mixed)
+                refuted_shapiro[label].append(shap_p < significance_level)
+    refuted_shapiro_alpha, refuted_shapiro_tau = refuted_shapiro['alpha'], refuted_shapiro['tau']
+
+    # %% Save to analyses
+    group_results = pd.DataFrame({
+        'alpha_over_k_comb': aoK_mixed,
+        'alpha_over_k_combV': aoK_V,
+        'kappa': aoK_weights[:, 0],
+        'alpha_comb': aoK_mixed * k,
+        'alpha_combV': aoK_V * k**2,
+        'tau': tau_mixed,
+        'tauV': tau_V,
+        'kappa_tau': tau_weights[:, 0],
+        'shap_alpha_W': shapiro_results['alpha'][:, 0],
+        'shap_alpha_p': shapiro_results['alpha'][:, 1],
+        'shap_tau_W': shapiro_results['tau'][:, 0],
+        'shap_tau_p': shapiro_results['tau'][:, 1],
+    })
+    row_results = group_results.iloc[np.repeat(np.arange(groups_len), group_sizes.values)]
+    row_results.index = analyses.index[table.index]
+    for col in row_results:
+        analyses[col] = row_results[col]
+
+    # Print the mixed estimator for each gene-construct-nc combination
+    for group, (gene, construct, nc) in enumerate(group_sizes.index):
+        print(
+            f'{gene}, {construct}, nc{nc}: tau = {tau_mixed[group]:.1f} +- {np.sqrt(tau_V[group]):.1f} s, alpha = {aoK_mixed[group]*k:.1f} +- {np.sqrt(aoK_V[group]*k**2):.1f} min^{-1}')
 
     print('\nShapiro-Wilk normality test results across all genes, constructs, ncs:')
     print(
@@ -150,10 +154,6 @@ def calculate_alpha(analyses_in):
     return analyses
 
 
-def drop_nan(T):
-    return T[~np.isnan(T)]
-
-
 def calculate_free_travel_time(analyses_in):
     """
     Estimate the free passage time by fitting the non-scaled current-density diagram across all ncs for each gene and construct individually.
@@ -188,18 +188,25 @@ def calculate_free_travel_time(analyses_in):
 
     # Fit the diagram individually for each gene, but all constructs and ncs mixed
     # This makes sense because all constructs and nc supposedly have the same length and polymerase elongation rate
-    for gene in genes:
-        analyses_filtered = analyses[(analyses.gene == gene)]
-        indices = analyses_filtered.index
+    # The fits of all genes are performed at once. The data of each gene are padded to the same length
+    genes = sorted(genes)
+    gene_rows = [np.flatnonzero(analyses.gene.values == gene) for gene in genes]
+    points_len = max(len(rows) for rows in gene_rows)
+    mask = np.arange(points_len) < np.array([len(rows) for rows in gene_rows])[:, np.newaxis]
+
+    def stack(column):
+        values = np.full((len(genes), points_len), np.nan)
+        values[mask] = np.concatenate([analyses[column].values[rows] for rows in gene_rows])
+        return values
 
-        Ns = analyses_filtered['max'].values
-        NsV = analyses_filtered['maxV'].values
-        slopes = analyses_filtered['slope'].values
-        slopesV = analyses_filtered['slopeV'].values
+    Ns, NsV, slopes, slopesV = [stack(column) for column in ['max', 'maxV', 'slope', 'slopeV']]
 
-        # Fit N/s passing through zero. Give result in minutes
-        fit = bayesian_linear_fit(x=slopes, Vx=slopesV, y=Ns, Vy=NsV, c=False, prior=prior_func)
-        T, TV = [fit[key] for key in ['m', 'mV']]
+    # Fit N/s passing through zero. Give result in minutes
+    fits = bayesian_linear_fit_batch(x=slopes, Vx=slopesV, y=Ns, Vy=NsV, mask=mask,
+                                     c=False, prior=prior_func)
+
+    for gene, rows, fit in zip(genes, gene_rows, fits):
+        T, TV = fit.m, fit.mV
 
         # Estimate L from T and k
         L_est = k * T
@@ -210,6 +217,7 @@ def calculate_free_travel_time(analyses_in):
         print(f'{gene}: T = {T:.2f} +- {np.sqrt(TV):.2f}, L = {L_rnd:.0f} +- {Lstd_rnd:.0f}')
 
         # Save to analyses
+        indices = analyses.index[rows]
         analyses.loc[indices, 'T'] = T
         analyses.loc[indices, 'TV'] = TV
         analyses.loc[indices, 'L'] = L_est
@@ -218,7 +226,59 @@ def calculate_free_travel_time(analyses_in):
     return analyses
 
 
-def calculate_rho_and_J(analyses_in, I_est, IV_est=0):
+def rho_from_max(max, l, I, k, T):
+    """
+    Site occupation density from the max. intensity
+    """
+    return max * l / I / k / T
+
+
+def JoK_from_slope(slope, k, I):
+    """
+    Polymerase flux J/k from the initial slope
+    """
+    return slope / k / I
+
+
+def rho_and_J_from_measurements(max, slope, T, l, k, I):
+    """
+    Calculate rho, r, J/k and j from the measured slopes and max. polymerase numbers.
+    Used to propagate the uncertainties of all inputs by Monte Carlo sampling
+    """
+    rho = rho_from_max(max, l, I, k, T)
+    JoK = JoK_from_slope(slope, k, I)
+    return rho, rho / rho_MC_from_l(l), JoK, JoK / J_over_k_MC_from_l(l)
+
+
+def alpha_over_k_from_measurements(max, slope, T, l, k, I):
+    """
+    Calculate alpha/k from J/k and from rho (see `rho_and_J_from_measurements`)
+    """
+    rho, _, JoK, _ = rho_and_J_from_measurements(max, slope, T, l, k, I)
+    return alpha_over_k_from_JoK(JoK, l), alpha_over_k_from_rho(rho, l)
+
+
+def check_propagation(propagation):
+    if propagation not in ['delta', 'mc']:
+        raise ValueError(f"Unknown propagation method '{propagation}'. Use 'delta' or 'mc'")
+
+
+def save_mc_results(analyses, names, results):
+    """
+    Save the results of `propagate_mc` for the quantities `names` into the analyses table.
+
+    The values of the quantities are not modified: they are the point estimates calculated from the means of the inputs.
+    The variances calculated from the Monte Carlo samples replace the delta-method variances in the `<name>V` columns.
+    The mean of the samples is saved in `<name>_mc_mean`, and the quantiles in `<name>_q<percent>`, e.g. `rho_q2.5`.
+    """
+    for name, mean, variance, quantiles in zip(names, *results):
+        analyses[name + 'V'] = variance
+        analyses[name + '_mc_mean'] = mean
+        for quantile, values in zip(mc_quantiles, quantiles):
+            analyses[f'{name}_q{100 * quantile:g}'] = values
+
+
+def calculate_rho_and_J(analyses_in, I_est, IV_est=0, propagation='delta', rng=None):
     """
     The function uses the calibration coefficient to convert a.u. into polymerase numbers.
     It calculate:
@@ -227,9 +287,13 @@ def calculate_rho_and_J(analyses_in, I_est, IV_est=0):
     - polymerase flux J/k in pol/min,
     - polymerase flux normalized to the MC regime
 
-    One may provide the error on the calibration coefficient as `IV_est`
+    One may provide the error on the calibration coefficient as `IV_est`.
+    The variances are calculated with the delta method by `propagate`.
+    With `propagation='mc'`, they are calculated by Monte Carlo sampling of the measured slopes and max. polymerase numbers, T, l, k and I (see `save_mc_results`).
+    `rng` is a `numpy.random.Generator` or a seed for the Monte Carlo sampling.
     """
 
+    check_propagation(propagation)
     analyses = analyses_in.copy()
     T = analyses['T']   # Cannot use a dot because it is going to transpose
     TV = analyses.TV
@@ -237,38 +301,218 @@ def calculate_rho_and_J(analyses_in, I_est, IV_est=0):
     rho_MC, rho_MCV = rho_MC_func()
     JoK_MC, JoK_MCV = J_over_k_MC()
 
+    # The variances are propagated for all rows at once
     # rho
-    max = analyses['max']
-    maxV = analyses['maxV']
-    analyses['rho'] = rho = max * l / I_est / k / T
-    analyses['rhoV'] = rhoV = rho**2 * (maxV / max**2 + lV / l**2
-                                        + IV_est / I_est**2 + kV / k**2 + TV / T**2)
+    analyses['rho'], analyses['rhoV'] = rho, rhoV = propagate(
+        rho_from_max, [analyses['max'], l, I_est, k, T], [analyses['maxV'], lV, IV_est, kV, TV])
 
-    analyses['r'] = r = rho / rho_MC
-    analyses['rV'] = r**2 * (rhoV / rho**2 + rho_MCV / rho_MC**2)
+    analyses['r'], analyses['rV'] = propagate(
+        lambda rho, rho_MC: rho / rho_MC, [rho, rho_MC], [rhoV, rho_MCV])
 
     # J/k
-    slope = analyses['slope']
-    slopeV = analyses['slopeV']
-    analyses['JoK'] = JoK = slope / k / I_est
-    analyses['JoKV'] = JoKV = JoK**2 * (slopeV / slope**2 + kV / k**2 + IV_est / I_est**2)
+    analyses['JoK'], analyses['JoKV'] = JoK, JoKV = propagate(
+        JoK_from_slope, [analyses['slope'], k, I_est], [analyses['slopeV'], kV, IV_est])
 
-    analyses['j'] = j = JoK / JoK_MC
-    analyses['jV'] = j**2 * (JoKV / JoK**2 + JoK_MCV / JoK_MC**2)
+    analyses['j'], analyses['jV'] = propagate(
+        lambda JoK, JoK_MC: JoK / JoK_MC, [JoK, JoK_MC], [JoKV, JoK_MCV])
+
+    if propagation == 'mc':
+        # The same samples of l are used for rho and the MC regime values, so their correlation is taken into account
+        results = propagate_mc(
+            rho_and_J_from_measurements, [analyses['max'], analyses['slope'], T, l, k, I_est],
+            [analyses['maxV'], analyses['slopeV'], TV, lV, kV, IV_est],
+            samples=mc_samples, quantiles=mc_quantiles, rng=rng)
+        save_mc_results(analyses, ['rho', 'r', 'JoK', 'j'], results)
 
     return analyses
 
 
-def calculate_slopes(data, analyses_in, save_figures, pdf=False):
+def init_analyses(table, nc_limits, ncs=range(11, 15)):
+    """
+    Initialize the table of results with one row per data set and nc.
+    The data set names, genes and constructs are copied from the first row of each data set of the `TraceTable`, and the nc time limits from `nc_limits` (see `identify_ncs`).
+    """
+    index = pd.MultiIndex.from_product((sorted(set(table.dataset_ids)), ncs), names=['dataset_id', 'nc'])
+    analyses = pd.DataFrame(columns=['dataset_name', 'gene', 'gene_id', 'construct'], index=index)
+    dataset_info = table.first(['dataset', 'gene', 'gene_id', 'construct']).rename(
+        columns={'dataset': 'dataset_name'})
+    dataset_rows = analyses.index.get_level_values('dataset_id')
+    for col in analyses.columns:
+        analyses[col] = dataset_info[col].astype(object).reindex(dataset_rows).values
+    return pd.concat([analyses, nc_limits], axis='columns')
+
+
+def calculate_slopes(table, analyses_in, save_figures, pdf=False, workers=1, slope_mode='fixed'):
     """
     Slope and max. polymerase number calculation procedure.
+    `table` is a `TraceTable` with identified ncs.
     The characteristics are not calculated if less than 3 frames are present, i.e. nc duration >= 2*dt_new.
 
+    `slope_mode` defines the time window of the slope fit:
+    'fixed' -   the first `slope_length_mins` of the nc (see `get_nc_slopes`),
+    'best'  -   the window of the same length with the best linear fit in the nc (see `get_best_nc_slopes`).
+
     The function plots and outputs slope detection figures for each data set in the `output_slopes_folder`.
 
     Also produces a histogram of recorded AP positions.
     One AP per trace is used, and the AP is the mean observed AP value.
+
+    The data sets are independent, so they may be processed in parallel by `workers` processes.
+    Each worker process keeps its own matplotlib state.
+    If `workers` is 1, the data sets are processed one by one in the current process.
+
+    The figures are rendered separately from the calculations from the plot specifications returned for each data set.
+    With one worker, they are rendered in the current thread after the calculations of each data set, since pyplot is not thread-safe. Otherwise, they are rendered in the process pool.
+    No figures are built if `save_figures` is False.
+    """
+    cols = ['slope', 'slopeV', 'max', 'maxV']
+
+    analyses = analyses_in.copy()
+    for col in cols:
+        if col not in analyses:
+            analyses[col] = np.nan
+
+    dataset_groups = [dataset_data for _, dataset_data in table.datasets()]
+    desc = 'Calculating slopes'
+
+    # Fit the slopes of all data sets and ncs at once
+    if slope_mode == 'fixed':
+        nc_slopes = get_nc_slopes(table)
+    elif slope_mode == 'best':
+        nc_slopes = get_best_nc_slopes(table)
+    else:
+        raise ValueError(f"Unknown slope mode '{slope_mode}'. Use 'fixed' or 'best'")
+    dataset_slopes = {dataset_id: {} for dataset_id in table.dataset_ids}
+    for (dataset_id, nc), fit in nc_slopes.items():
+        dataset_slopes[dataset_id][nc] = fit
+    dataset_slopes = [dataset_slopes[dataset_id] for dataset_id in table.dataset_ids]
+
+    # Reuse the average traces already calculated for the data sets, e.g. by `identify_ncs`
+    dataset_avg_traces = [{key: table.avg_traces[key]} if key in table.avg_traces else {}
+                          for key in [(dataset_id, dt_new) for dataset_id in table.dataset_ids]]
+
+    def merge(dataset_results):
+        for (dataset_id, nc), values in dataset_results.items():
+            analyses.loc[(dataset_id, nc), cols] = values
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_plotting_worker) as executor:
+            renders = []
+            dataset_outputs = executor.map(
+                calculate_dataset_slopes, dataset_groups, dataset_slopes, dataset_avg_traces)
+            for dataset_results, plot_spec in tqdm(dataset_outputs, total=len(dataset_groups), desc=desc):
+                merge(dataset_results)
+                if save_figures:
+                    renders.append(executor.submit(render_slopes_figures, plot_spec, pdf))
+            # Re-raise rendering errors if any
+            for render in renders:
+                render.result()
+    else:
+        for dataset_data, slopes, avg_traces in tqdm(zip(dataset_groups, dataset_slopes, dataset_avg_traces),
+                                                     total=len(dataset_groups), desc=desc):
+            dataset_results, plot_spec = calculate_dataset_slopes(dataset_data, slopes, avg_traces)
+            merge(dataset_results)
+            if save_figures:
+                render_slopes_figures(plot_spec, pdf)
+
+    return analyses
+
+
+def init_plotting_worker():
+    """
+    Initialize the matplotlib state of a worker process: render without a display and drop figures inherited from the parent process
     """
+    matplotlib.use('Agg')
+    plt.close('all')
+
+
+def calculate_dataset_slopes(dataset_data, slopes=None, avg_traces=None):
+    """
+    Calculate the slopes and the max. polymerase numbers of each nc of a single data set.
+    `dataset_data` are the rows of the data set in a `TraceTable`, i.e. sorted by nc.
+    `slopes` is a dictionary {nc: (slope, slopeV, coefs, (start, end))} of the slopes already fitted with `get_nc_slopes` or `get_best_nc_slopes`.
+    The slopes are fitted here if it is not provided.
+    `avg_traces` may contain the average trace of the data set already calculated by `get_dataset_avg_trace`.
+    The average trace is used for the detection of the max. polymerase numbers and for the figures.
+    No figures are created.
+
+    Return:
+    results     -   dictionary {(dataset_id, nc): (slope, slopeV, max, maxV)}
+    plot_spec   -   dictionary with all the data necessary to plot the figures of the data set with `render_slopes_figures`
+    """
+    # Constants
+    ncs = range(11, 15)
+
+    results = {}
+
+    # Check if there are data points after filtering
+    if not dataset_data.shape[0]:
+        logging.warning(
+            "No data points available for slope fitting after positional fitering. Skipping data set")
+        return results, None
+
+    dataset_name = dataset_data.dataset.iloc[0]
+    dataset_id = dataset_data.dataset_id.iloc[0]
+
+    # Get an average trace on a regulare time mesh
+    dataset_table = TraceTable(dataset_data, is_sorted=True, avg_traces=avg_traces)
+    avg_data, std_data, _ = get_dataset_avg_trace(dataset_table, dataset_id, dt_new)
+
+    plot_spec = {'dataset_id': dataset_id,
+                 'dataset_name': dataset_name,
+                 'time': avg_data.index.values,
+                 'intensity': avg_data.intensity.values,
+                 'intensity_std': std_data.intensity.values,
+                 'intensity_threshold': intensity_thresholds.get(dataset_id, default_intensity_threshold),
+                 'ap_means': dataset_data.groupby('trace_id').ap_mean.first().values,
+                 'ncs': []}
+
+    # %% Calculate slopes and max intensity
+    if slopes is None:
+        slopes = {nc: fit for (_, nc), fit in get_nc_slopes(dataset_table).items()}
+
+    for nc in ncs:
+        nc_data = dataset_table.nc(dataset_id, nc)
+        if not nc_data.empty:
+            # By default, the slope is fitted on a fixed time interval after the start of the nc
+            start_slope = nc_data.time.min()
+            end_slope = start_slope + slope_length_mins
+
+            # Calculate max and slope only if the nc includes at least 3 frames.
+            # Otherwise, return nans
+            nc_length = nc_data.time.max() - nc_data.time.min()
+            if nc_length >= 2 * dt_new:
+                slope, slope_V, coefs, (start_slope, end_slope) = slopes[nc]
+                max_intensity, max_intensity_std = get_max_intensity(nc_data, avg_data)
+            else:
+                slope, slope_V = [np.nan] * 2
+                coefs = [np.nan] * 2
+                max_intensity, max_intensity_std = [np.nan] * 2
+            if slope < 0:
+                continue
+
+            # Save the results
+            results[(dataset_id, nc)] = (
+                slope, slope_V, max_intensity, max_intensity_std**2)
+
+            # Keep what is necessary to plot the nc slope and detected max intensity
+            plot_spec['ncs'].append({'nc': nc,
+                                     'coefs': coefs,
+                                     'start': start_slope,
+                                     'end': end_slope,
+                                     'max_intensity': max_intensity,
+                                     'nc_span': (nc_data.time.min(), nc_data.time.max())})
+
+    return results, plot_spec
+
+
+def render_slopes_figures(plot_spec, pdf=False):
+    """
+    Plot and save the slope detection figure and the histogram of recorded AP positions of a data set from its plot specification
+    """
+    if plot_spec is None:
+        return
+
     # Plot paraemters
     markersize = 2
     lw = 1  # line width
@@ -279,122 +523,65 @@ def calculate_slopes(data, analyses_in, save_figures, pdf=False):
     alpha = 0.2     # transparency
     height_factor = 0.5
 
-    # Constants
-    ncs = range(11, 15)
-
-    analyses = analyses_in.copy()
-    dataset_ids = set(data.dataset_id)
-
-    for dataset_id in tqdm(dataset_ids, desc='Calculating slopes'):
-        dataset_data = data[data.dataset_id == dataset_id]
-
-        dataset_name = dataset_data.dataset.iloc[0]
-        dataset_id = dataset_data.dataset_id.iloc[0]
-        gene_id = dataset_data.gene_id.iloc[0]
-        gene = dataset_data.gene.iloc[0]
-        construct_id = dataset_data.construct_id.iloc[0]
-
-        # Check if there are data points after filtering
-        if not dataset_data.shape[0]:
-            logging.warning(
-                f"No data points available for slope fitting after positional fitering. Skipping dataset={dataset_id}")
-            continue
-
-        # %% Calculate slopes and max values
-        set_figure_size(num=5, rows=1, page_width_frac=0.5,
-                        clear=True, height_factor=height_factor)
-        fig, ax = plt.subplots(1, 1, num=5)
-
-        # Get an average trace on a regulare time mesh
-        avg_data, std_data = get_avg_on_regular_time_mesh(dataset_data, dt=dt_new)
-
-        # Plot the average trace
-        x = avg_data.index
-        y = avg_data.intensity
-        ax.plot(x.values, y.values, '-o', markersize=markersize, lw=lw, c=colors['trace'])
-
-        # Add standard deviation as a shaded region
-        ylow = y - std_data.intensity
-        yup = y + std_data.intensity
-        plt.fill_between(x.values, ylow.values, yup.values,
-                         facecolor=colors['trace'], alpha=alpha, edgecolor=None)
-
-        # Detect the time limits of the plot
-        t_span = avg_data[~pd.isna(avg_data.intensity)].index.values
-        xlims = np.array(t_span[[0, -1]])
-        # Extend slightly for better presentation
-        xlims = xlims + (xlims[1] - xlims[0]) * 0.1 / 2 * np.array([-1, 1])
-        plt.xlim(xlims)
-
-        # %% Calculate slopes and max intensity
-        for nc in ncs:
-            nc_data = dataset_data[dataset_data.nc == nc]
-            if not nc_data.empty:
-                # Add columns to analyses
-                cols = ['slope', 'slopeV', 'max', 'maxV']
-                for col in cols:
-                    if col not in analyses:
-                        analyses[col] = np.nan
-
-                # Fit slope on a fixed time interval after the start of the nc
-                start_slope = nc_data.time.min()
-                end_slope = start_slope + slope_length_mins
-
-                # Calculate max and slope only if the nc includes at least 3 frames.
-                # Otherwise, return nans
-                nc_length = nc_data.time.max() - nc_data.time.min()
-                if nc_length >= 2 * dt_new:
-                    slope, slope_V, coefs = get_slope(nc_data, start=start_slope, end=end_slope)
-                    max_intensity, max_intensity_std = get_max_intensity(nc_data)
-                else:
-                    slope, slope_V = [np.nan] * 2
-                    coefs = [np.nan] * 2
-                    max_intensity, max_intensity_std = [np.nan] * 2
-                if slope < 0:
-                    continue
-
-                # Save to analyses
-                analyses.loc[(dataset_id, nc), cols] = (
-                    slope, slope_V, max_intensity, max_intensity_std**2)
-
-                # Plot current nc slope and detected max inensity
-                plot_slopes(dataset_data, coefs, start_slope,
-                            end_slope, max_intensity, nc, ax, lw=lw, colors=colors)
-
-        # Save figure
-        figname = "slopes_{id:02d}_{dataset_name}".format(id=dataset_id, dataset_name=dataset_name)
-        figpath = os.path.join(output_slopes_folder, figname)
-
-        if save_figures:
-            if pdf:
-                fig.savefig(figpath + '.pdf', pad_inches=0, bbox_inches='tight')
-
-            # Save an enlarged png version for easier analysis
-            factor = 3
-            figsize = fig.get_size_inches()
-            fig.set_figwidth(figsize[0] * factor)
-            fig.set_figheight(figsize[1] * factor)
-            fig.savefig(figpath + '.png', pad_inches=0, bbox_inches='tight')
-
-        # %% Plot a histogram of recorded AP positions
-        fig = plt.figure(num=10, clear=True)
-        str_title = '%s, id=%i' % (dataset_name.replace('_', '\_'), dataset_id)
-
-        MeanAPs = data.groupby(data['trace_id']).ap_mean.first()
-        plt.hist(MeanAPs)
-
-        # Adjust the plot
-        plt.xlim([0, 1])
-        plt.xlabel('AP')
-        plt.title(str_title)
-
-        # Save figure
-        figpath = f"AP_hist_{dataset_id}.png"
-        figpath = os.path.join(AP_hist_folder, figpath)
-        if save_figures:
-            fig.savefig(figpath)
+    dataset_name = plot_spec['dataset_name']
+    dataset_id = plot_spec['dataset_id']
+
+    set_figure_size(num=5, rows=1, page_width_frac=0.5,
+                    clear=True, height_factor=height_factor)
+    fig, ax = plt.subplots(1, 1, num=5)
+
+    # Plot the average trace
+    x = plot_spec['time']
+    y = plot_spec['intensity']
+    ax.plot(x, y, '-o', markersize=markersize, lw=lw, c=colors['trace'])
+
+    # Add standard deviation as a shaded region
+    ylow = y - plot_spec['intensity_std']
+    yup = y + plot_spec['intensity_std']
+    plt.fill_between(x, ylow, yup,
+                     facecolor=colors['trace'], alpha=alpha, edgecolor=None)
+
+    # Detect the time limits of the plot
+    t_span = x[~np.isnan(y)]
+    xlims = np.array(t_span[[0, -1]])
+    # Extend slightly for better presentation
+    xlims = xlims + (xlims[1] - xlims[0]) * 0.1 / 2 * np.array([-1, 1])
+    plt.xlim(xlims)
+
+    # Plot the slope and detected max intensity of each nc
+    for nc_spec in plot_spec['ncs']:
+        plot_slopes(dataset_name, plot_spec['intensity_threshold'], ax=ax, lw=lw, colors=colors,
+                    **nc_spec)
+
+    # Save figure
+    figname = "slopes_{id:02d}_{dataset_name}".format(id=dataset_id, dataset_name=dataset_name)
+    figpath = os.path.join(output_slopes_folder, figname)
+
+    if pdf:
+        fig.savefig(figpath + '.pdf', pad_inches=0, bbox_inches='tight')
+
+    # Save an enlarged png version for easier analysis
+    factor = 3
+    figsize = fig.get_size_inches()
+    fig.set_figwidth(figsize[0] * factor)
+    fig.set_figheight(figsize[1] * factor)
+    fig.savefig(figpath + '.png', pad_inches=0, bbox_inches='tight')
+
+    # %% Plot a histogram of recorded AP positions
+    fig = plt.figure(num=10, clear=True)
+    str_title = '%s, id=%i' % (dataset_name.replace('_', '\\_'), dataset_id)
+
+    plt.hist(plot_spec['ap_means'])
+
+    # Adjust the plot
+    plt.xlim([0, 1])
+    plt.xlabel('AP')
+    plt.title(str_title)
 
-    return analyses
+    # Save figure
+    figpath = f"AP_hist_{dataset_id}.png"
+    figpath = os.path.join(AP_hist_folder, figpath)
+    fig.savefig(figpath)
 
 
 def get_slope(nc_data, start, end):
@@ -406,30 +593,158 @@ def get_slope(nc_data, start, end):
     cur_data = nc_data[(nc_data.time >= start)
                        & (nc_data.time <= end)]
 
-    if len(cur_data) <= 3:
-        slope = np.nan
-        coefs = [np.nan, np.nan]
-        slope_V = np.nan
-    else:
-        coefs, V = np.polyfit(cur_data.time, cur_data.intensity, 1, cov=True)
-        slope = coefs[0]
-        slope_V = V[0, 0]
-    return slope, slope_V, coefs
+    slope, intercept, slope_V, _ = grouped_linear_fit(
+        cur_data.time, cur_data.intensity, np.zeros(len(cur_data), dtype=int), 1, min_points=4)
+    return slope[0], slope_V[0], [slope[0], intercept[0]]
+
+
+def get_nc_slopes(table):
+    """
+    Fit the first `slope_length_mins` of each nc of each data set of a `TraceTable` with a straight line.
+    The windows start at the first time point of the nc.
+    All windows are fitted at once with `grouped_linear_fit`, with the same result as `get_slope` for each window.
+
+    Return:
+    dictionary {(dataset_id, nc): (slope, slopeV, coefs, (start, end))}, where [start, end] is the fitted time window
+    """
+    keys = list(table.nc_offsets)
+    if not keys:
+        return {}
+    starts, ends = np.array([table.nc_offsets[key] for key in keys]).T
+    sizes = ends - starts
+
+    # Gather the rows of all nc blocks one after the other
+    block_ind = np.repeat(np.arange(len(keys)), sizes)
+    block_offsets = np.concatenate([[0], np.cumsum(sizes[:-1])])
+    rows = np.arange(sizes.sum()) + np.repeat(starts - block_offsets, sizes)
+    times = table.data.time.values[rows]
+    intensities = table.data.intensity.values[rows]
+
+    # Keep the points within the fitting window of their nc
+    start_slope = np.minimum.reduceat(times, block_offsets)
+    in_window = times <= start_slope[block_ind] + slope_length_mins
+
+    slopes, intercepts, slopesV, _ = grouped_linear_fit(
+        times[in_window], intensities[in_window], block_ind[in_window], len(keys), min_points=4)
+    return {key: (slope, slopeV, [slope, intercept], (start, start + slope_length_mins))
+            for key, slope, slopeV, intercept, start in zip(keys, slopes, slopesV, intercepts, start_slope)}
+
+
+def get_best_nc_slopes(table, window_mins=slope_length_mins):
+    """
+    Detect the initial polymerase injection slope of each nc of each data set of a `TraceTable` adaptively.
+
+    Windows of length `window_mins` starting at each time point of the nc are fitted with a straight line.
+    The window with the lowest residual per point is selected among the windows with a positive slope and a positive intersect with the time axis.
+    The time is counted from the end of the previous nc of the data set, i.e. the fitted injection must start after the previous mitosis.
+    There is no constraint on the intersect for the first nc of a data set.
+    Only the windows fitting within the nc are considered, apart from the window starting at the first time point, which is the window used by `get_nc_slopes`.
+    Like in `get_slope`, a window must contain at least 4 points. These points must belong to at least 3 time points.
+
+    The sums of t, y, t**2, t*y and y**2 of all windows are obtained at once from prefix sums over the time points of the ncs.
+    The cost is therefore linear in the number of points, unlike the window-by-window fits of archive/find_best_fit.py.
+
+    Return:
+    dictionary {(dataset_id, nc): (slope, slopeV, coefs, (start, end))}, where [start, end] is the selected time window.
+    The results are nan if no window satisfies the constraints.
+    """
+    keys = list(table.nc_offsets)
+    if not keys:
+        return {}
+    starts, ends = np.array([table.nc_offsets[key] for key in keys]).T
+    sizes = ends - starts
+
+    # Gather the rows of all nc blocks one after the other
+    block_ind = np.repeat(np.arange(len(keys)), sizes)
+    block_offsets = np.concatenate([[0], np.cumsum(sizes[:-1])])
+    rows = np.arange(sizes.sum()) + np.repeat(starts - block_offsets, sizes)
+    times = table.data.time.values[rows].astype(float)
+    intensities = table.data.intensity.values[rows].astype(float)
+
+    # Count the time from the start of the nc and the intensity from the nc mean to limit round-off errors in the sums
+    nc_start = np.minimum.reduceat(times, block_offsets)
+    nc_end = np.maximum.reduceat(times, block_offsets)
+    intensity_mean = np.add.reduceat(intensities, block_offsets) / sizes
+    t = times - nc_start[block_ind]
+    y = intensities - intensity_mean[block_ind]
+
+    # Aggregate the points of each time point of each nc
+    order = np.lexsort((t, block_ind))
+    block_ind, t, y = block_ind[order], t[order], y[order]
+    is_new_point = np.concatenate([[True], (block_ind[1:] != block_ind[:-1]) | (t[1:] != t[:-1])])
+    point_ind = np.cumsum(is_new_point) - 1
+    point_block = block_ind[is_new_point]
+    point_t = t[is_new_point]
+    points_len = len(point_t)
+
+    sums = np.array([np.bincount(point_ind, weights=weights, minlength=points_len)
+                     for weights in [np.ones_like(t), t, y, t**2, t * y, y**2]])
+    prefix_sums = np.concatenate([np.zeros((len(sums), 1)), np.cumsum(sums, axis=1)], axis=1)
+
+    # The window starting at time point i contains the time points i to window_end - 1 of the same nc.
+    # The (nc, time) keys are sorted, so the ends of all windows are found with one `searchsorted`
+    block_span = np.max(point_t) + window_mins + 1
+    point_keys = point_block * block_span + point_t
+    window_end = np.searchsorted(point_keys, point_keys + window_mins, side='right')
+    n, St, Sy, Stt, Sty, Syy = prefix_sums[:, window_end] - prefix_sums[:, :-1]
+    time_points_count = window_end - np.arange(points_len)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Sxx = Stt - St**2 / n
+        Sxy = Sty - St * Sy / n
+        slopes = Sxy / Sxx
+        # Intercept of the intensity with the time counted from the start of the nc
+        intercepts = (Sy - slopes * St) / n + intensity_mean[point_block]
+        residuals = np.maximum(Syy - Sy**2 / n - slopes * Sxy, 0)
+        slopesV = residuals / (n - 2) / Sxx
+        crossing_times = -intercepts / slopes
+
+    # The time origin of each nc is the last time point of the previous nc of the same data set
+    dataset_ids = np.array([dataset_id for dataset_id, _ in keys])
+    has_previous_nc = np.concatenate([[False], dataset_ids[1:] == dataset_ids[:-1]])
+    origins = np.where(has_previous_nc, np.concatenate([[np.nan], nc_end[:-1]]), -np.inf) - nc_start
+
+    is_first_window = np.concatenate([[True], point_block[1:] != point_block[:-1]])
+    fits_in_nc = point_t + window_mins <= (nc_end - nc_start)[point_block]
+    is_valid = ((is_first_window | fits_in_nc) & (n >= 4) & (time_points_count >= 3)
+                & (slopes > 0) & (crossing_times > origins[point_block]))
+
+    # Select the valid window with the lowest residual per point in each nc
+    scores = np.where(is_valid, residuals / n, np.inf)
+    order = np.lexsort((scores, point_block))
+    best = order[np.concatenate([[True], point_block[order][1:] != point_block[order][:-1]])]
+
+    # Each nc contains at least one time point, so `best` has one window per nc in the order of the ncs
+    nc_slopes = {}
+    for block, (key, window) in enumerate(zip(keys, best)):
+        if is_valid[window]:
+            start = nc_start[block] + point_t[window]
+            coefs = [slopes[window], intercepts[window] - slopes[window] * nc_start[block]]
+            nc_slopes[key] = (slopes[window], slopesV[window], coefs, (start, start + window_mins))
+        else:
+            nc_slopes[key] = (np.nan, np.nan, [np.nan, np.nan], (nc_start[block], nc_start[block] + window_mins))
+    return nc_slopes
 
 
-def get_max_intensity(nc_data):
+def get_max_intensity(nc_data, avg_data=None):
     """
-    Get the maximum polymerase number for a cycle. Average within +- 1 time step of the regular mesh
+    Get the maximum polymerase number for a cycle. Average within +- 1 time step of the regular mesh.
+
+    If the average trace of the whole data set `avg_data` is provided, the maximum is searched among its bins covering the time span of the nc.
+    Otherwise, the nc data are averaged on a regular time mesh.
     """
 
     if nc_data.empty:
         return np.nan
 
-    # print(nc_data)
-    avg_nc_data, _ = get_avg_on_regular_time_mesh(nc_data, dt_new)
-    # print(avg_nc_data.intensity.dtype)
+    if avg_data is None:
+        avg_nc_data, _ = get_avg_on_regular_time_mesh(nc_data, dt_new)
+    else:
+        bin_times = avg_data.index.values
+        first_bin = np.searchsorted(bin_times, nc_data.time.min(), side='right') - 1
+        last_bin = np.searchsorted(bin_times, nc_data.time.max(), side='right') - 1
+        avg_nc_data = avg_data.iloc[max(first_bin, 0):last_bin + 1]
     max_time = avg_nc_data.intensity.idxmax()
-    # print(max_time)
 
     # interval = max_time + np.array([-1, 1]) * dt_new
     int = nc_data[(nc_data.time >= max_time - dt_new) &
@@ -439,13 +754,12 @@ def get_max_intensity(nc_data):
     return max_intensity, max_intensity_std
 
 
-def plot_slopes(dataset_data, coefs, start, end, max_intensity, nc, ax, lw, colors):
+def plot_slopes(dataset_name, intensity_threshold, coefs, start, end, max_intensity, nc, nc_span, ax, lw, colors):
     """
     Plot the initial slopes and measured max intensity of the nuclear cycle.
     Also plots the noise threshold.
+    `nc_span` contains the first and the last time point of the nc.
     """
-    dataset_name = dataset_data.dataset.iloc[0]
-    dataset_id = dataset_data.dataset_id.iloc[0]
 
     # Plot the slope
     x_fit = np.asarray([start, end])
@@ -454,7 +768,6 @@ def plot_slopes(dataset_data, coefs, start, end, max_intensity, nc, ax, lw, colo
 
     # Plot the noise threshold
     xlims = plt.xlim()
-    intensity_threshold = intensity_thresholds.get(dataset_id, default_intensity_threshold)
     ax.plot(xlims, [intensity_threshold] * 2, 'g', lw=lw, c=colors['threshold'])
 
     # Print nc numbers over each detected nc
@@ -462,13 +775,12 @@ def plot_slopes(dataset_data, coefs, start, end, max_intensity, nc, ax, lw, colo
     plt.text(start, ymax * 0.9, f'nc{nc}', fontsize=7)
 
     # Plot the max. polymerase number
-    x_max = [dataset_data[dataset_data.nc == nc].time.min(),
-             dataset_data[dataset_data.nc == nc].time.max()]
+    x_max = list(nc_span)
     y_max = np.asarray([1, 1]) * max_intensity
     plt.plot(x_max, y_max, 'm--', lw=lw, c=colors['max'])
 
     # Add plot title and adjust plot
-    str_title = dataset_name.replace('_', '\_')
+    str_title = dataset_name.replace('_', '\\_')
     plt.title(str_title)
     plt.xlabel('$t$, min')
     plt.ylabel('Fluo, a.u.')
@@ -507,38 +819,76 @@ def get_regular_time_mesh(data, dt):
     return time_mesh
 
 
-def get_avg_on_regular_time_mesh(data, dt):
+def bin_on_time_mesh(time, values, time_mesh):
     """
-    Calculate an average time trace on a regular time mesh with a given dt
+    Calculate the mean, the standard deviation (ddof=1) and the number of points of `values` in each bin [t_i, t_{i+1}) of the time mesh.
+
+    All bins are processed in a single pass with `np.bincount`.
+    Nan values are ignored. Bins with no points get a nan mean, bins with less than 2 points get a nan std.
+    """
+    time = np.asarray(time, dtype=float)
+    values = np.asarray(values, dtype=float)
+    bins_len = len(time_mesh) - 1
+
+    # Attribute each point to a bin. Points outside the mesh and nan values are dropped
+    bin_ind = np.searchsorted(time_mesh, time, side='right') - 1
+    valid = (bin_ind >= 0) & (bin_ind < bins_len) & ~np.isnan(values)
+    bin_ind, values = bin_ind[valid], values[valid]
+
+    count = np.bincount(bin_ind, minlength=bins_len)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(bin_ind, weights=values, minlength=bins_len) / count
+        # Use the deviations from the bin means to avoid the loss of precision of sum(x**2) - n * mean**2
+        squares = np.bincount(bin_ind, weights=(values - mean[bin_ind])**2, minlength=bins_len)
+        std = np.sqrt(squares / (count - 1))
+    std[count < 2] = np.nan
+
+    return mean, std, count
+
+
+def get_avg_on_regular_time_mesh(data, dt, return_count=False):
+    """
+    Calculate an average time trace on a regular time mesh with a given dt.
+    The number of points in each bin is also returned if `return_count` is True
     """
     time_mesh = get_regular_time_mesh(data, dt)
-    avg_data = pd.DataFrame(index=time_mesh[:-1], columns=['intensity'], dtype=float)
-    std_data = avg_data.copy()
-
-    for i in range(len(time_mesh) - 1):
-        int = data[(data.time >= time_mesh[i])
-                   & (data.time < time_mesh[i + 1])].intensity
-        avg_data.loc[time_mesh[i]] = int.mean()
-        std_data.loc[time_mesh[i]] = np.std(int, ddof=1)
-
-    # Interpolate if values are missing. Do not extrapolate
-    avg_data_not_nan = avg_data[~np.isnan(avg_data.intensity)]
-    nan_time = avg_data[np.isnan(avg_data.intensity)].index.values
-    # print(data)
-    # print(avg_data)
-    # print(avg_data_not_nan)
-    # print(nan_time)
+    mean, std, count = bin_on_time_mesh(data.time.values, data.intensity.values, time_mesh)
 
+    # Interpolate if values are missing. Do not extrapolate.
     # Interpolate if more than 1 time point present. Note this is average interpolation
-    if avg_data_not_nan.count().intensity > 1:
-        interp_func = interp1d(avg_data_not_nan.index.values, avg_data_not_nan.intensity.values)
-        avg_data.loc[nan_time, 'intensity'] = interp_func(nan_time)
+    is_nan = np.isnan(mean)
+    if np.sum(~is_nan) > 1:
+        bin_times = time_mesh[:-1]
+        known_times = bin_times[~is_nan]
+        fill = is_nan & (bin_times >= known_times[0]) & (bin_times <= known_times[-1])
+        mean[fill] = np.interp(bin_times[fill], known_times, mean[~is_nan])
+
+    avg_data = pd.DataFrame({'intensity': mean}, index=time_mesh[:-1])
+    std_data = pd.DataFrame({'intensity': std}, index=time_mesh[:-1])
+
+    if return_count:
+        count_data = pd.DataFrame({'intensity': count}, index=time_mesh[:-1])
+        return avg_data, std_data, count_data
     return avg_data, std_data
 
 
-def filter_by_AP(data_in):
+def get_dataset_avg_trace(table, dataset_id, dt):
+    """
+    Get the average trace, its standard deviation and the number of points on a regular time mesh for a data set of a `TraceTable`.
+    The result is calculated once and stored in `table.avg_traces` for later calls.
+    The returned data frames are shared, so they should not be modified.
+    """
+    key = (dataset_id, dt)
+    if key not in table.avg_traces:
+        table.avg_traces[key] = get_avg_on_regular_time_mesh(
+            table.dataset(dataset_id), dt=dt, return_count=True)
+    return table.avg_traces[key]
+
+
+def filter_by_AP(table):
     """
-    This function contains the code used for filtering fluorescence traces by their AP positions
+    This function contains the code used for filtering fluorescence traces by their AP positions.
+    The filtered rows of the `TraceTable` are returned as a new `TraceTable`.
 
     For hb, we find the AP corresponding to maximum expression APmax, and then take all traces in the interval [0.05; APmax - 0.05].
 
@@ -552,45 +902,36 @@ def filter_by_AP(data_in):
     knirps_half_width_AP = 0.02
     hb_AP_margin = 0.05
 
-    datasets = set(data_in.dataset)
-    data = pd.DataFrame()
-
-    for dataset in tqdm(datasets, desc='Parsing data sets'):
-        # Take one data set
-        dataset_data = data_in[data_in.dataset == dataset]
-        gene = dataset_data.gene.iloc[0]
-
-        if gene == 'hb':
-            # Localize the maximum and keep the AP region described above
-            max_AP = dataset_data.ap_mean.max()
-            filtered_data = dataset_data[
-                (dataset_data.ap_mean <= max_AP - hb_AP_margin) &
-                (dataset_data.ap_mean >= hb_AP_margin)]
-            data = pd.concat([data, filtered_data])
-
-        elif gene == 'kn':
-            frames = set(dataset_data.frame)
-            # Individually process each frame
-            for frame in frames:
-                frame_data = dataset_data[dataset_data.frame == frame]
-                median_AP = frame_data.ap.median()
-                filtered_data = frame_data[
-                    (frame_data.ap >= median_AP - knirps_half_width_AP) &
-                    (frame_data.ap <= median_AP + knirps_half_width_AP)]
-                data = pd.concat([data, filtered_data])
-
-        elif gene == 'sn':
-            filtered_data = dataset_data
-            data = pd.concat([data, filtered_data])
+    data = table.data
+
+    # The gene of each data set is defined by its first row
+    gene = table.per_dataset(table.first('gene').values)
+
+    # hb: localize the maximum in each data set and keep the AP region described above
+    max_AP = table.per_dataset(np.fmax.reduceat(data.ap_mean.values, table.dataset_offsets[:-1]))
+    is_hb = (gene == 'hb') & (data.ap_mean.values <= max_AP - hb_AP_margin) & (
+        data.ap_mean.values >= hb_AP_margin)
+
+    # kn: individually process each frame of each data set
+    median_AP = data.groupby(['dataset_id', 'frame']).ap.transform('median').values
+    is_kn = (gene == 'kn') & (data.ap.values >= median_AP - knirps_half_width_AP) & (
+        data.ap.values <= median_AP + knirps_half_width_AP)
+
+    # sn: no filtering
+    is_sn = gene == 'sn'
+
+    table = table.filter(is_hb | is_kn | is_sn)
     print('Data filtered!')
 
-    return data
+    return table
 
 
-def identify_ncs(data):
+def identify_ncs(table):
     """
     Identify ncs in data traces by first thresholding and then numbering the ncs above the threshold.
     See README form more details.
+
+    Return a new `TraceTable` with an `nc` column and the table of nc time limits.
     """
     # The sequential number of the last observed nc.
     # By default the last expected nc is nc14.
@@ -610,22 +951,19 @@ def identify_ncs(data):
         70: 13,
     }
 
-    datasets_len = data.dataset_id.max() + 1
     ncs = range(11, 15)
 
+    # Only process the data sets present in the input
+    dataset_ids = table.dataset_ids
+
     # Prepare output data frames
-    data_out = copy.deepcopy(data)
-    data_out['nc'] = np.nan
     iterables = pd.MultiIndex.from_product(
-        [range(datasets_len), ncs], names=['dataset_id', 'nc'])
-    nc_limits = pd.DataFrame(columns=['Tstart', 'Tend'], index=iterables)
-
-    for dataset_id in trange(datasets_len, desc='Processing data sets'):
-        # dataset_id = 54
-        dataset_data = data[(data.dataset_id == dataset_id)]
+        [dataset_ids, ncs], names=['dataset_id', 'nc'])
+    nc_limits = pd.DataFrame(np.nan, columns=['Tstart', 'Tend'], index=iterables)
 
+    for dataset_id, dataset_data in tqdm(table.datasets(), total=len(dataset_ids), desc='Processing data sets'):
         # Calculate average trace
-        avg_trace, _ = get_avg_on_regular_time_mesh(dataset_data, dt=dt_new)
+        avg_trace = get_dataset_avg_trace(table, dataset_id, dt_new)[0].copy()
 
         # Threshold the average trace
         intensity_threshold = intensity_thresholds.get(dataset_id, default_intensity_threshold)
@@ -654,151 +992,302 @@ def identify_ncs(data):
         avg_trace.loc[~avg_trace.is_expressing, 'nc'] = np.nan
 
         # %% Collect the nc time intervals in a separate table
-        for nc in ncs:
-            nc_data = avg_trace[avg_trace.nc == nc]
-            if not nc_data.empty:
-                Tstart = avg_trace[avg_trace.nc == nc].index[0]
-                Tend = avg_trace[avg_trace.nc == nc].index[-1]
-                nc_limits.loc[(dataset_id, nc), ['Tstart', 'Tend']] = [Tstart, Tend]
+        limits = avg_trace[avg_trace.nc.isin(ncs)].reset_index().groupby('nc')['index'].agg(['first', 'last'])
+        for nc, (Tstart, Tend) in limits.iterrows():
+            nc_limits.loc[(dataset_id, int(nc)), ['Tstart', 'Tend']] = [Tstart, Tend]
+
+    # %% Use the interval table to label the original non-averaged data in one pass per data set.
+    # The nc intervals of a data set do not overlap, so each time point falls at most into the last interval starting before it
+    nc_column = np.full(len(table), np.nan)
+    times = table.data.time.values
+    for i, dataset_id in enumerate(dataset_ids):
+        limits = nc_limits.loc[dataset_id].dropna()
+        if limits.empty:
+            continue
+        rows = np.arange(table.dataset_offsets[i], table.dataset_offsets[i + 1])
+        interval = np.searchsorted(limits.Tstart.values, times[rows], side='right') - 1
+        is_inside = interval >= 0
+        is_inside[is_inside] = times[rows[is_inside]] <= limits.Tend.values[interval[is_inside]]
+        nc_column[rows[is_inside]] = limits.index.values[interval[is_inside]]
 
-        # %% Use the table to label original non-averaged data set
-        for nc in ncs:
-            indices = ((data_out.time >= nc_limits.loc[(dataset_id, nc), 'Tstart'])
-                       & (data_out.time <= nc_limits.loc[(dataset_id, nc), 'Tend'])
-                       & (data_out.dataset_id == dataset_id)
-                       )
-            # Add as an extra column for the input data frame
-            data_out.loc[indices, 'nc'] = nc
-    return data_out, nc_limits
+    # Add as an extra column. The rows are sorted again to build the nc blocks
+    return table.assign(nc=nc_column), nc_limits
 
 
-def perform_welchs_test(analyses_in):
-    """
-    Perform Welch's unequal variances t-test to evaluate whether alpha is the same across genes, constructs or ncs.
-    Each of the three parts of the code corresponds to one changing parameter.
+contrast_columns = ['comparison', 'quantity', 'gene1', 'construct1', 'nc1', 'gene2', 'construct2', 'nc2']
 
-    All of the tests are performed for alpha since we saw that it is close to being normally distributed, while tau isn't.
-    Similarities between other parameters are tested for historical reasons and are not re-used later on.
+
+def get_welch_summary(analyses, quantities):
     """
-    analyses = analyses_in.copy()
+    Summarize the quantities of each (gene, construct, nc) group for Welch's tests in one tidy table.
 
-    genes = set(analyses.gene)
-    constructs = set(analyses.construct)
-    gene_ids = set(analyses.gene_id)
-    ncs = set(analyses.index.get_level_values(1))
-    quantities = ['r', 'j', 'alpha_over_k_comb', 'tau', 'alpha_comb']
+    For 'r' and 'j', the mean and the variance across the data sets of the group are used.
+    For the other quantities (the mixed estimators), the estimate of the group and its variance are used.
+    The number of samples is the number of data sets of the group with a value.
 
-    grouped = analyses.groupby(by=['gene', 'nc', 'construct'])
-    idx = pd.IndexSlice
+    Return:
+    data frame indexed by (quantity, gene, construct, nc) with columns `mean`, `V` and `n`
+    """
+    grouped = analyses.groupby(by=['gene', 'construct', 'nc'])
+    summaries = []
+    for quantity in quantities:
+        if quantity in ['r', 'j']:
+            means = grouped[quantity].mean()
+            vars = grouped[quantity].var(ddof=1)
+        else:
+            means = grouped[quantity].first()
+            vars = grouped[quantity + 'V'].first()
+        summaries.append(pd.DataFrame({'mean': means, 'V': vars, 'n': grouped[quantity].count()}))
+    return pd.concat(summaries, keys=quantities, names=['quantity']).astype(float)
 
-    # Initialize a temporary data frame
-    calc = pd.DataFrame()
-    for col in ['t', 'nu']:
-        calc[col] = np.nan
 
-    # %% Test for similarities across constructs
-    # Some tests are only performed if all three constructs are availables
-    has_all_constructs = 'bac' in constructs and 'no_pr' in constructs and 'no_sh' in constructs
-    if not has_all_constructs:
-        print(">> Skipping Welch's test across constructs: some of the constructs were not detected <<")
-    else:
-        print('>> p-values across constructs <<')
-        for quantity in quantities:
-            # Load/calculate means, variances and number of samples
-            if quantity in ['r', 'j']:
-                calc['means'] = grouped[quantity].mean()
-                calc['vars'] = grouped[quantity].apply(
-                    lambda group: np.var(group[~np.isnan(group)], ddof=1))
+def get_contrasts(analyses):
+    """
+    Enumerate the comparisons of `perform_welchs_test`:
+    - 'construct'   -   no_sh vs bac for each gene and nc, for r, j, alpha_over_k_comb, tau and alpha_comb. Only if all three constructs are present;
+    - 'nc'          -   nc14 vs each earlier nc for each gene and construct, for alpha_comb;
+    - 'gene'        -   each pair of genes for each construct and nc, for alpha_comb and tau.
 
-            elif quantity in ['alpha_over_k_comb', 'tau', 'alpha_comb']:
-                calc['means'] = grouped[quantity].first()
-                calc['vars'] = grouped[quantity + 'V'].first()
+    Return:
+    data frame with one row per test: the comparison type, the quantity and the two groups (gene1, construct1, nc1, gene2, construct2, nc2)
+    """
+    genes = sorted(set(analyses.gene))
+    constructs = sorted(set(analyses.construct))
+    gene_ids = sorted(set(analyses.gene_id))
+    ncs = sorted(set(analyses.index.get_level_values(1)))
 
-            calc['n'] = grouped[quantity].count()
+    # Each contrast is (comparison, quantity, group 1, group 2)
+    contrasts = []
 
-            # Calculate independently for each gene and nc
+    has_all_constructs = 'bac' in constructs and 'no_pr' in constructs and 'no_sh' in constructs
+    if has_all_constructs:
+        for quantity in ['r', 'j', 'alpha_over_k_comb', 'tau', 'alpha_comb']:
             for gene in genes:
                 for nc in ncs:
-                    bac = calc.loc[(gene, nc, 'bac'), :]
-                    no_sh = calc.loc[(gene, nc, 'no_sh'), :]
+                    contrasts.append(('construct', quantity, (gene, 'no_sh', nc), (gene, 'bac', nc)))
 
-                    p, t, nu = welchs_test(
-                        x1Mean=no_sh.means, x1V=no_sh.vars,
-                        n1=no_sh.n, x2Mean=bac.means, x2V=bac.vars, n2=bac.n)
+    nc1 = 14
+    for gene in genes:
+        for construct in constructs:
+            for nc2 in ncs:
+                if nc2 < nc1:
+                    contrasts.append(('nc', 'alpha_comb', (gene, construct, nc1), (gene, construct, nc2)))
 
-                    calc.loc[(gene, nc, 'bac'), ['t']] = t
-                    calc.loc[(gene, nc, 'bac'), ['nu']] = nu
-                    label = quantity + '_p_value'
-                    calc.loc[(gene, nc, 'bac'), label] = p
+    for construct in constructs:
+        for nc in ncs:
+            for gene_id1 in gene_ids:
+                for gene_id2 in gene_ids:
+                    if gene_id2 <= gene_id1:
+                        continue
+                    gene1, gene2 = [gene_labels[i] for i in [gene_id1, gene_id2]]
+                    for quantity in ['alpha_comb', 'tau']:
+                        contrasts.append(('gene', quantity, (gene1, construct, nc), (gene2, construct, nc)))
 
-                    # Copy the p-value back into the analyses table
-                    gene_filter = analyses.gene == gene
-                    analyses.loc[idx[gene_filter, nc], label] = p
+    return pd.DataFrame([(comparison, quantity) + group1 + group2
+                         for comparison, quantity, group1, group2 in contrasts], columns=contrast_columns)
 
-                    # Print out results for `alpha_comb`
-                    if not np.isnan(t) and quantity is 'alpha_comb':
-                        print(f'{gene}, nc{nc}, bac, no_sh:\tp for alpha_comb: {p:.2g}')
 
-    # %% Test across ncs for only alpha similarities.
-    # Basically I compare nc14 to all other ncs for each gene-construct combination
-    print('\n>> p-values across ncss <<')
-    quantity = 'alpha_comb'
-    nc1 = 14
+def get_welch_tests(analyses):
+    """
+    Perform all Welch's tests of the comparisons of `get_contrasts` in a single vectorized call.
 
-    # Load means, vars and sample numbers
-    calc['means'] = grouped[quantity].first()
-    calc['vars'] = grouped[quantity + 'V'].first()
-    calc['n'] = grouped[quantity].count()
+    Return:
+    long-format data frame with one row per test: the comparison type, the quantity, the two groups (gene1, construct1, nc1, gene2, construct2, nc2), the group means and the t, nu and p values.
+    For 'r' and 'j', the log10 Bayes factor of `get_bayes_factors` is given in `log10_B`. It is nan for the other quantities.
+    The p-values can be used for a multiple-testing correction.
+    Groups absent from the analyses give nan results.
+    """
+    tests = get_contrasts(analyses)
+    if tests.empty:
+        return tests.assign(mean1=[], mean2=[], t=[], nu=[], p=[], log10_B=[])
+
+    # Gather the summaries of both groups of each test
+    summary = get_welch_summary(analyses, sorted(set(tests.quantity)))
+    groups = {}
+    for i in ['1', '2']:
+        keys = pd.MultiIndex.from_arrays(
+            [tests[col + i] if col != 'quantity' else tests[col] for col in ['quantity', 'gene', 'construct', 'nc']])
+        # Groups absent from the analyses get nan
+        groups[i] = summary.reindex(keys)
+
+    p, t, nu = welchs_test(
+        x1Mean=groups['1']['mean'].values, x1V=groups['1']['V'].values, n1=groups['1']['n'].values,
+        x2Mean=groups['2']['mean'].values, x2V=groups['2']['V'].values, n2=groups['2']['n'].values)
+
+    tests = tests.assign(mean1=groups['1']['mean'].values, mean2=groups['2']['mean'].values, t=t, nu=nu, p=p)
+
+    # Add the Bayes factors of the quantities with one value per data set. The Bayes factor is symmetric in the two groups
+    bayes_factors = get_bayes_factors(analyses, quantities=sorted({'r', 'j'} & set(tests.quantity)))
+    swapped = bayes_factors.rename(columns={col + i: col + j for col in ['gene', 'construct', 'nc']
+                                            for i, j in [('1', '2'), ('2', '1')]})
+    bayes_factors = pd.concat([bayes_factors, swapped], ignore_index=True)
+    return tests.merge(bayes_factors, how='left', on=contrast_columns[1:])
+
+
+def get_dataset_samples(analyses, quantity):
+    """
+    Get the value of a quantity for each data set, so that groups of data sets can be compared without assuming normality.
 
-    for gene in genes:
-        for construct in constructs:
-            for nc2 in ncs:
-                if nc2 >= nc1:
-                    continue
-                data1 = calc.loc[(gene, nc1, construct), :]
-                data2 = calc.loc[(gene, nc2, construct), :]
+    'r' and 'j' are measured in each data set.
+    For the mixed estimators, the estimators of each data set are combined with the weights of their group (`kappa` or `kappa_tau`), like in the Shapiro-Wilk tests of `calculate_alpha`.
+    """
+    if quantity in ['r', 'j']:
+        return analyses[quantity]
+
+    aoK_rho, aoK_J = analyses.alpha_over_k_rho, analyses.alpha_over_k_J
+    if quantity == 'tau':
+        def tau(aoK):
+            return 1 / aoK / k * 60
+        return analyses.kappa_tau * tau(aoK_rho) + (1 - analyses.kappa_tau) * tau(aoK_J)
+
+    aoK_mixed = analyses.kappa * aoK_rho + (1 - analyses.kappa) * aoK_J
+    if quantity == 'alpha_over_k_comb':
+        return aoK_mixed
+    elif quantity == 'alpha_comb':
+        return aoK_mixed * k
+    raise ValueError(f"No values per data set for the quantity '{quantity}'")
+
+
+def get_permutation_tests(analyses, permutations=10**5, workers=1, rng=None):
+    """
+    Perform permutation tests for the comparisons of `get_contrasts` with the values of each data set given by `get_dataset_samples`.
+    The tests do not assume normality. The permutations of all tests are evaluated by `support.permutation_tests`, in parallel if `workers` > 1.
+
+    Return:
+    long-format data frame with one row per test: the comparison type, the quantity, the two groups (gene1, construct1, nc1, gene2, construct2, nc2), the group means, the p value and the number of permutations performed.
+    Groups absent from the analyses give nan results.
+    """
+    tests = get_contrasts(analyses)
+    if tests.empty:
+        return tests.assign(mean1=[], mean2=[], p=[], permutations=[])
+
+    # Split the values of each quantity by group
+    group_samples = {}
+    groups = [analyses.gene, analyses.construct, analyses.index.get_level_values(1)]
+    for quantity in set(tests.quantity):
+        for group, values in get_dataset_samples(analyses, quantity).groupby(groups):
+            group_samples[(quantity,) + group] = values.values
+
+    samples = {}
+    for i in ['1', '2']:
+        keys = zip(tests.quantity, tests['gene' + i], tests['construct' + i], tests['nc' + i])
+        samples[i] = [group_samples.get(key, np.array([])) for key in keys]
+
+    p, _, done = permutation_tests(samples['1'], samples['2'], permutations=permutations, workers=workers, rng=rng)
+
+    with np.errstate(invalid='ignore'):
+        means = {i: [np.nanmean(x) if np.any(~np.isnan(x)) else np.nan for x in samples[i]] for i in ['1', '2']}
+    return tests.assign(mean1=means['1'], mean2=means['2'], p=p, permutations=done)
+
+
+def get_bayes_factors(analyses, quantities=('r', 'j'), mu_pi=None, V_pi=None):
+    """
+    Calculate the log10 Bayes factors (see `support.bayes_factor`) between every pair of (gene, construct, nc) groups.
+
+    Only the quantities with one value per data set can be compared, since the Bayes factor needs the number of values, their mean and their biased variance in each group.
+    By default, the prior is centered on the mean of all data sets, with the variance of all data sets. The weight of the prior is `n_pi` from `constants`.
+
+    Return:
+    long-format data frame with one row per pair of groups: the quantity, the two groups (gene1, construct1, nc1, gene2, construct2, nc2) and `log10_B`.
+    Each pair appears once. Groups without values give nan.
+    """
+    grouped = analyses.groupby(by=['gene', 'construct', 'nc'])
+    results = []
+    for quantity in quantities:
+        stats = pd.DataFrame({'n': grouped[quantity].count(),
+                              'mean': grouped[quantity].mean(),
+                              'V': grouped[quantity].var(ddof=0)})
+        values = analyses[quantity].dropna()
+        prior_mean = values.mean() if mu_pi is None else mu_pi
+        prior_V = values.var(ddof=0) if V_pi is None else V_pi
+
+        # All pairs of groups at once
+        ind1, ind2 = np.triu_indices(len(stats), k=1)
+        stats1, stats2 = stats.iloc[ind1], stats.iloc[ind2]
+        log10_B = bayes_factor(
+            n1=stats1.n.values, mean1=stats1['mean'].values, V1=stats1.V.values,
+            n2=stats2.n.values, mean2=stats2['mean'].values, V2=stats2.V.values,
+            mu_pi=prior_mean, V_pi=prior_V)
+
+        result = pd.DataFrame({'quantity': quantity}, index=range(len(ind1)))
+        for i, groups in zip(['1', '2'], [stats1, stats2]):
+            for level in ['gene', 'construct', 'nc']:
+                result[level + i] = groups.index.get_level_values(level).values
+        result['log10_B'] = log10_B
+        results.append(result)
+
+    if not results:
+        return pd.DataFrame(columns=['quantity', 'gene1', 'construct1', 'nc1',
+                                     'gene2', 'construct2', 'nc2', 'log10_B'])
+    return pd.concat(results, ignore_index=True)
+
+
+def perform_welchs_test(analyses_in, test='welch', permutations=10**5, workers=1, rng=None):
+    """
+    Perform Welch's unequal variances t-test to evaluate whether alpha is the same across genes, constructs or ncs.
+    Each of the three parts of the code corresponds to one changing parameter.
+
+    All of the tests are performed for alpha since we saw that it is close to being normally distributed, while tau isn't.
+    Similarities between other parameters are tested for historical reasons and are not re-used later on.
+
+    All tests are performed at once by `get_welch_tests`, which returns them as a long-format table.
+    The p-values of the tests across constructs are saved in the `<quantity>_p_value` columns, and the log10 Bayes factors of 'r' and 'j' next to them in the `<quantity>_log10_B` columns.
+
+    With `test='permutation'`, the same comparisons are evaluated with permutation tests of the values of each data set instead (see `get_permutation_tests`), which do not assume normality.
+    `permutations` is the maximal number of permutations per test, `workers` the number of processes and `rng` a seed or a `numpy.random.Generator`.
+    """
+    analyses = analyses_in.copy()
+    if test == 'welch':
+        tests = get_welch_tests(analyses)
+    elif test == 'permutation':
+        tests = get_permutation_tests(analyses, permutations=permutations, workers=workers, rng=rng)
+    else:
+        raise ValueError(f"Unknown test '{test}'. Use 'welch' or 'permutation'")
 
-                p, t, nu = welchs_test(
-                    x1Mean=data1.means, x1V=data1.vars,
-                    n1=data1.n, x2Mean=data2.means, x2V=data2.vars, n2=data2.n)
+    # %% Test for similarities across constructs
+    construct_tests = tests[tests.comparison == 'construct']
+    if construct_tests.empty:
+        print(">> Skipping Welch's test across constructs: some of the constructs were not detected <<")
+    else:
+        print('>> p-values across constructs <<')
+        # Copy the p-values back into the analyses table for all constructs of each gene and nc
+        rows = pd.MultiIndex.from_arrays([analyses.gene, analyses.index.get_level_values(1)])
+        for quantity, quantity_tests in construct_tests.groupby('quantity', sort=False):
+            quantity_tests = quantity_tests.set_index(['gene1', 'nc1'])
+            analyses[quantity + '_p_value'] = quantity_tests.p.reindex(rows).values
+            # Keep the Bayes factors next to the p-values of the quantities with one value per data set
+            if 'log10_B' in quantity_tests and quantity_tests.log10_B.notna().any():
+                analyses[quantity + '_log10_B'] = quantity_tests.log10_B.reindex(rows).values
+
+        # Print out results for `r` and `j` with their Bayes factors
+        if 'log10_B' in construct_tests:
+            for row in construct_tests[construct_tests.quantity.isin(['r', 'j'])
+                                       & ~construct_tests.p.isna()].itertuples():
+                print(f'{row.gene1}, nc{row.nc1}, bac, no_sh:\tp for {row.quantity}: {row.p:.2g},\tlog10 B: {row.log10_B:.2g}')
+
+        # Print out results for `alpha_comb`
+        for row in construct_tests[(construct_tests.quantity == 'alpha_comb')
+                                   & ~construct_tests.p.isna()].itertuples():
+            print(f'{row.gene1}, nc{row.nc1}, bac, no_sh:\tp for alpha_comb: {row.p:.2g}')
 
-                print(f'{gene}, {construct}, nc{nc2}, nc{nc1}:\tp for alpha: {p:.2g}')
+    # %% Test across ncs for only alpha similarities.
+    # Basically I compare nc14 to all other ncs for each gene-construct combination
+    print('\n>> p-values across ncss <<')
+    for row in tests[tests.comparison == 'nc'].itertuples():
+        print(f'{row.gene1}, {row.construct1}, nc{row.nc2}, nc{row.nc1}:\tp for alpha: {row.p:.2g}')
 
     # %% Similarity test for alpha across genes
-    if len(genes) < 2:
+    if len(set(analyses.gene)) < 2:
         print("\n>> Skipping Welch's test across genes: not enough genes <<")
     else:
         print('\n>> p-values across genes <<')
-
-        grouped = analyses.groupby(by=['gene', 'nc', 'construct'])
-        index = pd.MultiIndex.from_product([ncs, genes, genes])
-
-        quantities = ['alpha_comb', 'tau']
         print('p-values across genes: ')
-        for construct in constructs:
-            for nc in ncs:
-                for gene_id1 in gene_ids:
-                    for gene_id2 in gene_ids:
-                        if gene_id2 <= gene_id1:
-                            continue
-                        p = {}
-                        for quantity in quantities:
-
-                            # Create a temporary data frame
-                            calc = pd.DataFrame()
-                            calc['means'] = grouped[quantity].first()
-                            calc['vars'] = grouped[quantity + 'V'].first()
-                            calc['n'] = grouped[quantity].count()
-
-                            gene1, gene2 = [gene_labels[i] for i in [gene_id1, gene_id2]]
-                            data1 = calc.loc[(gene1, nc, construct), :]
-                            data2 = calc.loc[(gene2, nc, construct), :]
-
-                            p[quantity], t, nu = welchs_test(
-                                x1Mean=data1.means, x1V=data1.vars,
-                                n1=data1.n, x2Mean=data2.means, x2V=data2.vars, n2=data2.n)
-                        print(
-                            f'{construct}, nc{nc}, {gene1}, {gene2}:\tp for {quantities[0]} - {p[quantities[0]]:.2g},\tp for {quantities[1]} - {p[quantities[1]]:.2g}')
+        gene_tests = tests[tests.comparison == 'gene']
+        quantities = ['alpha_comb', 'tau']
+        p = {quantity: gene_tests[gene_tests.quantity == quantity].p.values for quantity in quantities}
+        for i, row in enumerate(gene_tests[gene_tests.quantity == quantities[0]].itertuples()):
+            print(
+                f'{row.construct1}, nc{row.nc1}, {row.gene1}, {row.gene2}:\tp for {quantities[0]} - {p[quantities[0]][i]:.2g},\tp for {quantities[1]} - {p[quantities[1]][i]:.2g}')
     return analyses
 
 
@@ -0,0 +1,221 @@
+"""
+This file contains the import of the `CompiledParticles.mat` files of the MS2 image analysis into the input table of the pipeline.
+It replaces `MATLAB conversion code/data_to_csv.m`, which needs MATLAB.
+
+The data sets are expected in the `<data_folder>/<gene folder>/_approved/<data set>/CompiledParticles.mat` files, with the gene folders listed in `gene_folders`.
+The `Frame`, `Fluo` and `APpos` arrays of each particle are flattened into the `frame`, `intensity` and `ap` columns, and the time is `Frame * mins_per_frame`.
+As in `data_to_csv.m`, the construct is `no_sh` if the data set name contains 'shad', `no_pr` if it contains 'prim', and `bac` otherwise (case-insensitive).
+
+MATLAB v7.3 files are HDF5 files and are read with the optional `h5py` package. Older versions are read with `scipy.io.loadmat`.
+The table is written directly into the binary cache format (see `cache.py`) and can be loaded with `load_data`.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.io import loadmat
+from tqdm import tqdm
+
+from cache import cache_version, convert_types, read_cache, write_cache
+from constants import gene_labels, mins_per_frame
+
+gene_folders = {'HunchBack': 'hb', 'Knirps': 'kn', 'SNAIL': 'sn'}
+particle_fields = {'Frame': 'frame', 'Fluo': 'intensity', 'APpos': 'ap'}
+compiled_particles_filename = 'CompiledParticles.mat'
+
+
+def get_construct(dataset):
+    """
+    Identify the construct and its id from the data set name
+    """
+    if 'shad' in dataset.lower():
+        return 'no_sh', 2
+    elif 'prim' in dataset.lower():
+        return 'no_pr', 1
+    return 'bac', 0
+
+
+def find_datasets(data_folder):
+    """
+    List the data set folders of all genes in the order of `data_to_csv.m`: by gene, then by data set name.
+
+    Return:
+    list of tuples (gene, data set name, data set folder)
+    """
+    datasets = []
+    for gene_folder, gene in gene_folders.items():
+        approved_folder = os.path.join(data_folder, gene_folder, '_approved')
+        if not os.path.isdir(approved_folder):
+            continue
+        for dataset in sorted(os.listdir(approved_folder)):
+            if os.path.isdir(os.path.join(approved_folder, dataset)):
+                datasets.append((gene, dataset, os.path.join(approved_folder, dataset)))
+    return datasets
+
+
+def read_particles_hdf5(filepath):
+    """
+    Read the particle fields from a MATLAB v7.3 file.
+    Each field of the `CompiledParticles` struct array is a column of references to the arrays of the particles.
+    """
+    import h5py
+
+    def read_array(dataset):
+        # Empty arrays are saved as their dimensions with the `MATLAB_empty` attribute
+        if dataset.attrs.get('MATLAB_empty', 0):
+            return np.array([])
+        return np.asarray(dataset, dtype=float).ravel()
+
+    particles = []
+    with h5py.File(filepath, 'r') as file:
+        group = file['CompiledParticles']
+        fields = {}
+        for field in particle_fields:
+            # Some data sets spell the AP position field as `APPos`
+            name = 'APPos' if field == 'APpos' and field not in group else field
+            if name not in group:
+                continue
+            dataset = group[name]
+            if h5py.check_ref_dtype(dataset.dtype) is not None:
+                fields[field] = [read_array(file[ref]) for ref in dataset[()].ravel()]
+            else:
+                # A single particle
+                fields[field] = [read_array(dataset)]
+        particles_len = len(fields['Frame'])
+        for i in range(particles_len):
+            particles.append({field: values[i] for field, values in fields.items()})
+    return particles
+
+
+def read_particles(filepath):
+    """
+    Read the `Frame`, `Fluo` and `APpos` arrays of each particle of a `CompiledParticles.mat` file.
+
+    Return:
+    list of dictionaries {field: array}, one per particle
+    """
+    try:
+        contents = loadmat(filepath, variable_names=['CompiledParticles'], simplify_cells=True)
+    except NotImplementedError:
+        # MATLAB v7.3 files
+        return read_particles_hdf5(filepath)
+
+    particles = contents['CompiledParticles']
+    # A single particle is loaded as a dictionary
+    if isinstance(particles, dict):
+        particles = [particles]
+    # Files with several spot channels contain a cell array of particle arrays. Keep the first channel
+    if len(particles) > 0 and not isinstance(particles[0], dict):
+        particles = particles[0]
+        particles = [particles] if isinstance(particles, dict) else particles
+    # Some data sets spell the AP position field as `APPos`
+    particles = [{'APpos' if field == 'APPos' else field: value for field, value in particle.items()}
+                 for particle in particles]
+    return [{field: np.atleast_1d(np.asarray(particle[field], dtype=float))
+             for field in particle_fields if field in particle} for particle in particles]
+
+
+def load_dataset(gene, dataset, folder):
+    """
+    Flatten the particles of one data set into a table with one row per particle and frame.
+    The ids of the data set and of the traces are assigned later.
+
+    Return:
+    table           -   the table, or None if the `CompiledParticles.mat` file cannot be read
+    particles_len   -   the number of particles, including the particles without frames
+    """
+    try:
+        particles = read_particles(os.path.join(folder, compiled_particles_filename))
+    except (OSError, KeyError, ValueError, ImportError) as error:
+        print(f'Could not read data set `{dataset}`: {error}')
+        return None, 0
+
+    lengths = np.array([len(particle['Frame']) for particle in particles], dtype=int)
+    columns = {'particle': np.repeat(np.arange(len(particles)), lengths)}
+    for field, column in particle_fields.items():
+        # Missing fields are filled with nan like in `data_to_csv.m`
+        columns[column] = np.concatenate(
+            [particle[field] if field in particle and len(particle[field]) == length else np.full(length, np.nan)
+             for particle, length in zip(particles, lengths)]) if len(particles) > 0 else np.array([])
+    table = pd.DataFrame(columns)
+    table['frame'] = table['frame'].astype(int)
+    table['time'] = table['frame'] * mins_per_frame
+
+    construct, construct_id = get_construct(dataset)
+    table['dataset'] = dataset
+    table['gene'] = gene
+    table['gene_id'] = gene_labels.index(gene)
+    table['construct'] = construct
+    table['construct_id'] = construct_id
+    return table, len(particles)
+
+
+def get_source_fingerprint(datasets):
+    """
+    Identify the current version of the input files by their paths, sizes and modification times, without reading them
+    """
+    sha = hashlib.sha256()
+    mtime = 0.0
+    for _, _, folder in datasets:
+        filepath = os.path.join(folder, compiled_particles_filename)
+        if os.path.isfile(filepath):
+            stat = os.stat(filepath)
+            sha.update(repr((filepath, stat.st_size, stat.st_mtime)).encode())
+            mtime = max(mtime, stat.st_mtime)
+    return sha.hexdigest(), mtime
+
+
+def import_compiled_particles(data_folder, output_path, workers=1, use_cache=True):
+    """
+    Import all `CompiledParticles.mat` files of the data folder into a binary cache file.
+
+    The data sets are read in parallel by `workers` processes.
+    The data sets are numbered in the order of `find_datasets`, and the traces are numbered sequentially across data sets.
+    As in `data_to_csv.m`, each particle takes a trace id, even if it has no frames.
+    The mean AP position of each trace (`ap_mean`) is added like in `load_data`.
+
+    Parameters:
+    output_path -   path of the `.npz` file to create. It can be used as the input file of `load_data`
+    use_cache   -   if True, the import is skipped when the `.mat` files have not changed since `output_path` was written
+
+    Return:
+    the imported table
+    """
+    datasets = find_datasets(data_folder)
+    source_hash, source_mtime = get_source_fingerprint(datasets)
+    if use_cache and os.path.isfile(output_path):
+        with np.load(output_path, allow_pickle=False) as arrays:
+            is_current = (int(arrays['_version']) == cache_version and str(arrays['_source_hash']) == source_hash)
+        if is_current:
+            return read_cache(output_path)
+    genes, names, folders = zip(*datasets) if datasets else ([], [], [])
+
+    desc = 'Reading CompiledParticles'
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outputs = list(tqdm(executor.map(load_dataset, genes, names, folders), total=len(datasets), desc=desc))
+    else:
+        outputs = [load_dataset(*dataset) for dataset in tqdm(datasets, desc=desc)]
+
+    error_datasets = [name for name, (table, _) in zip(names, outputs) if table is None]
+    outputs = [(table, particles_len) for table, particles_len in outputs if table is not None]
+    if error_datasets:
+        print('Encountered errors in the data sets:\n' + '\n'.join(error_datasets))
+
+    trace_offset = 0
+    for dataset_id, (table, particles_len) in enumerate(outputs):
+        table['dataset_id'] = dataset_id
+        table['trace_id'] = table.pop('particle') + trace_offset
+        trace_offset += particles_len
+    tables = [table for table, _ in outputs]
+
+    columns = ['trace_id', 'dataset_id', 'dataset', 'gene', 'gene_id', 'construct', 'construct_id', 'frame', 'time',
+               'intensity', 'ap']
+    data = pd.concat(tables, ignore_index=True)[columns] if tables else pd.DataFrame(columns=columns)
+    data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+    data = convert_types(data)
+    write_cache(data, output_path, source_hash=source_hash, source_mtime=source_mtime)
+    return data
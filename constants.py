@@ -64,8 +64,14 @@ f'expected slope length = {slope_length_mins:.2f} +- {np.sqrt(slope_length_minsV
 # %% Bayes factors
 n_pi = 4
 
+# %% Monte Carlo error propagation
+mc_samples = 100000  # samples per row
+mc_quantiles = [0.025, 0.5, 0.975]
+
 # %% Misc
 figures_folder = r".\figures"
+stage_cache_folder = r".\stage_cache"
+dataset_store_folder = r".\dataset_store"
 
 gene_labels = ['hb', 'kn', 'sn']
 gene_long = {'hb': 'hunchback', 'kn': 'knirps', 'sn': 'snail'}
@@ -0,0 +1,121 @@
+"""
+This file contains the incremental processing of the data sets by the per-data-set stages of the pipeline: `filter_by_AP`, `identify_ncs` and `calculate_slopes`.
+
+These stages process each data set independently, so their results are kept for each data set in the `dataset_store_folder`.
+Each data set is identified by a key, the sha256 hash of:
+- its rows of the input table,
+- its id, since the intensity thresholds of `identify_ncs` depend on it,
+- the source code and the constants of the stages (see `stage_cache.get_dependencies`) and the slope detection parameters.
+
+When data sets are added to the input file, only the new data sets and the data sets whose key changed are processed.
+The stages using all data sets at once (`calculate_free_travel_time`, `calculate_alpha`, `perform_welchs_test`) are then run on the merged table.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from calculate import (calculate_slopes, filter_by_AP, identify_ncs,
+                       init_analyses)
+from constants import (AP_hist_folder, dataset_store_folder,
+                       output_slopes_folder)
+from stage_cache import get_dependencies, hash_value
+from trace_table import TraceTable
+
+
+def get_stages_hash(slope_mode):
+    """
+    Hash the source code and the constants of the per-data-set stages and the parameters changing their results
+    """
+    functions, constants = {}, {}
+    for func in [filter_by_AP, identify_ncs, init_analyses, calculate_slopes, TraceTable]:
+        get_dependencies(func, functions, constants)
+    return hash_value((functions, constants, slope_mode)).hexdigest()
+
+
+def get_dataset_keys(table, stages_hash):
+    """
+    Calculate the key of each data set of a `TraceTable` from its rows and the hash of the stages.
+
+    Return:
+    dictionary {dataset_id: key}
+    """
+    keys = {}
+    for dataset_id, dataset_data in table.datasets():
+        sha = hashlib.sha256(stages_hash.encode())
+        hash_value(int(dataset_id), sha)
+        hash_value(dataset_data.reset_index(drop=True), sha)
+        keys[int(dataset_id)] = sha.hexdigest()
+    return keys
+
+
+def read_store_manifest(folder):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return {int(dataset_id): entry for dataset_id, entry in json.load(file).items()}
+
+
+def write_store_manifest(folder, manifest):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({str(dataset_id): entry for dataset_id, entry in manifest.items()}, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def process_datasets(table, ncs=range(11, 15), save_figures=True, pdf=False, workers=1, slope_mode='fixed',
+                     folder=dataset_store_folder):
+    """
+    Perform AP filtering, nc detection and slope calculation for the new or modified data sets of a `TraceTable` and load the results of the other data sets from the store.
+
+    The parameters are those of `calculate_slopes`.
+    The figures are only saved for the processed data sets. The figures of the other data sets are kept in the output folders.
+
+    Return:
+    analyses    -   the table of results of all data sets of `table`, as returned by `calculate_slopes`
+    processed   -   the list of the processed data set ids
+    """
+    keys = get_dataset_keys(table, get_stages_hash(slope_mode))
+    manifest = read_store_manifest(folder)
+    processed = [dataset_id for dataset_id, key in keys.items()
+                 if dataset_id not in manifest or manifest[dataset_id]['key'] != key
+                 or not os.path.isfile(os.path.join(folder, manifest[dataset_id]['file']))]
+    print(f'Processing {len(processed)} new or modified data sets out of {len(keys)}')
+
+    results = []
+    if processed:
+        new_table = table.filter(np.isin(table.data.dataset_id.values, processed))
+        filtered_table = filter_by_AP(new_table)
+        table_with_ncs, nc_limits = identify_ncs(filtered_table)
+        if save_figures:
+            os.makedirs(AP_hist_folder, exist_ok=True)
+            os.makedirs(output_slopes_folder, exist_ok=True)
+        new_analyses = calculate_slopes(table_with_ncs, init_analyses(new_table, nc_limits, ncs),
+                                        save_figures=save_figures, pdf=pdf, workers=workers, slope_mode=slope_mode)
+
+        # Save the results of each data set separately
+        os.makedirs(folder, exist_ok=True)
+        for dataset_id in processed:
+            dataset_analyses = new_analyses.loc[[dataset_id]]
+            filename = f'dataset_{dataset_id}.pkl'
+            with open(os.path.join(folder, filename + '.tmp'), 'wb') as file:
+                pickle.dump(dataset_analyses, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(os.path.join(folder, filename + '.tmp'), os.path.join(folder, filename))
+            manifest[dataset_id] = {'key': keys[dataset_id], 'file': filename,
+                                    'dataset_name': str(dataset_analyses.dataset_name.iloc[0])}
+        write_store_manifest(folder, manifest)
+        results.append(new_analyses)
+
+    for dataset_id in keys:
+        if dataset_id not in processed:
+            with open(os.path.join(folder, manifest[dataset_id]['file']), 'rb') as file:
+                results.append(pickle.load(file))
+
+    analyses = pd.concat(results).sort_index(level=['dataset_id', 'nc'])
+    return analyses, processed
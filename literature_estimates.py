@@ -6,7 +6,9 @@ This file contains scripts with  parameter estimates from earlier publications:
 import numpy as np
 from scipy.special import gammaln
 
-from BLUE_estimator import BLUE_estimator
+from propagation import propagate
+from support import (BLUE_estimator, alpha_over_k_from_JoK,
+                     alpha_over_k_from_rho)
 
 # % Common constants
 l = 50
@@ -29,27 +31,14 @@ print(J1 / kElong)
 
 
 def alpha_over_k_rho_func(rho, rhoV, l, lV):
-    """Inverse function for alpha/k from J/k"""
-    aoK = rho / (l - rho * (l - 1))
-    partial_rho = aoK**2 * l / rho**2
-    partial_l = - aoK**2 * (1 - rho) / rho
-
-    aoKV = partial_rho**2 * rhoV + partial_l**2 * lV
-
+    """Inverse function for alpha/k from rho"""
+    aoK, aoKV = propagate(alpha_over_k_from_rho, [rho, l], [rhoV, lV])
     return [aoK, aoKV]
 
 
 def alpha_over_k_J_func(JoK, JoKV, l, lV):
     """Inverse function for alpha/k from J/k"""
-    aoK = (1
-           - JoK * (l - 1)
-           - np.sqrt(1 + JoK**2 * (l - 1) **
-                     2 - 2 * JoK * (l + 1))
-           ) / 2
-    partial_l = JoK / 2 * (-1 + (1 + JoK - JoK * l) / np.sqrt(-4 * JoK + (-1 + JoK * (l - 1))**2))
-    partial_JoK = (1 - l + (1 - JoK * (l - 1)**2 + l) /
-                   np.sqrt(-4 * JoK + (-1 + JoK * (l - 1))**2)) / 2
-    aoKV = partial_l**2 * lV + partial_JoK**2 * JoKV
+    aoK, aoKV = propagate(alpha_over_k_from_JoK, [JoK, l], [JoKV, lV])
     return [aoK, aoKV]
 
 
@@ -24,14 +24,19 @@ import pandas as pd
 from tqdm import trange
 
 # from Dataset import detect_timestep
+from cache import load_data
 from calculate import (calculate_alpha, calculate_free_travel_time,
                        calculate_rho_and_J, calculate_slopes, filter_by_AP,
-                       identify_ncs, perform_welchs_test)
+                       identify_ncs, init_analyses, perform_welchs_test)
 from constants import (AP_hist_folder, data_folder, figures_folder,
                        matlab_csv_data_file, output_slopes_folder, s13_hb_bac)
+from dataset_store import process_datasets
 from plot import (plot_j_alpha_curve, plot_normalized_current_density_diagram,
                   plot_parameter_evolution)
+from stage_cache import run_stage
+from streaming import partition_csv, process_partitions
 from support import reinit_folder
+from trace_table import TraceTable
 
 # Do not show figures, just save to files
 matplotlib.use('Agg')
@@ -40,48 +45,66 @@ reinit_folder(figures_folder)
 # Constants
 ncs = range(11, 15)
 
+# The outputs of the analysis stages are saved in the `stage_cache_folder`.
+# A stage is recomputed only if its inputs, its code or the constants it uses changed. Set to False to recompute all stages
+use_stage_cache = True
+
+# How the data sets are processed by AP filtering, nc detection and slope calculation:
+# 'all'         -   all data sets at once, through the stage cache;
+# 'incremental' -   only new or modified data sets. The results of each data set are kept in the `dataset_store_folder`;
+# 'streaming'   -   like 'incremental', but the input file is first split into one partition file per data set and the data sets are loaded one by one. Use it if the input file does not fit into memory
+processing = 'all'
+
 # %% Import
 filepath = os.path.join(data_folder, matlab_csv_data_file)
-data = pd.read_csv(filepath, sep=',', encoding='utf-8')
-print('Loaded columns: ', data.columns.values)
+if processing == 'streaming':
+    # Read the input file in chunks and write the rows of each data set to a separate file
+    partitions = partition_csv(filepath)
+    print('Data sets found: ', list(partitions))
+else:
+    # The mean AP position of each trace is calculated on load and stored in the binary cache
+    # The rows are sorted by data set once, so that each data set is accessed as a slice
+    data = TraceTable(load_data(filepath))
+    print('Loaded columns: ', data.data.columns.values)
 
-# Calculate the mean AP position for each trace
-data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+# %% Process the data sets one by one
+# The next cells until the count of data sets are skipped
+if processing == 'incremental':
+    analyses, _ = process_datasets(data, ncs, save_figures=True, pdf=False, workers=1, slope_mode='fixed')
+elif processing == 'streaming':
+    analyses = process_partitions(partitions, ncs, save_figures=True, pdf=False, slope_mode='fixed')
 
-# Detect the range of data sets and ncs present in the input file
-datasets_len = data.dataset_id.max() + 1
-datasets = set(data.dataset_id)
-genes = set(data.gene)
 
 # %% Perform AP filtering
-filtered_data = filter_by_AP(data)
+if processing == 'all':
+    filtered_data = run_stage(filter_by_AP, [data], use_cache=use_stage_cache)
 
 # %% Detect nuclear cycles
-data_with_ncs, nc_limits = identify_ncs(filtered_data)
-print('Time limits for each data set:\n', nc_limits)
+if processing == 'all':
+    data_with_ncs, nc_limits = run_stage(identify_ncs, [filtered_data], use_cache=use_stage_cache)
+    print('Time limits for each data set:\n', nc_limits)
 
 
 # %% Initialize the data structure to store results
-index = pd.MultiIndex.from_product((datasets, ncs), names=['dataset_id', 'nc'])
-analyses = pd.DataFrame(columns=['dataset_name', 'gene', 'gene_id',
-                                 'construct'], index=index)
-# Copy dataset names, genes and constructs
-for id in datasets:
-    analyses.loc[id, 'gene'] = data[data.dataset_id == id].head(1).gene.values[0]
-    analyses.loc[id, 'gene_id'] = data[data.dataset_id == id].head(1).gene_id.values[0]
-    analyses.loc[id, 'construct'] = data[data.dataset_id == id].head(1).construct.values[0]
-    analyses.loc[id, 'dataset_name'] = data[data.dataset_id == id].head(1).dataset.values[0]
-
-analyses = pd.concat([analyses, nc_limits], axis='columns')
+# Copy dataset names, genes and constructs from the first row of each data set
+if processing == 'all':
+    analyses = init_analyses(data, nc_limits, ncs)
 
 
 # %% Calculate initial slopes and maximum polymerase numbers
-# You can modify the `save_figures` and `pdf` parameters if necessary
+# You can modify the `save_figures` and `pdf` parameters if necessary.
+# Set `workers` to the number of processes to use to process data sets in parallel
+# Set `slope_mode='best'` to fit the slope in the window with the best linear fit instead of the beginning of each nc
+
+# The figures are only saved when the slopes are recomputed
+def detect_slopes(table, analyses):
+    # Clean up the output folder
+    reinit_folder([AP_hist_folder, output_slopes_folder])
+    return calculate_slopes(table, analyses, save_figures=True, pdf=False, workers=1, slope_mode='fixed')
+
 
-# Clean up the output folder
-reinit_folder([AP_hist_folder, output_slopes_folder])
-analyses = calculate_slopes(
-    data_with_ncs, analyses, save_figures=True, pdf=False)
+if processing == 'all':
+    analyses = run_stage(detect_slopes, [data_with_ncs, analyses], use_cache=use_stage_cache)
 
 
 # %% Print the number of available data sets per gene, construct and nc
@@ -94,7 +117,7 @@ print('\nNumber of data sets, all ncs mixed:\n', analyses.copy().reset_index().g
 
 
 # %% Calculate the slope of the current-density diagram, the transit time and the effective length of the gene
-analyses = calculate_free_travel_time(analyses)
+analyses = run_stage(calculate_free_travel_time, [analyses], use_cache=use_stage_cache)
 
 # %% Get calibration coefficient I based on the nc13 measurements from (Zoller, Little, Gregor, 2018). Change `s13_hb_bac` in `constants.py` or `I_est` directly if you want to modify this behavior.
 # Set recalibrate = False if you don't want to recalibrate the trace
@@ -109,12 +132,15 @@ else:
 print('Using the calibration coefficient I=', I_est)
 
 # %% Use the calibration coeffeicient to estimate the polymerase flux, maximal number and alpha
-analyses = calculate_rho_and_J(analyses, I_est)
-analyses = calculate_alpha(analyses)
+# Set `propagation='mc'` to calculate the variances by Monte Carlo sampling instead of the delta method. `calculate_alpha` then also needs `I_est`
+# The random stages are seeded, so that the cached outputs are those a new calculation would give
+analyses = run_stage(calculate_rho_and_J, [analyses, I_est], {'rng': 0}, use_cache=use_stage_cache)
+analyses = run_stage(calculate_alpha, [analyses], {'I_est': I_est, 'rng': 0}, use_cache=use_stage_cache)
 
 
 # %% Perform Welch's test for equal means
-analyses = perform_welchs_test(analyses)
+# Set `test='permutation'` to use permutation tests of the data set values instead, which do not assume normality. Set `workers` to spread the permutations over several processes
+analyses = run_stage(perform_welchs_test, [analyses], {'test': 'welch', 'rng': 0}, use_cache=use_stage_cache)
 
 
 # %% Plot parameter evolution across ncs in different genes and constructs
@@ -0,0 +1,180 @@
+"""
+This file contains the propagation of uncertainties through vectorized expressions with the delta method.
+
+For independent inputs x_i with variances V_i, the variance of f(x) is approximated as
+V = \\sum_i (d f / d x_i)**2 * V_i
+
+The partial derivatives are calculated with the complex-step method:
+d f / d x_i = Im(f(x + i h e_i)) / h
+which is exact to machine precision for analytic expressions, because no difference of close numbers is taken.
+The expression must therefore be written with NumPy functions accepting complex arguments (no `abs`, comparisons or `np.maximum`).
+
+The delta method is a first-order approximation. It fails close to singularities, e.g. the square root in alpha/k(J/k) or tau = 1/alpha.
+`propagate_mc` instead pushes samples of normally distributed inputs through the same expressions.
+"""
+
+import warnings
+
+import numpy as np
+
+complex_step = 1e-20
+
+
+def propagate(func, means, variances):
+    """
+    Calculate the values and the variances of a vectorized expression of independent inputs.
+
+    Parameters:
+    func        -   a function of the inputs, func(*means), returning an array or a tuple of arrays
+    means       -   list of the mean values of the inputs. Floats or arrays broadcastable together, e.g. the columns of `analyses`
+    variances   -   list of the variances of the inputs in the same order. Use 0 for the inputs without uncertainty
+
+    The Jacobian of all rows and all inputs is obtained in a single complex evaluation of `func`.
+    The inputs are stacked along a new first axis, and input i is perturbed only in slice i.
+    The values are calculated in a separate real evaluation, so that invalid operations give nan like in real arithmetics.
+
+    Return:
+    values, variances   -   arrays of the broadcast shape of the inputs, or tuples of arrays if `func` returns a tuple
+    """
+    means = [np.asarray(mean, dtype=float) for mean in means]
+    variances = [np.asarray(variance, dtype=float) for variance in variances]
+    inputs_len = len(means)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = func(*means)
+
+        # Perturb input i in slice i of the stack
+        shape = np.broadcast_shapes(*[mean.shape for mean in means])
+        perturbations = np.eye(inputs_len).reshape((inputs_len, inputs_len) + (1,) * len(shape))
+        stacked = [np.broadcast_to(mean, shape) + 1j * complex_step * perturbations[i]
+                   for i, mean in enumerate(means)]
+        jacobian = func(*stacked)
+
+    def get_variance(value, derivatives):
+        derivatives = np.imag(derivatives) / complex_step
+        # Inputs without uncertainty do not contribute even if the derivative is not finite
+        variance = sum(np.where(variances[i] == 0, 0, derivatives[i]**2 * variances[i])
+                       for i in range(inputs_len))
+        return np.where(np.isnan(value), np.nan, variance)
+
+    if isinstance(values, tuple):
+        return values, tuple(get_variance(value, derivatives)
+                             for value, derivatives in zip(values, jacobian))
+    return values, get_variance(values, jacobian)
+
+
+def sample_quantiles(values, quantiles):
+    """
+    Calculate the quantiles of finite samples along the last axis with the linear interpolation of `np.quantile`.
+
+    Instead of partitioning the samples around all quantile positions at once, the samples are partitioned around one position at a time, starting from the lowest.
+    Each subsequent partition only processes the samples above the previous position, which is about twice faster for large arrays.
+    """
+    values = np.array(values, dtype=float)
+    samples = values.shape[-1]
+    positions = np.asarray(quantiles) * (samples - 1)
+    result = np.empty((len(positions),) + values.shape[:-1])
+
+    start = 0
+    for i in np.argsort(positions):
+        low = int(np.floor(positions[i]))
+        if low >= start:
+            # Partition in place through a view of the remaining samples
+            values[..., start:].partition(low - start, axis=-1)
+            start = low
+        lower = values[..., low]
+        upper = np.min(values[..., low + 1:], axis=-1) if low + 1 < samples else lower
+        result[i] = lower + (positions[i] - low) * (upper - lower)
+    return result
+
+
+def propagate_mc(func, means, variances, samples, quantiles=(0.025, 0.5, 0.975), rng=None, chunk_size=10**7):
+    """
+    Propagate the uncertainties of independent normally distributed inputs through a vectorized expression by Monte Carlo sampling.
+
+    Parameters:
+    func        -   a function of the inputs, func(*means), returning an array or a tuple of arrays
+    means       -   list of the mean values of the inputs. Floats are parameters shared by all rows (e.g. k or l), 1D arrays contain one value per row
+    variances   -   list of the variances of the inputs in the same order
+    samples     -   number of samples per row
+    quantiles   -   the quantiles of the output distributions to calculate
+    rng         -   a `numpy.random.Generator` or a seed
+
+    One set of samples is drawn for each shared parameter and used for all rows, so that the correlations between the rows are kept.
+    The expression is evaluated on arrays of shape (rows, samples).
+    The rows are processed in chunks of about `chunk_size` elements to limit the memory use.
+    Non-finite output samples, e.g. beyond the square-root singularity of alpha/k(J/k), are ignored.
+
+    Return:
+    values, variances, quantiles    -   the mean and the variance of the output samples of each row, and their quantiles of shape (len(quantiles), rows).
+                                        Tuples of arrays if `func` returns a tuple
+    """
+    rng = np.random.default_rng(rng)
+    means = [np.asarray(mean, dtype=float) for mean in means]
+    stds = [np.broadcast_to(np.sqrt(np.asarray(variance, dtype=float)), mean.shape)
+            for mean, variance in zip(means, variances)]
+    rows_len = max([len(mean) for mean in means if mean.ndim > 0], default=1)
+
+    # Shared parameters are sampled once
+    shared_samples = [mean + std * rng.standard_normal(samples) if mean.ndim == 0 else None
+                      for mean, std in zip(means, stds)]
+
+    # Rows with non-finite inputs have no finite output samples and are skipped
+    valid_rows = np.ones(rows_len, dtype=bool)
+    for mean, std in zip(means, stds):
+        if mean.ndim > 0:
+            valid_rows &= np.isfinite(mean) & np.isfinite(std)
+    valid_rows = np.flatnonzero(valid_rows)
+
+    chunk_rows = max(chunk_size // samples, 1)
+    results = None
+    is_tuple = False
+    for start in range(0, len(valid_rows), chunk_rows):
+        rows = valid_rows[start:start + chunk_rows]
+        inputs = []
+        for mean, std, shared in zip(means, stds, shared_samples):
+            if shared is not None:
+                inputs.append(shared[np.newaxis, :])
+            else:
+                inputs.append(mean[rows, np.newaxis]
+                              + std[rows, np.newaxis] * rng.standard_normal((len(rows), samples)))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            outputs = func(*inputs)
+        is_tuple = isinstance(outputs, tuple)
+        if not is_tuple:
+            outputs = (outputs,)
+
+        if results is None:
+            results = [(np.full(rows_len, np.nan), np.full(rows_len, np.nan),
+                        np.full((len(quantiles), rows_len), np.nan)) for _ in outputs]
+
+        for output, (values, output_variances, output_quantiles) in zip(outputs, results):
+            output = np.broadcast_to(output, (len(rows), samples))
+            is_finite = np.isfinite(output)
+            if np.all(is_finite):
+                values[rows] = np.mean(output, axis=1)
+                output_variances[rows] = np.var(output, axis=1, ddof=1)
+                output_quantiles[:, rows] = sample_quantiles(output, quantiles)
+                continue
+
+            # Ignore non-finite samples
+            for i, row in enumerate(rows):
+                finite_samples = output[i, is_finite[i]]
+                if len(finite_samples) > 1:
+                    values[row] = np.mean(finite_samples)
+                    output_variances[row] = np.var(finite_samples, ddof=1)
+                    output_quantiles[:, row] = sample_quantiles(finite_samples, quantiles)
+
+    if results is None:
+        # No valid rows: evaluate the expression at the means to get the number of outputs
+        with np.errstate(invalid='ignore', divide='ignore'):
+            outputs = func(*means)
+        is_tuple = isinstance(outputs, tuple)
+        results = [(np.full(rows_len, np.nan), np.full(rows_len, np.nan),
+                    np.full((len(quantiles), rows_len), np.nan)) for _ in (outputs if is_tuple else (outputs,))]
+
+    values, output_variances, output_quantiles = zip(*results)
+    if is_tuple:
+        return values, output_variances, output_quantiles
+    return values[0], output_variances[0], output_quantiles[0]
@@ -0,0 +1,242 @@
+"""
+This file contains a disk cache for the outputs of the stages of the pipeline in `main.py`.
+
+The output of a stage is stored in a pickle file named after the stage and a key.
+The key is the sha256 hash of:
+- the contents of the inputs of the stage,
+- the source code of the stage function and of all project functions it calls,
+- the values of the module-level constants used by these functions, e.g. `dt_new`, `intensity_thresholds` or `k` from `constants.py`.
+
+A stage is therefore recomputed only if its inputs, its code or the constants it uses change.
+Constants used only for plotting do not invalidate the analysis.
+A `manifest.json` file in the cache folder describes the latest entry of each stage.
+"""
+
+import hashlib
+import inspect
+import json
+import marshal
+import os
+import pickle
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+from constants import stage_cache_folder
+
+stage_cache_version = 1
+project_folder = os.path.dirname(os.path.abspath(__file__))
+
+
+def is_project_object(obj):
+    """
+    Check whether a function or a class is defined in a file of the project folder
+    """
+    try:
+        source_file = inspect.getsourcefile(obj)
+    except TypeError:
+        return False
+    return source_file is not None and os.path.dirname(os.path.abspath(source_file)) == project_folder
+
+
+def hash_value(value, sha=None):
+    """
+    Update a sha256 hash with the contents of a value.
+    Tables, arrays, containers and scalars are supported. Other objects are hashed through their `data` attribute if present (e.g. `TraceTable`), otherwise through their `repr`.
+    """
+    sha = hashlib.sha256() if sha is None else sha
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        sha.update(repr((type(value).__name__, value.shape, list(value.index.names))).encode())
+        if isinstance(value, pd.DataFrame):
+            sha.update(repr([(str(col), str(dtype)) for col, dtype in value.dtypes.items()]).encode())
+        else:
+            sha.update(repr((value.name, str(value.dtype))).encode())
+        # Object columns may mix numbers and strings
+        hashable = value.astype({col: str for col, dtype in value.dtypes.items() if dtype == object}) \
+            if isinstance(value, pd.DataFrame) else (value.astype(str) if value.dtype == object else value)
+        sha.update(pd.util.hash_pandas_object(hashable, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        sha.update(repr((value.dtype.str, value.shape)).encode())
+        sha.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+    elif isinstance(value, dict):
+        sha.update(b'dict')
+        for key in sorted(value, key=repr):
+            hash_value(key, sha)
+            hash_value(value[key], sha)
+    elif isinstance(value, (list, tuple)):
+        sha.update(type(value).__name__.encode())
+        for item in value:
+            hash_value(item, sha)
+    elif hasattr(value, 'data') and isinstance(value.data, pd.DataFrame):
+        sha.update(type(value).__name__.encode())
+        hash_value(value.data, sha)
+    else:
+        sha.update(repr(value).encode())
+    return sha
+
+
+def get_code_objects(code):
+    """
+    Get a code object and the code objects of the functions defined inside it
+    """
+    codes = [code]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            codes += get_code_objects(const)
+    return codes
+
+
+def get_source(func):
+    """
+    Get the source code of a function, or its compiled code if the source is not available, e.g. for functions defined with `exec`
+    """
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return marshal.dumps(func.__code__).hex()
+
+
+def get_dependencies(func, functions=None, constants=None):
+    """
+    Collect the project functions called by `func` and the module-level constants they use.
+
+    The names used in the code of each function are looked up in its module.
+    Project functions and classes are followed recursively. Modules, external functions and builtins are ignored.
+    The values of the other names are the constants, e.g. `dt_new` or `k` imported from `constants.py`.
+
+    Return:
+    functions   -   dictionary {qualified name: source code}
+    constants   -   dictionary {name: value}
+    """
+    functions = {} if functions is None else functions
+    constants = {} if constants is None else constants
+
+    if inspect.isclass(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        if name not in functions:
+            functions[name] = inspect.getsource(func)
+            for _, method in inspect.getmembers(func, inspect.isfunction):
+                if is_project_object(method):
+                    get_dependencies(method, functions, constants)
+        return functions, constants
+
+    func = inspect.unwrap(func)
+    name = f'{func.__module__}.{func.__qualname__}'
+    if name in functions:
+        return functions, constants
+    functions[name] = get_source(func)
+    # Default values are evaluated when the function is defined, e.g. `window_mins=slope_length_mins`
+    constants[name + '.__defaults__'] = (func.__defaults__, func.__kwdefaults__)
+
+    for code in get_code_objects(func.__code__):
+        for global_name in code.co_names:
+            if global_name not in func.__globals__:
+                continue
+            value = func.__globals__[global_name]
+            if inspect.ismodule(value):
+                continue
+            if inspect.isfunction(value) or inspect.isclass(value):
+                if is_project_object(value):
+                    get_dependencies(value, functions, constants)
+                continue
+            if callable(value):
+                continue
+            constants[global_name] = value
+    return functions, constants
+
+
+def get_stage_key(func, args, kwargs):
+    """
+    Calculate the key of a stage from its inputs, its code and the constants it uses.
+
+    Return:
+    key, functions, constants   -   see `get_dependencies` for the last two
+    """
+    functions, constants = get_dependencies(func)
+    # Project classes of the inputs, e.g. `TraceTable`, are used through their methods
+    for value in list(args) + list(kwargs.values()):
+        if is_project_object(type(value)):
+            get_dependencies(type(value), functions, constants)
+
+    sha = hashlib.sha256()
+    hash_value((stage_cache_version, func.__module__, func.__qualname__), sha)
+    hash_value(functions, sha)
+    hash_value(constants, sha)
+    hash_value(list(args), sha)
+    hash_value(kwargs, sha)
+    return sha.hexdigest(), functions, constants
+
+
+def read_manifest(folder):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_manifest(folder, manifest):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def run_stage(func, args=(), kwargs=None, name=None, use_cache=True, folder=stage_cache_folder):
+    """
+    Calculate func(*args, **kwargs), or load the result from the stage cache if the key of the stage has not changed (see `get_stage_key`).
+
+    Parameters:
+    name        -   the name of the stage in the cache. The name of the function by default
+    use_cache   -   if False, the stage is always recomputed and the cache is not modified
+
+    Only the latest entry of each stage is kept. Side effects of the stage, e.g. saved figures, are not reproduced when the result is loaded from the cache.
+    Random stages must be given a fixed seed in their arguments, e.g. `rng=0`, so that the key determines the result.
+    """
+    kwargs = {} if kwargs is None else kwargs
+    if not use_cache:
+        return func(*args, **kwargs)
+
+    name = func.__name__ if name is None else name
+    key, functions, constants = get_stage_key(func, args, kwargs)
+    filename = f'{name}-{key[:16]}.pkl'
+    filepath = os.path.join(folder, filename)
+
+    manifest = read_manifest(folder)
+    entry = manifest.get(name)
+    if entry is not None and entry['key'] == key and os.path.isfile(filepath):
+        with open(filepath, 'rb') as file:
+            result = pickle.load(file)
+        print(f'Loaded `{name}` from the stage cache')
+        return result
+
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - start
+
+    os.makedirs(folder, exist_ok=True)
+    # Write to a temporary file first so that an interrupted write does not leave a broken entry
+    with open(filepath + '.tmp', 'wb') as file:
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filepath + '.tmp', filepath)
+
+    # Replace the previous entry of the stage
+    manifest = read_manifest(folder)
+    previous = manifest.get(name)
+    if previous is not None and previous['file'] != filename:
+        previous_path = os.path.join(folder, previous['file'])
+        if os.path.isfile(previous_path):
+            os.remove(previous_path)
+    manifest[name] = {
+        'key': key,
+        'file': filename,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_s': round(duration, 3),
+        'functions': sorted(functions),
+        'constants': {const: repr(value) for const, value in constants.items() if '.__defaults__' not in const},
+    }
+    write_manifest(folder, manifest)
+    return result
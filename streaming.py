@@ -0,0 +1,91 @@
+"""
+This file contains the streaming ingestion of the input `.csv` file for inputs too large to be loaded into memory at once.
+
+The file is read in chunks of rows, and the rows of each data set are appended to a separate partition file on disk.
+The data sets are then loaded and processed one by one by the per-data-set stages (see `dataset_store.process_datasets`), so that the peak memory use is set by the largest data set rather than by the whole input.
+The partitions are rebuilt when the modification time or the contents hash of the input file change.
+"""
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from cache import hash_file, load_data
+from constants import dataset_store_folder
+from dataset_store import process_datasets
+from trace_table import TraceTable
+
+partitions_version = 1
+
+
+def get_partitions_folder(filepath):
+    return filepath + '.partitions'
+
+
+def partition_csv(filepath, chunksize=10**6, folder=None):
+    """
+    Split the rows of the input `.csv` file into one `.csv` file per data set.
+
+    The input is read in chunks of `chunksize` rows, so only one chunk is held in memory.
+    The partitions are reused if they were built from the current version of the input file.
+
+    Return:
+    dictionary {dataset_id: partition file path}
+    """
+    folder = get_partitions_folder(filepath) if folder is None else folder
+    manifest_path = os.path.join(folder, 'manifest.json')
+    mtime = os.path.getmtime(filepath)
+    source_hash = hash_file(filepath)
+
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+        if (manifest['version'] == partitions_version and manifest['source_mtime'] == mtime
+                and manifest['source_hash'] == source_hash):
+            return {int(dataset_id): os.path.join(folder, filename)
+                    for dataset_id, filename in manifest['partitions'].items()}
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    partitions = {}
+    for chunk in pd.read_csv(filepath, sep=',', encoding='utf-8', chunksize=chunksize):
+        for dataset_id, dataset_rows in chunk.groupby('dataset_id', sort=False):
+            dataset_id = int(dataset_id)
+            is_new = dataset_id not in partitions
+            if is_new:
+                partitions[dataset_id] = f'dataset_{dataset_id}.csv'
+            dataset_rows.to_csv(os.path.join(folder, partitions[dataset_id]), mode='w' if is_new else 'a',
+                                header=is_new, index=False, encoding='utf-8')
+
+    # The manifest is written last, so that interrupted partitioning is started again
+    manifest = {'version': partitions_version, 'source_mtime': mtime, 'source_hash': source_hash,
+                'partitions': {str(dataset_id): filename for dataset_id, filename in sorted(partitions.items())}}
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    return {dataset_id: os.path.join(folder, filename) for dataset_id, filename in sorted(partitions.items())}
+
+
+def process_partitions(partitions, ncs=range(11, 15), save_figures=True, pdf=False, slope_mode='fixed',
+                       folder=dataset_store_folder):
+    """
+    Perform AP filtering, nc detection and slope calculation data set by data set from the partitions of `partition_csv`.
+
+    Each partition is loaded through the binary cache (see `load_data`) and processed by `dataset_store.process_datasets`, so unchanged data sets are not processed again.
+    The parameters are those of `process_datasets`.
+    Only one data set is held in memory at a time.
+
+    Return:
+    the table of results of all data sets, as returned by `calculate_slopes`
+    """
+    results = []
+    for dataset_id, partition_path in sorted(partitions.items()):
+        table = TraceTable(load_data(partition_path))
+        dataset_analyses, _ = process_datasets(table, ncs, save_figures=save_figures, pdf=pdf, slope_mode=slope_mode,
+                                               folder=folder)
+        results.append(dataset_analyses)
+        del table
+    return pd.concat(results)
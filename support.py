@@ -4,15 +4,20 @@ This file contains general statistical or non-statistical procedures not dependi
 
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy.linalg import inv
 from scipy import optimize as opt
+from scipy.special import gammaln
+from scipy.stats import beta
+from scipy.stats import t as student
 from tqdm import trange
 
-from constants import k, kV, l, lV, tau_rev, tau_revV
+from constants import k, kV, l, lV, n_pi, tau_rev, tau_revV
+from propagation import propagate
 
 
 def reinit_folder(folders):
@@ -42,7 +47,44 @@ This file contains data estimation and statistical calculation functions specifi
 """
 
 
-def bayesian_linear_fit(x, y, Vx, Vy, c=True, prior=None):
+def get_linear_fit_guess(x, y, Vx, Vy, weights, c=True):
+    """
+    Calculate the initial guess of the Bayesian linear fits of the problems stacked along the first axis of the arrays.
+
+    The slope and the intersect are given by the ordinary least squares.
+    The scatter sigmaV is estimated from the residual variance not explained by the variances of the points.
+    It is kept strictly positive, because the derivatives of -ln(posterior) with respect to sigmaV vanish at sigmaV = 0,
+    so that a minimization started there would not leave sigmaV = 0 even if it is a saddle point.
+
+    Return:
+    m, c, sigmaV    -   arrays of shape (problems,)
+    """
+    points_len = np.maximum(np.sum(weights, axis=1), 1)
+
+    def mean(values):
+        return np.sum(weights * values, axis=1) / points_len
+
+    if c:
+        x_mean, y_mean = mean(x), mean(y)
+        x_var = mean((x - x_mean[:, np.newaxis])**2)
+        xy_cov = mean((x - x_mean[:, np.newaxis]) * (y - y_mean[:, np.newaxis]))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = np.where(x_var > 0, xy_cov / x_var, 1)
+        c_guess = y_mean - m * x_mean
+    else:
+        x2_mean = mean(x**2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = np.where(x2_mean > 0, mean(x * y) / x2_mean, 1)
+        c_guess = np.zeros_like(m)
+
+    residual_V = mean((y - m[:, np.newaxis] * x - c_guess[:, np.newaxis])**2)
+    points_V = mean(Vy + m[:, np.newaxis]**2 * Vx)
+    eps = 1e-2 * np.maximum(points_V, np.finfo(float).tiny)
+    sigmaV = np.sqrt(np.maximum(residual_V - points_V, eps))
+    return m, c_guess, sigmaV
+
+
+def bayesian_linear_fit(x, y, Vx, Vy, c=True, prior=None, analytic_derivatives=True):
     """
     Perform a Bayesian linear fit for a heteroscedastic set of points with uncertainties along both axes.
     See the accompanying article and D'Agostini2005 for further details of the method.
@@ -54,6 +96,9 @@ def bayesian_linear_fit(x, y, Vx, Vy, c=True, prior=None):
     By default, we use a flat prior for sigmaV and intersect, and a uniform angle prior for the slope.
     A custom prior function can be supplied as a parameter
 
+    By default, the minimization uses the analytic gradient of -ln(posterior), and the variances of the estimates are calculated from its exact Hessian.
+    Set `analytic_derivatives` = False to use finite differences and the BFGS approximation of the inverse Hessian instead.
+
     Parameters:
     x, y    -   float, array-like, lists of coordinates of 2D data points
     Vx, Vy  -   float, array-like, the corresponding of each data point
@@ -66,31 +111,49 @@ def bayesian_linear_fit(x, y, Vx, Vy, c=True, prior=None):
     sigmaV, sigmaVV - equation scatter and the variance of its estimator
     """
 
-    sigmaV_guess = 0
-    m_guess = 1
     plot = False
 
+    phi, gradient, hessian = posterior(x, y, Vx, Vy, c=c, prior=prior, derivatives=True)
+
+    # Start from the least squares fit and the residual scatter (see `get_linear_fit_guess`)
+    not_nan = ~np.isnan(x * y)
+    m_guess, c_guess, sigmaV_guess = [guess[0] for guess in get_linear_fit_guess(
+        *[np.atleast_2d(np.asarray(ar, dtype=float)[not_nan]) for ar in [x, y, Vx, Vy]],
+        weights=np.ones((1, np.sum(not_nan))), c=c)]
     if c:
         # If not passing through the origin
-        phi = posterior(x, y, Vx, Vy, c=True, prior=prior)
-        guess = (m_guess, 0, sigmaV_guess)
-        min = opt.minimize(phi, guess)
-        m_est, c_est, sigmaV_est = min.x
-
-        # Calculate the uncertainty on the estimates by calculating the Hessian inverse
-        mV_est, cV_est, sigmaVV_est = min.hess_inv.diagonal()
-
+        guess = (m_guess, c_guess, sigmaV_guess)
     else:
         # If passing through the origin
-        phi = posterior(x, y, Vx, Vy, c=False, prior=prior)
         guess = (m_guess, sigmaV_guess)
+
+    if analytic_derivatives:
+        min = opt.minimize(phi, guess, jac=gradient)
+
+        # Calculate the uncertainty on the estimates from the inverse of the exact Hessian.
+        # Fall back to the BFGS approximation if the Hessian is singular
+        try:
+            estimates_V = inv(hessian(min.x)).diagonal()
+        except np.linalg.LinAlgError:
+            estimates_V = min.hess_inv.diagonal()
+    else:
         min = opt.minimize(phi, guess)
+        # Calculate the uncertainty on the estimates by calculating the Hessian inverse
+        estimates_V = min.hess_inv.diagonal()
+
+    if c:
+        m_est, c_est, sigmaV_est = min.x
+        mV_est, cV_est, sigmaVV_est = estimates_V
+    else:
         m_est, sigmaV_est = min.x
-        mV_est, sigmaVV_est = min.hess_inv.diagonal()
+        mV_est, sigmaVV_est = estimates_V
 
         c_est = 0
         cV_est = 0
 
+    # -ln(posterior) is even in sigmaV
+    sigmaV_est = np.abs(sigmaV_est)
+
     if plot:
         plt.figure(clear=True, num=1)
         plt.errorbar(x, y, xerr=np.sqrt(Vx), yerr=np.sqrt(Vy), fmt='.', elinewidth=0.5)
@@ -108,20 +171,25 @@ def bayesian_linear_fit(x, y, Vx, Vy, c=True, prior=None):
     return estimates
 
 
-def posterior(x, y, Vx, Vy, c=True, prior=None):
+def posterior(x, y, Vx, Vy, c=True, prior=None, derivatives=False):
     """
     Returns phi = -ln(posterior), non-normalized as a function of the control parameters (m, c, Vv)
     By default, we use a flat prior for sigmaV and intersect, and a uniform angle prior for the slope.
 
     posterior = p(m, c, sigmaV | x, y, Vx, Vy)
+
+    If `derivatives` is True, also returns the functions calculating the gradient and the Hessian of phi.
+    The derivatives of the likelihood are analytic.
+    The derivatives of a custom prior are calculated with finite differences, since the prior does not depend on the data.
     """
 
     # Drop nans
-    inds_not_nan = list(set(np.flatnonzero(~np.isnan(x * y))))
-    x, y, Vx, Vy = [ar[inds_not_nan] for ar in [x, y, Vx, Vy]]
+    not_nan = ~np.isnan(x * y)
+    x, y, Vx, Vy = [np.asarray(ar)[not_nan] for ar in [x, y, Vx, Vy]]
 
     # Default prior
-    if not prior:
+    default_prior = not prior
+    if default_prior:
         if c:
             def prior(m, c, sigmaV):
                 return 1 / np.pi / (m**2 + 1)
@@ -144,10 +212,250 @@ def posterior(x, y, Vx, Vy, c=True, prior=None):
         phi = -ln_likelihood(m, 0, sigmaV) - np.log(prior(m, sigmaV))
         return phi
 
+    if not derivatives:
+        if c:
+            return phi
+        else:
+            return phi_no_c
+
+    def ln_likelihood_derivatives(m, c, sigmaV):
+        """
+        Gradient and Hessian of -ln_likelihood with respect to (m, c, sigmaV).
+        Each term is f(D, r) = ln(D) / 2 + r**2 / 2 / D with D = sigmaV**2 + Vy + m**2 * Vx and r = y - m * x - c
+        """
+        D = sigmaV**2 + Vy + m**2 * Vx
+        r = y - m * x - c
+
+        # Partial derivatives of f
+        f_D = 1 / 2 / D - r**2 / 2 / D**2
+        f_r = r / D
+        f_DD = -1 / 2 / D**2 + r**2 / D**3
+        f_rr = 1 / D
+        f_rD = -r / D**2
+
+        # Derivatives of D and r with respect to (m, c, sigmaV)
+        zeros = np.zeros_like(x)
+        D_p = np.array([2 * m * Vx, zeros, 2 * sigmaV + zeros])
+        r_p = np.array([-x, zeros - 1, zeros])
+        D_pp = np.zeros((3, 3, len(x)))
+        D_pp[0, 0] = 2 * Vx
+        D_pp[2, 2] = 2
+
+        gradient = np.sum(f_D * D_p + f_r * r_p, axis=1)
+        hessian = np.sum(f_DD * D_p[:, np.newaxis] * D_p[np.newaxis, :]
+                         + f_rD * (D_p[:, np.newaxis] * r_p[np.newaxis, :]
+                                   + r_p[:, np.newaxis] * D_p[np.newaxis, :])
+                         + f_rr * r_p[:, np.newaxis] * r_p[np.newaxis, :]
+                         + f_D * D_pp, axis=2)
+        return gradient, hessian
+
+    def ln_prior_derivatives(params):
+        """
+        Gradient and Hessian of -ln(prior) with respect to the parameters of phi
+        """
+        params = np.asarray(params, dtype=float)
+        params_len = len(params)
+        if default_prior:
+            # -ln(prior) = ln(pi) + ln(m**2 + 1)
+            m = params[0]
+            gradient = np.zeros(params_len)
+            hessian = np.zeros((params_len, params_len))
+            gradient[0] = 2 * m / (m**2 + 1)
+            hessian[0, 0] = 2 * (1 - m**2) / (m**2 + 1)**2
+            return gradient, hessian
+
+        def ln_prior(params):
+            return -np.log(prior(*params))
+        return numerical_gradient_and_hessian(ln_prior, params)
+
     if c:
-        return phi
+        def gradient(params):
+            gradient, _ = ln_likelihood_derivatives(*params)
+            return gradient + ln_prior_derivatives(params)[0]
+
+        def hessian(params):
+            _, hessian = ln_likelihood_derivatives(*params)
+            return hessian + ln_prior_derivatives(params)[1]
+
+        return phi, gradient, hessian
     else:
-        return phi_no_c
+        # Drop the derivatives with respect to c
+        inds = [0, 2]
+
+        def gradient_no_c(params):
+            m, sigmaV = params
+            gradient, _ = ln_likelihood_derivatives(m, 0, sigmaV)
+            return gradient[inds] + ln_prior_derivatives(params)[0]
+
+        def hessian_no_c(params):
+            m, sigmaV = params
+            _, hessian = ln_likelihood_derivatives(m, 0, sigmaV)
+            return hessian[np.ix_(inds, inds)] + ln_prior_derivatives(params)[1]
+
+        return phi_no_c, gradient_no_c, hessian_no_c
+
+
+def numerical_gradient_and_hessian(func, params, step=1e-5):
+    """
+    Calculate the gradient and the Hessian of a scalar function with central finite differences.
+
+    `params` may have the shape (..., k), in which case `func` must be vectorized over the leading axes.
+    The gradient then has the shape (..., k) and the Hessian (..., k, k).
+    """
+    params = np.asarray(params, dtype=float)
+    params_len = params.shape[-1]
+    steps = step * np.maximum(1, np.abs(params))
+
+    def shift(i):
+        return np.eye(params_len)[i] * steps[..., i:i + 1]
+
+    gradient = np.stack([(func(params + shift(i)) - func(params - shift(i))) / 2 / steps[..., i]
+                         for i in range(params_len)], axis=-1)
+
+    hessian = np.zeros(params.shape + (params_len,))
+    for i in range(params_len):
+        for j in range(i, params_len):
+            hessian[..., i, j] = hessian[..., j, i] = (
+                func(params + shift(i) + shift(j)) - func(params + shift(i) - shift(j))
+                - func(params - shift(i) + shift(j)) + func(params - shift(i) - shift(j))
+            ) / 4 / steps[..., i] / steps[..., j]
+    return gradient, hessian
+
+
+def bayesian_linear_fit_batch(x, y, Vx, Vy, mask=None, c=True, prior=None, max_iter=100, tol=1e-9):
+    """
+    Perform many independent Bayesian linear fits (see `bayesian_linear_fit`) at once.
+
+    The problems are stacked along the first axis of the arrays of shape (problems, points).
+    Problems with fewer points are padded, and the padding is excluded by setting `mask` to False.
+    Points with nan coordinates or variances are also excluded.
+
+    All problems are minimized jointly by a damped Newton method with a backtracking line search.
+    The objective, its gradient and its Hessian are evaluated for all problems in a vectorized way.
+    The variances of the estimates are calculated from the inverse of the exact Hessian.
+
+    A custom prior must be vectorized: prior(m, sigmaV) or prior(m, c, sigmaV) receive arrays of shape (problems,).
+    Its derivatives are calculated with finite differences.
+
+    Return:
+    A numpy record array of shape (problems,) with the fields m, mV, c, cV, sigmaV, sigmaVV
+    """
+    x, y, Vx, Vy = [np.atleast_2d(np.asarray(ar, dtype=float)) for ar in [x, y, Vx, Vy]]
+    if mask is None:
+        mask = np.ones(x.shape, dtype=bool)
+    mask = np.asarray(mask, dtype=bool) & ~np.isnan(x * y * Vx * Vy)
+
+    # Replace the excluded points by neutral values
+    x, y, Vx = [np.where(mask, ar, 0) for ar in [x, y, Vx]]
+    Vy = np.where(mask, Vy, 1)
+    weights = mask.astype(float)
+
+    problems_len = x.shape[0]
+    # Parameters are (m, c, sigmaV). The intersect is fixed to 0 if c is False
+    inds = [0, 1, 2] if c else [0, 2]
+
+    def to_full(params):
+        if c:
+            return params
+        return np.stack([params[:, 0], np.zeros(problems_len), params[:, 1]], axis=1)
+
+    def ln_prior(params):
+        if not prior:
+            return np.log(np.pi) + np.log(params[..., 0]**2 + 1)
+        return -np.log(prior(*np.moveaxis(params, -1, 0)))
+
+    def ln_prior_derivatives(params):
+        if not prior:
+            m = params[:, 0]
+            gradient = np.zeros(params.shape)
+            hessian = np.zeros(params.shape + (params.shape[1],))
+            gradient[:, 0] = 2 * m / (m**2 + 1)
+            hessian[:, 0, 0] = 2 * (1 - m**2) / (m**2 + 1)**2
+            return gradient, hessian
+        return numerical_gradient_and_hessian(ln_prior, params)
+
+    def phi(params):
+        m, c, sigmaV = to_full(params).T[:, :, np.newaxis]
+        D = sigmaV**2 + Vy + m**2 * Vx
+        phi = np.sum(weights * (np.log(D) / 2 + (y - m * x - c)**2 / 2 / D), axis=1)
+        return phi + ln_prior(params)
+
+    def derivatives(params):
+        m, c, sigmaV = to_full(params).T[:, :, np.newaxis]
+        D = sigmaV**2 + Vy + m**2 * Vx
+        r = y - m * x - c
+
+        # See `posterior` for the notations
+        f_D = weights * (1 / 2 / D - r**2 / 2 / D**2)
+        f_r = weights * r / D
+        f_DD = weights * (-1 / 2 / D**2 + r**2 / D**3)
+        f_rr = weights / D
+        f_rD = -weights * r / D**2
+
+        zeros = np.zeros_like(x)
+        D_p = np.array([2 * m * Vx, zeros, 2 * sigmaV + zeros])[inds]
+        r_p = np.array([-x, zeros - 1, zeros])[inds]
+        D_pp = np.zeros((3, 3) + x.shape)
+        D_pp[0, 0] = 2 * Vx
+        D_pp[2, 2] = 2
+        D_pp = D_pp[np.ix_(inds, inds)]
+
+        gradient = np.sum(f_D * D_p + f_r * r_p, axis=2).T
+        hessian = np.sum(f_DD * D_p[:, np.newaxis] * D_p[np.newaxis, :]
+                         + f_rD * (D_p[:, np.newaxis] * r_p[np.newaxis, :]
+                                   + r_p[:, np.newaxis] * D_p[np.newaxis, :])
+                         + f_rr * r_p[:, np.newaxis] * r_p[np.newaxis, :]
+                         + f_D * D_pp, axis=3).transpose(2, 0, 1)
+
+        prior_gradient, prior_hessian = ln_prior_derivatives(params)
+        return gradient + prior_gradient, hessian + prior_hessian
+
+    # Start from the least squares fit and the residual scatter
+    m_guess, c_guess, sigmaV_guess = get_linear_fit_guess(x, y, Vx, Vy, weights, c=c)
+    params = np.stack([m_guess, c_guess, sigmaV_guess], axis=1)[:, inds]
+
+    active = np.ones(problems_len, dtype=bool)
+    for iteration in range(max_iter):
+        gradient, hessian = derivatives(params)
+        gradient[~active] = 0
+
+        # Make the Hessian positive definite by taking the absolute values of its eigenvalues
+        eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+        eigenvalues = np.maximum(np.abs(eigenvalues), 1e-12)
+        step = -np.einsum('pij,pj,pkj,pk->pi', eigenvectors, 1 / eigenvalues, eigenvectors, gradient)
+
+        # Backtracking line search, individually for each problem
+        phi_current = phi(params)
+        active &= np.isfinite(phi_current)
+        step_size = np.ones(problems_len)
+        for _ in range(50):
+            phi_new = phi(params + step_size[:, np.newaxis] * step)
+            decreased = phi_new <= phi_current + 1e-4 * step_size * np.sum(gradient * step, axis=1)
+            if np.all(decreased | ~active):
+                break
+            step_size[~decreased] /= 2
+        params = params + step_size[:, np.newaxis] * step
+
+        converged = np.max(np.abs(step_size[:, np.newaxis] * step), axis=1) < tol * (1 + np.max(np.abs(params), axis=1))
+        active &= ~converged
+        if not np.any(active):
+            break
+
+    # Calculate the uncertainty on the estimates from the inverse of the exact Hessian
+    _, hessian = derivatives(params)
+    variances = np.full(params.shape, np.nan)
+    invertible = np.linalg.det(hessian) != 0
+    variances[invertible] = np.diagonal(inv(hessian[invertible]), axis1=1, axis2=2)
+
+    estimates = np.zeros(problems_len, dtype=[(name, float) for name in
+                                              ['m', 'mV', 'c', 'cV', 'sigmaV', 'sigmaVV']])
+    estimates['m'], estimates['mV'] = params[:, 0], variances[:, 0]
+    # -ln(posterior) is even in sigmaV
+    estimates['sigmaV'], estimates['sigmaVV'] = np.abs(params[:, -1]), variances[:, -1]
+    if c:
+        estimates['c'], estimates['cV'] = params[:, 1], variances[:, 1]
+
+    return estimates.view(np.recarray)
 
 
 def BLUE_estimator(x1, x1V, x2, x2V, cov=0):
@@ -184,7 +492,29 @@ def BLUE_estimator(x1, x1V, x2, x2V, cov=0):
     return mixed_estimator[0, 0], mixedV, weights[0, 0]
 
 
-def mixed_estimator_2(T1, T2, verbose=False):
+def bootstrap_median_covariance(Ts, B, rng=None):
+    """
+    Estimate the covariance matrix of the medians of several series of the same length with bootstrap (with replacement).
+    Each series is resampled independently.
+
+    All B resamplings of all series are drawn at once as an index array of shape (len(Ts), B, n), and the medians are taken along the last axis.
+    The deviations are calculated with respect to the medians of the original series.
+
+    `rng` may be a `numpy.random.Generator`, a seed or None.
+    """
+    rng = np.random.default_rng(rng)
+    Ts = np.asarray(Ts, dtype=float)
+    series_len, n = Ts.shape
+
+    inds = rng.integers(0, n, size=(series_len, B, n))
+    sample_medians = np.median(np.take_along_axis(Ts[:, np.newaxis, :], inds, axis=2), axis=2)
+
+    deviations = sample_medians - np.median(Ts, axis=1)[:, np.newaxis]
+    sigma = deviations @ deviations.T / B
+    return sigma
+
+
+def mixed_estimator_2(T1, T2, verbose=False, rng=None):
     """
     Based on the Lavancier and Rochet (2016) article.
 
@@ -192,6 +522,8 @@ def mixed_estimator_2(T1, T2, verbose=False):
 
     The main result corresponds to Eq. (11) from the article.
     Its variance is the equation after Eq. (9). [equation not checked]
+
+    `rng` is a `numpy.random.Generator` or a seed used for the bootstrap.
     """
 
     B = 1000  # bootstrap repetitions
@@ -214,18 +546,7 @@ def mixed_estimator_2(T1, T2, verbose=False):
     T2_data_median = np.median(T2)
 
     # Estimate the covariance sigma matrix with bootstrap (with replacement, as described in the article)
-    sigma = np.zeros((2, 2))
-    for b in range(B):
-        T1_sample = np.random.choice(T1, size=n, replace=True)
-        T2_sample = np.random.choice(T2, size=n, replace=True)
-        # print('T1', T1_sample)
-        T1_sample_median = np.median(T1_sample)
-        T2_sample_median = np.median(T2_sample)
-        sigma += np.array([[(T1_sample_median - T1_data_median)**2,
-                            (T1_sample_median - T1_data_median) * (T2_sample_median - T2_data_median)],
-                           [(T1_sample_median - T1_data_median) * (T2_sample_median - T2_data_median),
-                            (T2_sample_median - T2_data_median)**2]])
-    sigma /= B
+    sigma = bootstrap_median_covariance([T1, T2], B=B, rng=rng)
 
     # print(n, sigma)
 
@@ -243,7 +564,7 @@ def mixed_estimator_2(T1, T2, verbose=False):
     return mixed_estimator, mixedV, np.squeeze(weights)
 
 
-def mixed_estimator_4(T1, T2, T3=None, T4=None, verbose=False):
+def mixed_estimator_4(T1, T2, T3=None, T4=None, verbose=False, rng=None):
     """
     Based on the Lavancier and Rochet (2016) article.
 
@@ -251,30 +572,23 @@ def mixed_estimator_4(T1, T2, T3=None, T4=None, verbose=False):
 
     The main result corresponds to Eq. (11) from the article.
     Its variance is the equation after Eq. (9). [equation not checked]
+
+    `rng` is a `numpy.random.Generator` or a seed used for the bootstrap.
     """
 
     B = 1000  # bootstrap repetitions
 
     # Drop nans
-    Ts = [T1, T2, T3, T4]
-    not_nans = np.isnan(T1)
-    for t in [T2, T3, T4]:
-        not_nans = np.logical_or(not_nans, np.isnan(t))
+    Ts = np.array([T1, T2, T3, T4], dtype=float)
+    Ts = Ts[:, ~np.any(np.isnan(Ts), axis=0)]
 
-    for t in [T1, T2, T3, T4]:
-        t = t[~not_nans]    # will work because they are aliases, not copies
-
-    n = len(T1)
+    n = Ts.shape[1]
 
     # Calculate the estimators for the data set. This is the input data for the rest
-    T_data_medians = np.full((4, 1), np.nan)
-    for i, t in enumerate(Ts):
-        T_data_medians[i] = np.median(t)
+    T_data_medians = np.median(Ts, axis=1)[:, np.newaxis] if n else np.full((4, 1), np.nan)
 
     I = np.ones((4, 1))
-    T = T_data_medians  # np.array([[T1_data_median, T2_data_median]]).T
-    # not_nans = np.logical_or(np.isnan(T1), np.isnan(T2))
-    # T1, T2 = T1[~not_nans], T2[~not_nans]
+    T = T_data_medians
 
     # Return nan if no samples
     # If one sample, return simple average with no variance
@@ -285,27 +599,7 @@ def mixed_estimator_4(T1, T2, T3=None, T4=None, verbose=False):
         return weights @ T, np.nan, weights
 
     # Estimate the covariance sigma matrix with bootstrap (with replacement, as described in the article)
-    sigma = np.zeros((4, 4))
-    T_sample_medians = np.full((4, 1), np.nan)
-    for b in range(B):
-        for i, t in enumerate(Ts):
-            # T_sample[i] = np.random.choice(t, size=n, replace=True)
-            T_sample_medians[i] = np.median(np.random.choice(t, size=n, replace=True))
-
-        # T1_sample = np.random.choice(T1, size=n, replace=True)
-        # T2_sample = np.random.choice(T2, size=n, replace=True)
-        # print('T1', T1_sample)
-        # T1_sample_median = np.median(T1_sample)
-        # T2_sample_median = np.median(T2_sample)
-
-        # столбец на строку
-        sigma += (T_sample_medians - T_data_medians) @ (T_sample_medians - T_data_medians).T
-
-        # sigma += np.array([[(T1_sample_median - T1_data_median)**2,
-        #                     (T1_sample_median - T1_data_median) * (T2_sample_median - T2_data_median)],
-        #                    [(T1_sample_median - T1_data_median) * (T2_sample_median - T2_data_median),
-        #                     (T2_sample_median - T2_data_median)**2]])
-    sigma /= B
+    sigma = bootstrap_median_covariance(Ts, B=B, rng=rng)
 
     # print(n, sigma)
 
@@ -322,21 +616,158 @@ def mixed_estimator_4(T1, T2, T3=None, T4=None, verbose=False):
     return mixed_estimator, mixedV, np.squeeze(weights)
 
 
+def grouped_median(values, group_sizes):
+    """
+    Calculate the medians of groups of different sizes along the last axis of `values`.
+    The elements of each group must be placed at the beginning of the last axis, the remaining (padding) elements are ignored.
+
+    `group_sizes` must be broadcastable to `values.shape[:-1]`.
+    Groups of size 0 get a nan median.
+    """
+    group_sizes = np.broadcast_to(group_sizes, values.shape[:-1])
+    is_padding = np.arange(values.shape[-1]) >= group_sizes[..., np.newaxis]
+
+    # Padding elements are sorted to the end of the axis
+    sorted_values = np.sort(np.where(is_padding, np.inf, values), axis=-1)
+
+    low = np.maximum((group_sizes - 1) // 2, 0)[..., np.newaxis]
+    high = np.maximum(group_sizes // 2, 0)[..., np.newaxis]
+    medians = (np.take_along_axis(sorted_values, low, axis=-1)
+               + np.take_along_axis(sorted_values, high, axis=-1))[..., 0] / 2
+    medians[group_sizes == 0] = np.nan
+    return medians
+
+
+def grouped_linear_fit(x, y, group_ind, groups_len, min_points=3):
+    """
+    Fit y = slope * x + intercept by least squares independently in many groups of points at once.
+    Point i belongs to group `group_ind[i]`. The groups may correspond, for example, to (data set, nc) windows or to individual traces.
+
+    The fits are obtained in closed form from the grouped sums of x, y, x**2, x*y and y**2 calculated with `np.bincount`.
+    The sums are calculated over the deviations from the group means to avoid the loss of precision of the raw sums.
+    The slope variance is scaled by the residuals like in `np.polyfit(..., cov=True)`:
+    slopeV = sum(residuals**2) / (n - 2) / sum((x - mean(x))**2)
+
+    Groups with less than `min_points` points get nan results.
+    Nan values are not dropped and propagate to the results of their group.
+
+    Return:
+    slope, intercept, slopeV, count     -   arrays of length `groups_len`
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    group_ind = np.asarray(group_ind)
+
+    count = np.bincount(group_ind, minlength=groups_len)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.bincount(group_ind, weights=x, minlength=groups_len) / count
+        y_mean = np.bincount(group_ind, weights=y, minlength=groups_len) / count
+        dx = x - x_mean[group_ind]
+        dy = y - y_mean[group_ind]
+        Sxx = np.bincount(group_ind, weights=dx**2, minlength=groups_len)
+        Sxy = np.bincount(group_ind, weights=dx * dy, minlength=groups_len)
+        Syy = np.bincount(group_ind, weights=dy**2, minlength=groups_len)
+
+        slope = Sxy / Sxx
+        intercept = y_mean - slope * x_mean
+        residuals = np.maximum(Syy - slope * Sxy, 0)
+        slopeV = residuals / (count - 2) / Sxx
+
+    for values in [slope, intercept, slopeV]:
+        values[count < min_points] = np.nan
+    return slope, intercept, slopeV, count
+
+
+def mixed_estimator_grouped(Ts, offsets, rng=None, B=1000):
+    """
+    Calculate the mixed estimators of Lavancier and Rochet (2016) (see `mixed_estimator_2`) for many groups at once.
+
+    The series of all groups are concatenated along the last axis of `Ts` of shape (series, rows).
+    The rows of group g are `Ts[:, offsets[g]:offsets[g + 1]]` (CSR-style offsets).
+    Rows with a nan in any of the series are dropped.
+
+    The bootstrap of all groups is performed in one vectorized pass by padding each group to the size of the largest group.
+    As in `mixed_estimator_2`, groups of 1 row return a simple average with no variance, empty groups return nans.
+
+    `rng` is a `numpy.random.Generator` or a seed used for the bootstrap.
+
+    Return:
+    mixed_estimators, mixedVs  -   arrays of shape (groups,)
+    weights                     -   array of shape (groups, series)
+    """
+    rng = np.random.default_rng(rng)
+    Ts = np.asarray(Ts, dtype=float)
+    offsets = np.asarray(offsets)
+    series_len = Ts.shape[0]
+    groups_len = len(offsets) - 1
+
+    # Drop nans and recalculate the offsets
+    group_ids = np.repeat(np.arange(groups_len), np.diff(offsets))
+    not_nans = ~np.any(np.isnan(Ts), axis=0)
+    Ts, group_ids = Ts[:, not_nans], group_ids[not_nans]
+    ns = np.bincount(group_ids, minlength=groups_len)
+    starts = np.concatenate([[0], np.cumsum(ns)[:-1]])
+
+    mixed_estimators = np.full(groups_len, np.nan)
+    mixedVs = np.full(groups_len, np.nan)
+    weights = np.full((groups_len, series_len), np.nan)
+
+    # Groups with a single row
+    single = ns == 1
+    mixed_estimators[single] = Ts[:, starts[single]].mean(axis=0)
+    weights[single] = 1 / series_len
+
+    bootstrapped = np.flatnonzero(ns >= 2)
+    if not len(bootstrapped):
+        return mixed_estimators, mixedVs, weights
+    ns, starts = ns[bootstrapped], starts[bootstrapped]
+    n_max = ns.max()
+
+    # Medians of the data of each group, shape (series, groups)
+    local_inds = np.minimum(np.arange(n_max), ns[:, np.newaxis] - 1)
+    T_data_medians = grouped_median(Ts[:, starts[:, np.newaxis] + local_inds], ns)
+
+    # Draw the resampling indices of all series, groups and repetitions at once.
+    # Shape (series, groups, B, n_max). Indices beyond the group size are padding
+    inds = (rng.random((series_len, len(ns), B, n_max)) * ns[:, np.newaxis, np.newaxis]).astype(int)
+    samples = np.take_along_axis(
+        Ts[:, np.newaxis, :], (starts[:, np.newaxis, np.newaxis] + inds).reshape(series_len, 1, -1),
+        axis=2).reshape(inds.shape)
+    T_sample_medians = grouped_median(samples, ns[:, np.newaxis])
+
+    # Covariance matrices of the medians, shape (groups, series, series)
+    deviations = T_sample_medians - T_data_medians[..., np.newaxis]
+    sigma = np.einsum('igb,jgb->gij', deviations, deviations) / B
+
+    # Calculate the mixed estimators. Groups with a singular covariance matrix are left as nans
+    invertible = np.linalg.det(sigma) != 0
+    sigma_inv = np.linalg.inv(sigma[invertible])
+    norm = sigma_inv.sum(axis=(1, 2))
+    group_weights = sigma_inv.sum(axis=1) / norm[:, np.newaxis]
+
+    inds = bootstrapped[invertible]
+    weights[inds] = group_weights
+    mixed_estimators[inds] = np.sum(group_weights * T_data_medians[:, invertible].T, axis=1)
+    mixedVs[inds] = 1 / norm
+
+    return mixed_estimators, mixedVs, weights
+
+
 def welchs_test(x1Mean, x1V, n1, x2Mean, x2V, n2):
     """
-    Can accept arrays as input
+    Can accept arrays as input. All the tests are then performed at once.
     """
     # Test statistics
-    t = (x1Mean - x2Mean) / \
-        np.sqrt(x1V / n1 + x2V / n2)
-    nu = ((x1V / n1 + x2V / n2)**2
-          / (x1V**2 / n1 / (n1 - 1) + x2V**2 / n2 / (n2 - 1))
-          )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (x1Mean - x2Mean) / \
+            np.sqrt(x1V / n1 + x2V / n2)
+        nu = ((x1V / n1 + x2V / n2)**2
+              / (x1V**2 / n1 / (n1 - 1) + x2V**2 / n2 / (n2 - 1))
+              )
     # p-value for additivity
-    if not np.isnan(t):
-        p = 2 * (student.cdf(-np.abs(t), df=nu))
-    else:
-        p = np.nan
+    p = np.where(np.isnan(t), np.nan, 2 * (student.cdf(-np.abs(t), df=nu)))
+    if np.ndim(p) == 0:
+        p = p[()]
 
     return p, t, nu
 
@@ -361,6 +792,139 @@ def welchs_test_arrays(x1, x2):
     return welchs_test(x1Mean, x1V, n1, x2Mean, x2V, n2)
 
 
+def count_permutation_exceedances(x, n1, observed, permutations, seed):
+    """
+    Count the random splits of the pooled sample `x` into groups of `n1` and `len(x) - n1` values with an absolute difference of means at least as large as `observed`.
+
+    The permutations are generated as one index matrix of shape (permutations, len(x)), and the statistics of all of them are calculated at once from the sums of the first `n1` values.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    inds = rng.permuted(np.tile(np.arange(n), (permutations, 1)), axis=1)
+    sums1 = np.sum(x[inds[:, :n1]], axis=1)
+    diffs = sums1 / n1 - (np.sum(x) - sums1) / (n - n1)
+    # Allow for the round-off errors of the sums, so that the observed split itself is counted
+    return np.sum(np.abs(diffs) >= observed * (1 - 1e-10))
+
+
+def permutation_tests(samples1, samples2, permutations=10**5, chunk_size=10**4, significance_level=0.05,
+                      confidence=0.99, workers=1, rng=None):
+    """
+    Perform two-sided permutation tests for the difference of means of many pairs of samples without assuming normality.
+
+    Parameters:
+    samples1, samples2  -   lists of arrays of values. The tests are performed for each pair (samples1[i], samples2[i]). Nan values are ignored
+    permutations        -   the maximal number of random permutations per test
+    chunk_size          -   the number of permutations evaluated at once (see `count_permutation_exceedances`)
+    workers             -   the number of processes evaluating the chunks of permutations of all tests in parallel
+    rng                 -   a seed or a `numpy.random.Generator` used to draw the seeds of the chunks. The results do not depend on `workers`
+
+    The permutations are processed in rounds of one chunk per test.
+    A test is stopped early once the Clopper-Pearson interval of its p-value at the given `confidence` lies entirely above or below `significance_level`, since more permutations would not change the conclusion.
+
+    Return:
+    p           -   the p-values (count + 1) / (permutations + 1), which include the observed split
+    diffs       -   the observed differences of means
+    done        -   the number of permutations performed for each test
+    """
+    tests_len = len(samples1)
+    samples1 = [np.asarray(x, dtype=float) for x in samples1]
+    samples2 = [np.asarray(x, dtype=float) for x in samples2]
+    samples1 = [x[~np.isnan(x)] for x in samples1]
+    samples2 = [x[~np.isnan(x)] for x in samples2]
+    pooled = [np.concatenate([x1, x2]) for x1, x2 in zip(samples1, samples2)]
+
+    diffs = np.full(tests_len, np.nan)
+    counts = np.zeros(tests_len, dtype=int)
+    done = np.zeros(tests_len, dtype=int)
+    active = np.zeros(tests_len, dtype=bool)
+    for i, (x1, x2) in enumerate(zip(samples1, samples2)):
+        if len(x1) > 0 and len(x2) > 0:
+            diffs[i] = np.mean(x1) - np.mean(x2)
+            active[i] = True
+
+    seed_sequence = np.random.SeedSequence(np.random.default_rng(rng).integers(2**63))
+
+    def get_round(chunk):
+        tests = np.flatnonzero(active)
+        sizes = np.minimum(chunk_size, permutations - done[tests])
+        seeds = [np.random.SeedSequence(seed_sequence.entropy, spawn_key=(test, chunk)) for test in tests]
+        args = ([pooled[test] for test in tests], [len(samples1[test]) for test in tests],
+                np.abs(diffs[tests]), sizes, seeds)
+        return tests, sizes, args
+
+    def run(map_func):
+        chunk = 0
+        while np.any(active):
+            tests, sizes, args = get_round(chunk)
+            counts[tests] += np.fromiter(map_func(count_permutation_exceedances, *args), dtype=int, count=len(tests))
+            done[tests] += sizes
+
+            # Stop the tests whose conclusion is settled
+            lower = beta.ppf((1 - confidence) / 2, counts[tests], done[tests] - counts[tests] + 1)
+            upper = beta.ppf((1 + confidence) / 2, counts[tests] + 1, done[tests] - counts[tests])
+            lower = np.nan_to_num(lower, nan=0)
+            upper = np.nan_to_num(upper, nan=1)
+            settled = (upper < significance_level) | (lower > significance_level) | (done[tests] >= permutations)
+            active[tests[settled]] = False
+            chunk += 1
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            run(executor.map)
+    else:
+        run(map)
+
+    with np.errstate(invalid='ignore'):
+        p = np.where(done > 0, (counts + 1) / (done + 1), np.nan)
+    return p, diffs, done
+
+
+def bayes_factor(n1, mean1, V1, n2, mean2, V2, mu_pi, V_pi, n_pi=n_pi):
+    """
+    Calculate the log10 Bayes factor for the evidence that two samples should be described by two different Gaussian distributions, as compared to a single Gaussian.
+    Basically it answers the question of whether the two distributions are different.
+
+    Same as `archive/calculate_bayes_factor.py`, but calculated from the sufficient statistics of the samples: the number of values, their mean and their biased variance.
+    All parameters can be arrays, in which case all Bayes factors are calculated at once.
+    The statistics of the pooled sample are obtained from those of the two samples.
+
+    Parameters:
+    mu_pi, V_pi, n_pi   -   the mean, the variance and the weight (in number of samples) of the normal-inverse-chi-squared prior
+
+    Return:
+    log10_B     -   log10 of the Bayes factor. Positive values favor two different distributions
+    """
+    n1, n2 = np.asarray(n1, dtype=float), np.asarray(n2, dtype=float)
+    n = n1 + n2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (n1 * mean1 + n2 * mean2) / n
+        V = (n1 * V1 + n2 * V2) / n + n1 * n2 / n**2 * (mean1 - mean2)**2
+
+    log_A0 = (np.log(2) + 1 / 2 * n_pi + (n_pi - 1) / 2 * np.log(np.pi)
+              + (n_pi - 3) / 2 * np.log(n_pi * V_pi) - gammaln((n_pi - 3) / 2))
+
+    def log_prob(s, n, V):
+        return (
+            log_A0
+            + (1 - n - n_pi) / 2 * np.log(np.pi)
+            - np.log(2)
+            - 1 / 2 * np.log(n + n_pi)
+            + gammaln((n + n_pi - 3) / 2)
+            - (n + n_pi - 3) / 2
+            * np.log(n * V + n_pi * V_pi + n * n_pi / (n + n_pi) * (s - mu_pi) ** 2)
+        )
+
+    with np.errstate(invalid='ignore'):
+        log_B = log_prob(mean1, n1, V1) + log_prob(mean2, n2, V2) - log_prob(mean, n, V)
+    # Empty samples give no evidence
+    log_B = np.where((n1 > 0) & (n2 > 0), log_B, np.nan)
+    if np.ndim(log_B) == 0:
+        log_B = log_B[()]
+
+    return log_B / np.log(10)
+
+
 def set_figure_size(num, rows, page_width_frac, height_factor=1.0, clear=True):
     pagewidth_in = 6.85
     font_size = 8
@@ -415,12 +979,12 @@ def rho_HD(betaT):
     return (1 - betaT)
 
 
-def rho_MC():
-    sq = np.sqrt(l)
-    rho = sq / (1 + sq)
+def rho_MC_from_l(l):
+    return np.sqrt(l) / (1 + np.sqrt(l))
 
-    partial_l = 1 / 2 / sq / (1 + sq)**2
-    rhoV = partial_l**2 * lV
+
+def rho_MC():
+    rho, rhoV = propagate(rho_MC_from_l, [l], [lV])
     # print(f'rho_MC: {rho} +- {np.sqrt(rhoV)}')
     return [rho, rhoV]
 
@@ -433,15 +997,33 @@ def J_over_k_HD(betaT):
     return betaT * (1 - betaT) / (1 + betaT * (l - 1))
 
 
+def J_over_k_MC_from_l(l):
+    return (1 + np.sqrt(l))**(-2)
+
+
 def J_over_k_MC():
-    sq = np.sqrt(l)
-    JoK = (1 + sq)**(-2)
-    partial_l = - (1 + sq)**(-3) / sq
-    JoKV = partial_l**2 * lV
+    JoK, JoKV = propagate(J_over_k_MC_from_l, [l], [lV])
     # print(f'J/k_MC: {JoK} +- {np.sqrt(JoKV)}')
     return [JoK, JoKV]
 
 
+def alpha_over_k_from_JoK(JoK, l):
+    """
+    Inverse function for alpha/k from J/k in the LD phase
+    """
+    return (1
+            - JoK * (l - 1)
+            - np.sqrt(1 + JoK**2 * (l - 1)**2 - 2 * JoK * (l + 1))
+            ) / 2
+
+
+def alpha_over_k_from_rho(rho, l):
+    """
+    Inverse function for alpha/k from rho in the LD phase
+    """
+    return rho / (l - rho * (l - 1))
+
+
 if __name__ == "__main__":
     rho_MC()
     J_over_k_MC()
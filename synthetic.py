@@ -0,0 +1,119 @@
+"""
+This file contains a generator of synthetic MS2 fluorescence traces in the format of the `matlab_csv_data_file`.
+
+The synthetic data sets follow the same steps as the experimental ones: in each nc, the intensity of a trace rises linearly and then saturates at a maximum.
+The true slope and maximum of each data set are known, which allows testing and benchmarking the pipeline on data of any size.
+"""
+
+import numpy as np
+import pandas as pd
+
+from constants import gene_labels, mins_per_frame
+
+columns = ['trace_id', 'dataset_id', 'dataset', 'gene', 'gene_id', 'construct', 'construct_id', 'frame', 'time',
+           'intensity', 'ap']
+construct_labels = ['bac', 'no_pr', 'no_sh']
+# The constructs are identified from the data set names (see `MATLAB conversion code/data_to_csv.m`)
+construct_name_suffixes = ['bac', 'primary', 'shadow']
+
+# Time limits of the ncs in minutes, nc14 starts at t = 0
+default_nc_times = {11: (-41, -34), 12: (-30, -21), 13: (-17, -4), 14: (0, 40)}
+
+
+def generate_traces(datasets=9, traces=50, frames=None, dt=mins_per_frame, nc_times=None, genes=None,
+                    slope=175, max_intensity=1250, dataset_spread=0.1, noise=20, frame_dropout=0.1,
+                    nc_jitter=0.5, rng=None):
+    """
+    Generate a table of synthetic MS2 traces with the columns of the `matlab_csv_data_file`.
+
+    Parameters:
+    datasets        -   the number of data sets. The genes and constructs are cycled through, so that data set i has gene i % len(genes) and construct (i // len(genes)) % 3
+    traces          -   the number of traces per data set
+    frames          -   the number of frames per trace. By default, the frames cover all ncs in `nc_times`
+    dt              -   the time between frames, min
+    nc_times        -   dictionary {nc: (start, end)} of the nc time limits in minutes. The default is `default_nc_times`
+    genes           -   list of the genes of the data sets, from `gene_labels`
+    slope           -   the mean initial slope of the intensity in each nc, fluo/min
+    max_intensity   -   the mean steady-state intensity, fluo
+    dataset_spread  -   the relative standard deviation of the slope and the max. intensity between data sets
+    noise           -   the standard deviation of the Gaussian noise of the intensity, fluo
+    frame_dropout   -   the probability that a frame of a trace is missing
+    nc_jitter       -   the standard deviation of the start of each nc between traces, min
+    rng             -   a `numpy.random.Generator` or a seed
+
+    The AP positions reproduce the expression patterns expected by `filter_by_AP`: hb traces spread over the anterior half, kn traces follow a stripe moving with time, and sn traces are distributed uniformly.
+    Note that the manual adjustments of `identify_ncs` and `intensity_thresholds` for particular experimental data sets also apply to the synthetic data sets with the same ids.
+
+    Return:
+    data frame with one row per observed frame, and the table of the true slope and max. intensity of each data set
+    """
+    rng = np.random.default_rng(rng)
+    nc_times = default_nc_times if nc_times is None else nc_times
+    genes = gene_labels if genes is None else genes
+    nc_limits = np.array([nc_times[nc] for nc in sorted(nc_times)])
+
+    # Time axis covering all ncs with a margin
+    start_time = nc_limits.min() - 3
+    if frames is None:
+        frames = int(np.ceil((nc_limits.max() + 3 - start_time) / dt))
+    frame = np.arange(frames)
+    time = start_time + frame * dt
+
+    # Data set properties
+    dataset_ids = np.arange(datasets)
+    gene_ids = np.array([gene_labels.index(genes[i % len(genes)]) for i in dataset_ids])
+    construct_ids = (dataset_ids // len(genes)) % len(construct_labels)
+    dataset_slopes = slope * (1 + dataset_spread * rng.standard_normal(datasets))
+    dataset_maxs = max_intensity * (1 + dataset_spread * rng.standard_normal(datasets))
+    truth = pd.DataFrame({'slope': dataset_slopes, 'max': dataset_maxs}, index=pd.Index(dataset_ids, name='dataset_id'))
+
+    # Intensities of all traces on a (trace, frame) grid. Each trace has its own nc starts
+    traces_len = datasets * traces
+    trace_dataset = np.repeat(dataset_ids, traces)
+    intensity = np.zeros((traces_len, frames))
+    for nc_start, nc_end in nc_limits:
+        starts = nc_start + nc_jitter * rng.standard_normal((traces_len, 1))
+        rise = np.clip((time - starts) * dataset_slopes[trace_dataset, np.newaxis],
+                       0, dataset_maxs[trace_dataset, np.newaxis])
+        intensity += np.where(time <= nc_end, rise, 0)
+    intensity += noise * rng.standard_normal((traces_len, frames))
+
+    # AP positions
+    trace_gene = np.array(gene_labels)[gene_ids[trace_dataset]]
+    ap = rng.uniform(0.05, 0.95, (traces_len, 1)) + 0.005 * rng.standard_normal((traces_len, frames))
+    ap = np.where((trace_gene == 'hb')[:, np.newaxis], 0.05 + (ap - 0.05) / 2, ap)
+    # The kn stripe moves anteriorly by 0.05 AP per hour
+    kn_ap = 0.65 - 0.05 * (time - start_time) / 60 + 0.02 * rng.standard_normal((traces_len, 1))
+    ap = np.where((trace_gene == 'kn')[:, np.newaxis],
+                  kn_ap + 0.005 * rng.standard_normal((traces_len, frames)), ap)
+
+    # Keep the observed frames only
+    trace_ind, frame_ind = np.nonzero(rng.random((traces_len, frames)) >= frame_dropout)
+    dataset_names = np.array([f'synthetic_{i}_{gene_labels[gene_ids[i]]}_{construct_name_suffixes[construct_ids[i]]}'
+                              for i in dataset_ids])
+    row_dataset = trace_dataset[trace_ind]
+    data = pd.DataFrame({
+        'trace_id': trace_ind,
+        'dataset_id': row_dataset,
+        'dataset': dataset_names[row_dataset],
+        'gene': trace_gene[trace_ind],
+        'gene_id': gene_ids[row_dataset],
+        'construct': np.array(construct_labels)[construct_ids[row_dataset]],
+        'construct_id': construct_ids[row_dataset],
+        'frame': frame[frame_ind],
+        'time': time[frame_ind],
+        'intensity': intensity[trace_ind, frame_ind],
+        'ap': ap[trace_ind, frame_ind],
+    }, columns=columns)
+    return data, truth
+
+
+def write_synthetic_data(filepath, **kwargs):
+    """
+    Generate synthetic traces with `generate_traces` and save them to a `.csv` file that can be loaded with `load_data`.
+
+    Return the table of the true slope and max. intensity of each data set.
+    """
+    data, truth = generate_traces(**kwargs)
+    data.to_csv(filepath, index=False)
+    return truth
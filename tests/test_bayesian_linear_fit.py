@@ -0,0 +1,125 @@
+"""
+Check the analytic derivatives of -ln(posterior) used in the Bayesian linear fit against finite differences
+"""
+
+import os
+import sys
+
+import numpy as np
+from scipy import optimize
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from support import (bayesian_linear_fit, bayesian_linear_fit_batch,  # noqa: E402
+                     numerical_gradient_and_hessian, posterior)
+
+
+def get_data():
+    rng = np.random.default_rng(0)
+    n = 40
+    x = rng.uniform(5, 30, n)
+    Vx = rng.uniform(0.5, 2, n)
+    y = 4.5 * x + 3 + rng.normal(0, 5, n)
+    Vy = rng.uniform(10, 40, n)
+    x[3] = np.nan
+    return x, y, Vx, Vy
+
+
+def test_posterior_derivatives():
+    x, y, Vx, Vy = get_data()
+
+    def prior(m, sigmaV):
+        return np.exp(-(m - 3.6)**2 / 2 / 0.5)
+
+    for c, prior, params in [(True, None, [4.0, 2.0, 3.0]),
+                             (False, None, [4.0, 3.0]),
+                             (False, prior, [4.0, 3.0])]:
+        phi, gradient, hessian = posterior(x, y, Vx, Vy, c=c, prior=prior, derivatives=True)
+        gradient_num, hessian_num = numerical_gradient_and_hessian(phi, params, step=1e-4)
+        assert np.allclose(gradient(params), gradient_num, rtol=1e-5)
+        assert np.allclose(hessian(params), hessian_num, rtol=1e-3)
+
+
+def test_bayesian_linear_fit():
+    x, y, Vx, Vy = get_data()
+
+    fit = bayesian_linear_fit(x, y, Vx, Vy, c=True)
+    fit_numerical = bayesian_linear_fit(x, y, Vx, Vy, c=True, analytic_derivatives=False)
+
+    assert np.isclose(fit['m'], fit_numerical['m'], rtol=1e-4)
+    assert np.isclose(fit['c'], fit_numerical['c'], rtol=1e-3)
+    assert fit['mV'] > 0 and fit['cV'] > 0
+
+
+def get_overdispersed_data(rng, shape=30):
+    """
+    Data scattering much more than their declared variances, so that the fit has sigmaV > 0
+    """
+    x = rng.uniform(1, 10, shape)
+    Vx = np.full(shape, 0.01)
+    Vy = np.full(shape, 0.01)
+    y = 2 * x + rng.normal(0, 2, shape)
+    return x, y, Vx, Vy
+
+
+def test_bayesian_linear_fit_overdispersed():
+    x, y, Vx, Vy = get_overdispersed_data(np.random.default_rng(0))
+
+    for c in [True, False]:
+        fit = bayesian_linear_fit(x, y, Vx, Vy, c=c)
+        fit_numerical = bayesian_linear_fit(x, y, Vx, Vy, c=c, analytic_derivatives=False)
+        for key in ['m', 'c', 'sigmaV']:
+            assert np.isclose(fit[key], fit_numerical[key], rtol=1e-4)
+        # The BFGS approximation of the inverse Hessian is less precise
+        assert np.isclose(fit['sigmaVV'], fit_numerical['sigmaVV'], rtol=0.05)
+        assert fit['sigmaV'] > 1 and fit['sigmaVV'] > 0
+
+
+def fit_reference(x, y, Vx, Vy, c):
+    """
+    Minimize -ln(posterior) from a starting point with sigmaV > 0, where its derivatives with respect to sigmaV do not vanish
+    """
+    phi, gradient, hessian = posterior(x, y, Vx, Vy, c=c, derivatives=True)
+    guess = (1, 0, 1) if c else (1, 1)
+    min = optimize.minimize(phi, guess, jac=gradient, method='BFGS', options={'gtol': 1e-10})
+    V = np.linalg.inv(hessian(min.x)).diagonal()
+    fit = {'m': min.x[0], 'mV': V[0], 'sigmaV': np.abs(min.x[-1]), 'sigmaVV': V[-1]}
+    fit['c'], fit['cV'] = (min.x[1], V[1]) if c else (0, 0)
+    return fit
+
+
+def test_bayesian_linear_fit_batch():
+    rng = np.random.default_rng(1)
+    problems_len, points_len = 20, 30
+    x = rng.uniform(5, 30, (problems_len, points_len))
+    Vx = rng.uniform(0.5, 2, (problems_len, points_len))
+    y = 4.5 * x + 3 + rng.normal(0, 5, (problems_len, points_len))
+    Vy = rng.uniform(10, 40, (problems_len, points_len))
+    mask = rng.random((problems_len, points_len)) > 0.2
+
+    for c in [True, False]:
+        fits = bayesian_linear_fit_batch(x, y, Vx, Vy, mask=mask, c=c)
+        for problem in range(problems_len):
+            inds = mask[problem]
+            fit = fit_reference(x[problem, inds], y[problem, inds], Vx[problem, inds], Vy[problem, inds], c=c)
+            fit_scalar = bayesian_linear_fit(x[problem, inds], y[problem, inds],
+                                             Vx[problem, inds], Vy[problem, inds], c=c)
+            for key in ['m', 'mV', 'c', 'cV', 'sigmaV', 'sigmaVV']:
+                assert np.isclose(fits[key][problem], fit[key], rtol=1e-3, atol=1e-4)
+                assert np.isclose(fits[key][problem], fit_scalar[key], rtol=1e-3, atol=1e-3)
+
+
+def test_bayesian_linear_fit_batch_overdispersed():
+    problems_len, points_len = 10, 30
+    x, y, Vx, Vy = get_overdispersed_data(np.random.default_rng(2), (problems_len, points_len))
+
+    for c in [True, False]:
+        fits = bayesian_linear_fit_batch(x, y, Vx, Vy, c=c)
+        for problem in range(problems_len):
+            fit = fit_reference(x[problem], y[problem], Vx[problem], Vy[problem], c=c)
+            fit_numerical = bayesian_linear_fit(x[problem], y[problem], Vx[problem], Vy[problem], c=c,
+                                                analytic_derivatives=False)
+            for key in ['m', 'mV', 'c', 'cV', 'sigmaV', 'sigmaVV']:
+                assert np.isclose(fits[key][problem], fit[key], rtol=1e-3, atol=1e-6)
+            for key in ['m', 'c', 'sigmaV']:
+                assert np.isclose(fits[key][problem], fit_numerical[key], rtol=1e-3, atol=1e-6)
+            assert fits['sigmaV'][problem] > 1 and fits['sigmaVV'][problem] > 0
@@ -0,0 +1,68 @@
+"""
+Compare the rolling-window slope detection based on prefix sums with window-by-window fits
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import get_best_nc_slopes, get_nc_slopes  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def get_best_slope_reference(nc_data, window_mins, origin):
+    """
+    Fit each window separately with `np.polyfit` and keep the best one
+    """
+    times = np.unique(nc_data.time)
+    nc_start, nc_end = times[0], times[-1]
+    best = (np.inf, np.nan, np.nan)
+    for start in times:
+        if start != nc_start and start + window_mins > nc_end:
+            continue
+        window = nc_data[(nc_data.time >= start) & (nc_data.time <= start + window_mins)]
+        if len(window) < 4 or window.time.nunique() < 3:
+            continue
+        (slope, intercept), residual = np.polyfit(
+            window.time - origin, window.intensity, 1, full=True)[:2]
+        score = residual[0] / len(window)
+        if slope > 0 and -intercept / slope > 0 and score < best[0]:
+            best = (score, slope, start)
+    return best[1:]
+
+
+def test_best_nc_slopes():
+    rng = np.random.default_rng(0)
+    dt = 0.7
+    data = []
+    for dataset_id in range(3):
+        for nc, (nc_start, nc_end) in zip([12, 13], [(-30, -20), (-15, 5)]):
+            time = np.arange(nc_start, nc_end, dt)
+            # A plateau followed by a slope starting at a random time
+            slope_start = nc_start + rng.uniform(1, 4)
+            intensity = np.maximum(time - slope_start, 0) * 300 + 50
+            for trace_id in range(5):
+                data.append(pd.DataFrame({
+                    'dataset_id': dataset_id, 'nc': nc, 'trace_id': trace_id, 'time': time,
+                    'intensity': intensity + rng.normal(0, 20, len(time))}))
+    table = TraceTable(pd.concat(data, ignore_index=True))
+
+    window_mins = 3
+    best_slopes = get_best_nc_slopes(table, window_mins=window_mins)
+    assert set(best_slopes) == set(get_nc_slopes(table))
+
+    for (dataset_id, nc), (slope, slopeV, coefs, (start, end)) in best_slopes.items():
+        nc_data = table.nc(dataset_id, nc)
+        # The intersect with the time axis must follow the end of the previous nc
+        origin = table.nc(dataset_id, nc - 1).time.max() if nc > 12 else -1e3
+        slope_reference, start_reference = get_best_slope_reference(nc_data, window_mins, origin)
+        assert np.isclose(slope, slope_reference)
+        assert np.isclose(start, start_reference)
+        assert slopeV > 0
+
+        # The coefficients are given for the absolute time
+        window = nc_data[(nc_data.time >= start) & (nc_data.time <= end)]
+        assert np.allclose(coefs, np.polyfit(window.time, window.intensity, 1))
@@ -0,0 +1,48 @@
+"""
+Check that the binary cache of the input data reproduces the `.csv` table and is rebuilt when the source changes
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from cache import get_cache_path, load_data  # noqa: E402
+
+
+def write_csv(filepath, seed):
+    rng = np.random.default_rng(seed)
+    n = 50
+    data = pd.DataFrame({'trace_id': np.repeat(np.arange(5), 10),
+                         'dataset_id': 0,
+                         'dataset': 'dataset_0',
+                         'gene': 'hb',
+                         'frame': np.tile(np.arange(10), 5),
+                         'time': np.tile(np.arange(10), 5) * 0.5,
+                         'intensity': rng.uniform(0, 1000, n),
+                         'ap': rng.uniform(0, 1, n)})
+    data.to_csv(filepath, index=False)
+    return data
+
+
+def test_cache(tmp_path):
+    filepath = str(tmp_path / 'data.csv')
+    source = write_csv(filepath, seed=0)
+
+    data = load_data(filepath)
+    assert os.path.isfile(get_cache_path(filepath))
+    cached = load_data(filepath)
+    pd.testing.assert_frame_equal(data, cached)
+
+    assert cached.gene.dtype == 'category'
+    assert cached.trace_id.dtype == np.int32
+    assert np.allclose(cached.intensity, source.intensity, rtol=1e-6)
+    assert np.allclose(cached.ap_mean, source.ap.groupby(source.trace_id).transform('mean'))
+
+    # A modified source file invalidates the cache
+    source = write_csv(filepath, seed=1)
+    os.utime(filepath, (0, 0))
+    reloaded = load_data(filepath)
+    assert np.allclose(reloaded.intensity, source.intensity, rtol=1e-6)
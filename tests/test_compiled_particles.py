@@ -0,0 +1,107 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.io import savemat
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cache import load_data  # noqa: E402
+from compiled_particles import (get_construct,  # noqa: E402
+                                import_compiled_particles, read_particles)
+from constants import mins_per_frame  # noqa: E402
+
+
+def write_compiled_particles(folder, particles):
+    """
+    Save a list of particles {field: values} as a `CompiledParticles` struct array
+    """
+    os.makedirs(folder)
+    fields = sorted({field for particle in particles for field in particle})
+    compiled = np.zeros((1, len(particles)), dtype=[(field, object) for field in fields])
+    for i, particle in enumerate(particles):
+        for field in fields:
+            compiled[0, i][field] = np.asarray(particle.get(field, []), dtype=float)
+    savemat(os.path.join(folder, 'CompiledParticles.mat'), {'CompiledParticles': compiled})
+
+
+def test_get_construct():
+    assert get_construct('2016_07_01_hb_NoShadow') == ('no_sh', 2)
+    assert get_construct('2016_07_01_Kn_NoPrimary') == ('no_pr', 1)
+    assert get_construct('2016_07_01_sn_BAC') == ('bac', 0)
+
+
+def test_import_compiled_particles(tmp_path):
+    # Particles without frames also take a trace id, like in `data_to_csv.m`
+    write_compiled_particles(os.path.join(tmp_path, 'HunchBack', '_approved', 'hb_bac_1'), [
+        {'Frame': [1, 2, 3], 'Fluo': [10, 20, 30], 'APpos': [0.3, 0.31, 0.32]},
+        {'Frame': [], 'Fluo': [], 'APpos': []},
+        {'Frame': [5, 6], 'Fluo': [40, 50], 'APpos': [0.4, 0.42]},
+        {'Frame': [], 'Fluo': [], 'APpos': []},
+    ])
+    write_compiled_particles(os.path.join(tmp_path, 'SNAIL', '_approved', 'sn_NoShad_1'), [
+        {'Frame': [7], 'Fluo': [60], 'APPos': [0.5]},
+    ])
+    # A folder without a `CompiledParticles.mat` file is reported and skipped
+    os.makedirs(os.path.join(tmp_path, 'Knirps', '_approved', 'kn_broken'))
+
+    assert len(read_particles(os.path.join(tmp_path, 'SNAIL', '_approved', 'sn_NoShad_1', 'CompiledParticles.mat'))) == 1
+
+    output_path = os.path.join(tmp_path, 'data.npz')
+    data = import_compiled_particles(str(tmp_path), output_path)
+
+    assert list(data.dataset) == ['hb_bac_1'] * 5 + ['sn_NoShad_1']
+    assert list(data.dataset_id) == [0] * 5 + [1]
+    assert list(data.trace_id) == [0, 0, 0, 2, 2, 4]
+    assert list(data.gene) == ['hb'] * 5 + ['sn']
+    assert list(data.gene_id) == [0] * 5 + [2]
+    assert list(data.construct) == ['bac'] * 5 + ['no_sh']
+    assert list(data.construct_id) == [0] * 5 + [2]
+    assert list(data.frame) == [1, 2, 3, 5, 6, 7]
+    assert np.allclose(data.time, data.frame * mins_per_frame)
+    assert np.allclose(data.intensity, [10, 20, 30, 40, 50, 60])
+    assert np.allclose(data.ap_mean, [0.31] * 3 + [0.41] * 2 + [0.5])
+
+    loaded = load_data(output_path)
+    assert loaded.equals(data)
+
+    # The import is skipped if the input files have not changed
+    assert import_compiled_particles(str(tmp_path), output_path).equals(data)
+
+
+def test_read_particles_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    particles = [{'Frame': [1, 2, 3], 'Fluo': [10, 20, 30], 'APPos': [0.3, 0.31, 0.32]},
+                 {'Frame': [], 'Fluo': [], 'APPos': []},
+                 {'Frame': [5, 6], 'Fluo': [40, 50], 'APPos': [0.4, 0.42]}]
+
+    # MATLAB v7.3 layout: each field is a column of references to the arrays of the particles
+    filepath = os.path.join(tmp_path, 'CompiledParticles.mat')
+    with h5py.File(filepath, 'w', userblock_size=512) as file:
+        refs = file.create_group('#refs#')
+        group = file.create_group('CompiledParticles')
+        # Empty arrays are saved as their dimensions
+        empty = refs.create_dataset('empty', data=np.array([0, 0], dtype=np.uint64))
+        empty.attrs['MATLAB_empty'] = np.uint8(1)
+        for field in ['Frame', 'Fluo', 'APPos']:
+            field_refs = np.empty((len(particles), 1), dtype=h5py.ref_dtype)
+            for i, particle in enumerate(particles):
+                if len(particle[field]) == 0:
+                    field_refs[i, 0] = empty.ref
+                    continue
+                values = refs.create_dataset(f'{field}_{i}', data=np.asarray(particle[field], dtype=float)[:, np.newaxis])
+                field_refs[i, 0] = values.ref
+            group.create_dataset(field, data=field_refs)
+
+    # The MATLAB header in the user block identifies the file as v7.3, so `loadmat` refuses it
+    header = b'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: Mon Jan  1 00:00:00 2024 HDF5 schema 1.00 .'
+    with open(filepath, 'r+b') as file:
+        file.write(header.ljust(116) + bytes(8) + b'\x00\x02' + b'IM')
+
+    read = read_particles(filepath)
+    assert len(read) == 3
+    for particle, expected in zip(read, particles):
+        assert np.array_equal(particle['Frame'], expected['Frame'])
+        assert np.array_equal(particle['Fluo'], expected['Fluo'])
+        assert np.allclose(particle['APpos'], expected['APPos'])
@@ -17,7 +17,7 @@ import numpy as np
 import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from BLUE_estimator import BLUE_estimator
+from support import BLUE_estimator
 
 
 def test_composite_estimator():
@@ -56,9 +56,9 @@ def test_composite_estimator():
 
     d1 = data.T
 
-    sum(((d1[:, i, np.newaxis] - true_yield[i]) @
-         (d1[:, i, np.newaxis] - true_yield[i]).T for i in range(d1.shape[1]))) / 14
-    np.sqrt(_)
+    true_cov = sum(((d1[:, i, np.newaxis] - true_yield[i]) @
+                    (d1[:, i, np.newaxis] - true_yield[i]).T for i in range(d1.shape[1]))) / 14
+    np.sqrt(true_cov)
     # i = 0
     # (data[np.newaxis, i, :] - data[np.newaxis, i, :].mean()
     #  ).T @ (data[np.newaxis, i, :] - data[np.newaxis, i, :].mean())
@@ -0,0 +1,47 @@
+"""
+Check that the incremental processing of the data sets gives the same results as processing all of them at once
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from cache import convert_types  # noqa: E402
+from calculate import (calculate_slopes, filter_by_AP, identify_ncs,  # noqa: E402
+                       init_analyses)
+from dataset_store import process_datasets  # noqa: E402
+from synthetic import generate_traces  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def test_process_datasets(tmp_path):
+    folder = str(tmp_path)
+    data, _ = generate_traces(datasets=6, traces=20, rng=0)
+    data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+    data = convert_types(data)
+    table = TraceTable(data)
+
+    table_with_ncs, nc_limits = identify_ncs(filter_by_AP(table))
+    expected = calculate_slopes(table_with_ncs, init_analyses(table, nc_limits), save_figures=False)
+
+    first_table = TraceTable(data[data.dataset_id < 4])
+    analyses, processed = process_datasets(first_table, save_figures=False, folder=folder)
+    assert processed == [0, 1, 2, 3]
+    pd.testing.assert_frame_equal(analyses, expected.loc[[0, 1, 2, 3]])
+
+    # Only the new data sets are processed
+    analyses, processed = process_datasets(table, save_figures=False, folder=folder)
+    assert processed == [4, 5]
+    pd.testing.assert_frame_equal(analyses, expected)
+
+    # A modified data set is processed again
+    modified = data.copy()
+    modified.loc[modified.dataset_id == 2, 'intensity'] *= 2
+    modified_table = TraceTable(modified)
+    analyses, processed = process_datasets(modified_table, save_figures=False, folder=folder)
+    assert processed == [2]
+    table_with_ncs, nc_limits = identify_ncs(filter_by_AP(modified_table))
+    pd.testing.assert_frame_equal(
+        analyses, calculate_slopes(table_with_ncs, init_analyses(modified_table, nc_limits), save_figures=False))
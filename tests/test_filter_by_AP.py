@@ -0,0 +1,88 @@
+"""
+Regression test for the grouped AP filtering.
+The output of `filter_by_AP` is compared to the original data-set-by-data-set and frame-by-frame implementation
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import filter_by_AP  # noqa: E402
+from constants import data_folder, matlab_csv_data_file  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def filter_by_AP_reference(data_in):
+    """
+    The original implementation of `filter_by_AP` based on repeated concatenation
+    """
+    knirps_half_width_AP = 0.02
+    hb_AP_margin = 0.05
+
+    datasets = set(data_in.dataset)
+    data = pd.DataFrame()
+
+    for dataset in datasets:
+        dataset_data = data_in[data_in.dataset == dataset]
+        gene = dataset_data.gene.iloc[0]
+
+        if gene == 'hb':
+            max_AP = dataset_data.ap_mean.max()
+            filtered_data = dataset_data[
+                (dataset_data.ap_mean <= max_AP - hb_AP_margin) &
+                (dataset_data.ap_mean >= hb_AP_margin)]
+            data = pd.concat([data, filtered_data])
+
+        elif gene == 'kn':
+            frames = set(dataset_data.frame)
+            for frame in frames:
+                frame_data = dataset_data[dataset_data.frame == frame]
+                median_AP = frame_data.ap.median()
+                filtered_data = frame_data[
+                    (frame_data.ap >= median_AP - knirps_half_width_AP) &
+                    (frame_data.ap <= median_AP + knirps_half_width_AP)]
+                data = pd.concat([data, filtered_data])
+
+        elif gene == 'sn':
+            data = pd.concat([data, dataset_data])
+
+    return data
+
+
+def load_example_data():
+    """
+    Load the example data if available. Otherwise, generate a small data set with the same columns
+    """
+    filepath = os.path.join(os.path.dirname(__file__), '..', data_folder, matlab_csv_data_file)
+    if os.path.isfile(filepath):
+        data = pd.read_csv(filepath, sep=',', encoding='utf-8')
+    else:
+        rng = np.random.default_rng(0)
+        traces_len, frames_len = 20, 30
+        genes = ['hb', 'kn', 'sn', 'hb']
+        data = []
+        for dataset_id, gene in enumerate(genes):
+            trace_id = np.repeat(np.arange(traces_len), frames_len) + dataset_id * traces_len
+            frame = np.tile(np.arange(frames_len), traces_len)
+            ap = np.repeat(rng.uniform(0, 1, traces_len), frames_len) + \
+                rng.normal(0, 0.01, traces_len * frames_len)
+            data.append(pd.DataFrame({'trace_id': trace_id, 'dataset_id': dataset_id,
+                                      'dataset': f'dataset_{dataset_id}', 'gene': gene,
+                                      'frame': frame, 'ap': ap}))
+        data = pd.concat(data, ignore_index=True)
+
+    data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+    return data
+
+
+def test_filter_by_AP():
+    data = load_example_data()
+
+    filtered = filter_by_AP(TraceTable(data)).data
+    reference = filter_by_AP_reference(data)
+
+    assert len(filtered) > 0
+    pd.testing.assert_frame_equal(filtered.sort_index(), reference.sort_index())
@@ -0,0 +1,32 @@
+"""
+Check the grouped closed-form least-squares fit against `np.polyfit` applied to each group
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from support import grouped_linear_fit  # noqa: E402
+
+
+def test_grouped_linear_fit():
+    rng = np.random.default_rng(0)
+    sizes = [0, 2, 4, 10, 50]
+    group_ind = np.repeat(np.arange(len(sizes)), sizes)
+    x = rng.uniform(-30, 100, len(group_ind))
+    y = 200 * x + 1000 + rng.normal(0, 300, len(group_ind))
+
+    # Shuffle the points of different groups
+    order = rng.permutation(len(group_ind))
+    slopes, intercepts, slopesV, count = grouped_linear_fit(
+        x[order], y[order], group_ind[order], len(sizes), min_points=4)
+
+    assert list(count) == sizes
+    assert np.all(np.isnan([slopes[:2], intercepts[:2], slopesV[:2]]))
+    for group in [2, 3, 4]:
+        inds = group_ind == group
+        coefs, V = np.polyfit(x[inds], y[inds], 1, cov=True)
+        assert np.allclose([slopes[group], intercepts[group]], coefs, rtol=1e-10)
+        assert np.isclose(slopesV[group], V[0, 0], rtol=1e-10)
@@ -0,0 +1,31 @@
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+with contextlib.redirect_stdout(io.StringIO()):
+    import literature_estimates  # noqa: E402
+
+
+def test_literature_estimates():
+    l, lV = 50, 64
+    rho, rhoV = 0.1, 1e-4
+    aoK, aoKV = literature_estimates.alpha_over_k_rho_func(rho, rhoV, l, lV)
+    partial_l = -(((1 - rho) * rho) / (l - (-1 + l) * rho)**2)
+    partial_rho = l / (l + rho - l * rho)**2
+    assert np.isclose(aoK, rho / (l - rho * (l - 1)))
+    assert np.isclose(aoKV, partial_l**2 * lV + partial_rho**2 * rhoV, rtol=1e-10)
+
+    JoK, JoKV = 0.01, 1e-6
+    aoK, aoKV = literature_estimates.alpha_over_k_J_func(JoK, JoKV, l, lV)
+    root = np.sqrt(1 + JoK**2 * (l - 1)**2 - 2 * JoK * (l + 1))
+    partial_JoK = (1 - l - (JoK * (l - 1)**2 - (l + 1)) / root) / 2
+    partial_l = (-JoK - (JoK**2 * (l - 1) - JoK) / root) / 2
+    assert np.isclose(aoK, (1 - JoK * (l - 1) - root) / 2)
+    assert np.isclose(aoKV, partial_l**2 * lV + partial_JoK**2 * JoKV, rtol=1e-10)
+
+    for estimates in [literature_estimates.Tantale2016, literature_estimates.Darzacq2007]:
+        assert np.isfinite(estimates['alpha_over_k']) and estimates['alpha_over_kV'] > 0
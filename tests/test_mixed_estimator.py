@@ -0,0 +1,79 @@
+"""
+Check the vectorized bootstrap of the mixed estimators against the bootstrap repeated in a loop
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from support import (bootstrap_median_covariance, grouped_median,  # noqa: E402
+                     mixed_estimator_2, mixed_estimator_4,
+                     mixed_estimator_grouped)
+
+
+def test_bootstrap_median_covariance():
+    rng = np.random.default_rng(0)
+    T1 = rng.normal(1, 0.3, size=20)
+    T2 = rng.normal(2, 0.1, size=20)
+    B = 20000
+
+    # Repeat the bootstrap in a loop
+    medians = np.median([T1, T2], axis=1)
+    sigma_loop = np.zeros((2, 2))
+    for b in range(B):
+        deviations = np.array([np.median(rng.choice(T, size=len(T))) for T in [T1, T2]]) - medians
+        sigma_loop += np.outer(deviations, deviations)
+    sigma_loop /= B
+
+    sigma = bootstrap_median_covariance([T1, T2], B=B, rng=1)
+    assert np.allclose(np.diag(sigma), np.diag(sigma_loop), rtol=0.1)
+    assert np.abs(sigma[0, 1]) < 0.1 * np.sqrt(sigma[0, 0] * sigma[1, 1])
+
+
+def test_mixed_estimators():
+    rng = np.random.default_rng(0)
+    T1 = rng.normal(1, 0.3, size=20)
+    T2 = rng.normal(1, 0.1, size=20)
+
+    # Reproducible with a seed
+    est1, V1, weights1 = mixed_estimator_2(T1, T2, rng=5)
+    est2, V2, weights2 = mixed_estimator_2(T1, T2, rng=np.random.default_rng(5))
+    assert est1 == est2 and V1 == V2
+
+    # The more precise series gets the larger weight
+    assert np.isclose(np.sum(weights1), 1)
+    assert weights1[1] > weights1[0]
+
+    est, V, weights = mixed_estimator_4(T1, T2, T1, T2, rng=5)
+    assert np.isclose(np.sum(weights), 1)
+    assert V > 0
+
+
+def test_mixed_estimator_grouped():
+    rng = np.random.default_rng(0)
+    sizes = [0, 1, 5, 12]
+    T1s = [rng.normal(1, 0.3, size=n) for n in sizes]
+    T2s = [rng.normal(1, 0.1, size=n) for n in sizes]
+    T1s[3][2] = np.nan
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+    estimators, Vs, weights = mixed_estimator_grouped(
+        [np.concatenate(T1s), np.concatenate(T2s)], offsets, rng=1, B=20000)
+
+    assert np.isnan(estimators[0]) and np.isnan(Vs[0])
+    assert estimators[1] == (T1s[1][0] + T2s[1][0]) / 2 and np.isnan(Vs[1])
+    for group in [2, 3]:
+        estimator, V, group_weights = mixed_estimator_2(T1s[group], T2s[group], rng=1)
+        assert np.isclose(estimators[group], estimator, rtol=0.05)
+        assert np.isclose(Vs[group], V, rtol=0.2)
+        assert np.allclose(weights[group], group_weights, atol=0.1)
+
+
+def test_grouped_median():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(3, 7))
+    sizes = np.array([7, 4, 1])
+    medians = grouped_median(values, sizes)
+    assert np.allclose(medians, [np.median(values[i, :sizes[i]]) for i in range(3)])
@@ -0,0 +1,63 @@
+"""
+Check the batched permutation tests against an exact enumeration of the splits of small samples
+"""
+
+import itertools
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import get_contrasts, perform_welchs_test  # noqa: E402
+from support import permutation_tests  # noqa: E402
+from test_welchs_test import get_analyses  # noqa: E402
+
+
+def get_exact_p(x1, x2):
+    pooled = np.concatenate([x1, x2])
+    observed = abs(np.mean(x1) - np.mean(x2))
+    diffs = []
+    for inds in itertools.combinations(range(len(pooled)), len(x1)):
+        mask = np.zeros(len(pooled), dtype=bool)
+        mask[list(inds)] = True
+        diffs.append(abs(pooled[mask].mean() - pooled[~mask].mean()))
+    return np.mean(np.array(diffs) >= observed - 1e-12)
+
+
+def test_permutation_tests():
+    rng = np.random.default_rng(0)
+    samples1 = [rng.normal(0, 1, 5), rng.normal(3, 1, 6), np.array([1.0, np.nan, 2.0]), np.array([])]
+    samples2 = [rng.normal(0.5, 1, 6), rng.normal(0, 1, 5), np.array([1.5, 2.5, 3.0]), np.array([1.0])]
+
+    # A significance level equal to the exact p-value of the first test never settles it
+    exact_p = get_exact_p(samples1[0], samples2[0])
+    p, diffs, done = permutation_tests(samples1, samples2, permutations=40000, chunk_size=5000,
+                                       significance_level=exact_p, rng=1)
+    for i in range(3):
+        x1, x2 = samples1[i][~np.isnan(samples1[i])], samples2[i]
+        assert np.isclose(diffs[i], np.mean(x1) - np.mean(x2))
+        assert abs(p[i] - get_exact_p(x1, x2)) < 0.01
+    assert np.isnan(p[3]) and done[3] == 0
+
+    # The clear difference is settled after the first chunk
+    assert done[0] == 40000
+    assert done[1] == 5000
+
+    # The results do not depend on the number of processes
+    p_parallel, _, done_parallel = permutation_tests(
+        samples1, samples2, permutations=40000, chunk_size=5000, significance_level=exact_p, rng=1, workers=2)
+    assert np.array_equal(p, p_parallel, equal_nan=True) and np.array_equal(done, done_parallel)
+
+
+def test_permutation_mode():
+    analyses = get_analyses(np.random.default_rng(0))
+    for col in ['alpha_over_k_rho', 'alpha_over_k_J']:
+        analyses[col] = np.random.default_rng(1).uniform(0.5, 1, len(analyses))
+    analyses['kappa'] = analyses['kappa_tau'] = 0.5
+
+    results = perform_welchs_test(analyses, test='permutation', permutations=2000, rng=0)
+    p_values = results.filter(like='_p_value')
+    assert list(p_values.columns) == [quantity + '_p_value' for quantity in
+                                      get_contrasts(analyses).query('comparison == "construct"').quantity.unique()]
+    assert p_values.min().min() > 0 and p_values.max().max() <= 1
@@ -0,0 +1,108 @@
+"""
+Compare the complex-step propagation of uncertainties with the hand-written partial derivatives it replaces
+"""
+
+import os
+import sys
+
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import (alpha_over_k_from_measurements,  # noqa: E402
+                       alpha_over_k_J, alpha_over_k_rho, calculate_alpha,
+                       calculate_rho_and_J)
+from constants import k, kV, l, lV  # noqa: E402
+from propagation import propagate, propagate_mc, sample_quantiles  # noqa: E402
+from support import J_over_k_MC, rho_MC  # noqa: E402
+
+
+def test_propagate():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(1, 2, 10)
+    xV = rng.uniform(0, 0.1, 10)
+    y, yV = 3.0, 0.2
+
+    values, variances = propagate(lambda x, y: (x * y, np.sqrt(x) / y), [x, y], [xV, yV])
+    assert np.allclose(values[0], x * y)
+    assert np.allclose(variances[0], y**2 * xV + x**2 * yV)
+    assert np.allclose(variances[1], xV / 4 / x / y**2 + x / y**4 * yV)
+
+    # Invalid values give nan like in real arithmetics
+    value, variance = propagate(np.sqrt, [-1.0], [0.1])
+    assert np.isnan(value) and np.isnan(variance)
+
+
+def test_alpha_over_k():
+    JoK = np.array([0.005, 0.01, 0.015])
+    JoKV = np.array([1e-6, 2e-6, 0])
+    partial_JoK = (1 / 2) * (1 - l - (2 * JoK * (-1 + l)**2 - 2 * (1 + l)) /
+                             (2 * np.sqrt(1 + JoK ** 2 * (-1 + l)**2 - 2 * JoK * (1 + l))))
+    partial_l = (1 / 2) * (-JoK - (-2 * JoK + 2 * JoK**2 * (-1 + l)) /
+                           (2 * np.sqrt(1 + JoK**2 * (-1 + l)**2 - 2 * JoK * (1 + l))))
+    _, aoKV = alpha_over_k_J(JoK, JoKV)
+    assert np.allclose(aoKV, partial_l**2 * lV + partial_JoK**2 * JoKV, rtol=1e-10)
+
+    rho = np.array([0.1, 0.3])
+    rhoV = np.array([1e-3, 2e-3])
+    partial_l = -(((1 - rho) * rho) / (l - (-1 + l) * rho)**2)
+    partial_rho = l / (l + rho - l * rho)**2
+    _, aoKV = alpha_over_k_rho(rho, rhoV)
+    assert np.allclose(aoKV, partial_l**2 * lV + partial_rho**2 * rhoV, rtol=1e-10)
+
+    sq = np.sqrt(l)
+    assert np.isclose(rho_MC()[1], (1 / 2 / sq / (1 + sq)**2)**2 * lV, rtol=1e-10)
+    assert np.isclose(J_over_k_MC()[1], ((1 + sq)**(-3) / sq)**2 * lV, rtol=1e-10)
+
+
+def test_propagate_mc():
+    x = np.array([1.0, 2.0, np.nan, 4.0])
+    xV = np.array([0.01, 0.04, 0.01, 0.0])
+    y, yV = 3.0, 0.01
+
+    values, variances, quantiles = propagate_mc(
+        lambda x, y: (x + y, np.sqrt(x - 1.5)), [x, y], [xV, yV],
+        samples=200000, quantiles=[0.5, 0.975], rng=0, chunk_size=300000)
+    assert np.allclose(values[0][[0, 1, 3]], (x + y)[[0, 1, 3]], rtol=1e-3)
+    assert np.allclose(variances[0][[0, 1, 3]], (xV + yV)[[0, 1, 3]], rtol=0.02)
+    assert np.allclose(quantiles[0][1, [0, 1]], (x + y + 1.96 * np.sqrt(xV + yV))[[0, 1]], rtol=1e-3)
+    assert np.isnan(values[0][2]) and np.isnan(quantiles[0][:, 2]).all()
+
+    # Non-finite samples are ignored
+    assert np.isnan(values[1][0])
+    assert np.isfinite(values[1][1]) and np.isclose(values[1][3], np.sqrt(2.5))
+
+
+def test_sample_quantiles():
+    values = np.random.default_rng(0).normal(size=(3, 1001))
+    quantiles = [0.5, 0.025, 0.975, 0, 1]
+    assert np.allclose(sample_quantiles(values, quantiles), np.quantile(values, quantiles, axis=1))
+
+
+def test_calculate_alpha_mc():
+    rng = np.random.default_rng(0)
+    rows_len = 8
+    index = pd.MultiIndex.from_product([range(4), [13, 14]], names=['dataset_id', 'nc'])
+    analyses = pd.DataFrame({'gene': 'hb', 'construct': 'bac', 'max': rng.uniform(200, 400, rows_len),
+                             'slope': rng.uniform(100, 200, rows_len), 'T': 3.0, 'TV': 0.01}, index=index)
+    analyses['maxV'] = (0.02 * analyses['max'])**2
+    analyses['slopeV'] = (0.02 * analyses['slope'])**2
+    I_est, IV_est = 25.0, 0.5
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        analyses = calculate_rho_and_J(analyses, I_est, IV_est, propagation='mc', rng=1)
+        alphas = calculate_alpha(analyses, rng=1, propagation='mc', I_est=I_est, IV_est=IV_est)
+        with pytest.raises(ValueError):
+            calculate_alpha(analyses, propagation='mc')
+
+    # The Monte Carlo variances follow the delta method applied to the whole chain of the measured inputs,
+    # up to the nonlinearity of the chain in k and I
+    _, (aoK_JV, aoK_rhoV) = propagate(
+        alpha_over_k_from_measurements, [analyses['max'], analyses['slope'], analyses['T'], l, k, I_est],
+        [analyses['maxV'], analyses['slopeV'], analyses['TV'], lV, kV, IV_est])
+    assert np.allclose(alphas.alpha_over_k_JV, aoK_JV, rtol=0.2)
+    assert np.allclose(alphas.alpha_over_k_rhoV, aoK_rhoV, rtol=0.2)
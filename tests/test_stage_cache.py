@@ -0,0 +1,67 @@
+"""
+Check that the stage cache reuses the outputs of the stages and invalidates them when their inputs, code or constants change
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import filter_by_AP  # noqa: E402
+from cache import convert_types  # noqa: E402
+from stage_cache import get_stage_key, run_stage  # noqa: E402
+from synthetic import generate_traces  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+scale = 2
+plot_color = 'red'
+
+
+def get_scaled(analyses, offset=0):
+    return analyses * scale + offset
+
+
+def test_run_stage(tmp_path, capsys):
+    folder = str(tmp_path)
+    analyses = pd.DataFrame({'slope': [1.0, np.nan]},
+                            index=pd.MultiIndex.from_tuples([(0, 13), (0, 14)], names=['dataset_id', 'nc']))
+
+    def run(*args, **kwargs):
+        result = run_stage(get_scaled, args, kwargs, folder=folder)
+        return result, 'Loaded' in capsys.readouterr().out
+
+    result, is_loaded = run(analyses)
+    assert not is_loaded and np.allclose(result.slope, [2, np.nan], equal_nan=True)
+    result, is_loaded = run(analyses)
+    assert is_loaded and np.allclose(result.slope, [2, np.nan], equal_nan=True)
+
+    # A changed input or parameter invalidates the entry
+    assert not run(analyses + 1)[1]
+    assert not run(analyses + 1, offset=1)[1]
+    assert len(os.listdir(folder)) == 2
+
+    # Only the constants used by the stage are part of the key
+    key = get_stage_key(get_scaled, [analyses], {})[0]
+    globals()['plot_color'] = 'blue'
+    assert get_stage_key(get_scaled, [analyses], {})[0] == key
+    globals()['scale'] = 3
+    try:
+        assert get_stage_key(get_scaled, [analyses], {})[0] != key
+    finally:
+        globals()['scale'] = 2
+
+
+def test_pipeline_stage(tmp_path):
+    data, _ = generate_traces(datasets=3, traces=10, rng=0)
+    data['ap_mean'] = data.ap.groupby(data['trace_id']).transform('mean')
+    table = TraceTable(convert_types(data))
+
+    functions = get_stage_key(filter_by_AP, [table], {})[1]
+    assert 'trace_table.TraceTable' in functions
+
+    computed = run_stage(filter_by_AP, [table], folder=str(tmp_path))
+    loaded = run_stage(filter_by_AP, [table], folder=str(tmp_path))
+    pd.testing.assert_frame_equal(computed.data, loaded.data)
+    assert np.array_equal(computed.dataset_offsets, loaded.dataset_offsets)
@@ -0,0 +1,38 @@
+"""
+Check that the data sets processed from the partitions of the input file give the same results as the whole table
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from cache import load_data  # noqa: E402
+from dataset_store import process_datasets  # noqa: E402
+from streaming import partition_csv, process_partitions  # noqa: E402
+from synthetic import write_synthetic_data  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def test_partitions(tmp_path):
+    filepath = str(tmp_path / 'input.csv')
+    write_synthetic_data(filepath, datasets=4, traces=10, rng=0)
+    source = pd.read_csv(filepath)
+
+    # Small chunks split the data sets between several chunks
+    partitions = partition_csv(filepath, chunksize=1000)
+    assert list(partitions) == [0, 1, 2, 3]
+    for dataset_id, partition_path in partitions.items():
+        partition = pd.read_csv(partition_path)
+        pd.testing.assert_frame_equal(partition, source[source.dataset_id == dataset_id].reset_index(drop=True))
+
+    # The partitions are reused until the input file changes
+    mtime = os.path.getmtime(partitions[0])
+    assert partition_csv(filepath, chunksize=1000) == partitions
+    assert os.path.getmtime(partitions[0]) == mtime
+
+    analyses = process_partitions(partitions, save_figures=False, folder=str(tmp_path / 'store'))
+    expected, _ = process_datasets(TraceTable(load_data(filepath, use_cache=False)), save_figures=False,
+                                   folder=str(tmp_path / 'store_all'))
+    pd.testing.assert_frame_equal(analyses, expected)
@@ -0,0 +1,43 @@
+"""
+Check that the synthetic traces follow the input data format and that the pipeline recovers their parameters
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmark import get_scaling_exponents  # noqa: E402
+from cache import load_data  # noqa: E402
+from calculate import calculate_slopes, filter_by_AP, identify_ncs, init_analyses  # noqa: E402
+from synthetic import columns, default_nc_times, write_synthetic_data  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def test_synthetic_traces(tmp_path):
+    filepath = str(tmp_path / 'synthetic.csv')
+    truth = write_synthetic_data(filepath, datasets=6, traces=40, rng=0)
+    assert list(pd.read_csv(filepath, nrows=1).columns) == columns
+
+    data = load_data(filepath, use_cache=False)
+    assert data.groupby('dataset_id').trace_id.nunique().tolist() == [40] * 6
+    assert set(data.construct[data.dataset.str.contains('prim')]) == {'no_pr'}
+
+    table = TraceTable(data)
+    table_with_ncs, nc_limits = identify_ncs(filter_by_AP(table))
+    # Data set 1 has a manually adjusted last nc in `identify_ncs`
+    nc_limits = nc_limits.drop(index=1, level='dataset_id')
+    expected_starts = [default_nc_times[nc][0] for nc in nc_limits.index.get_level_values('nc')]
+    assert np.allclose(nc_limits.Tstart, expected_starts, atol=1.5)
+
+    analyses = calculate_slopes(table_with_ncs, init_analyses(table, nc_limits), save_figures=False)
+    slopes = analyses.slope.drop(index=1, level='dataset_id').groupby('dataset_id').median()
+    assert np.allclose(slopes, truth.slope.drop(index=1), rtol=0.2)
+
+
+def test_scaling_exponents():
+    sizes = np.array([10, 20, 40])
+    timings = pd.DataFrame({'linear': 0.1 * sizes, 'quadratic': 1e-3 * sizes**2}, index=sizes)
+    assert np.allclose(get_scaling_exponents(timings), [1, 2])
@@ -0,0 +1,60 @@
+"""
+Compare the vectorized averaging on a regular time mesh with a direct bin-by-bin calculation
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import (get_avg_on_regular_time_mesh,  # noqa: E402
+                       get_dataset_avg_trace, get_max_intensity,
+                       get_regular_time_mesh)
+from constants import dt_new  # noqa: E402
+from trace_table import TraceTable  # noqa: E402
+
+
+def test_avg_on_regular_time_mesh():
+    dt = 0.7
+    rng = np.random.default_rng(0)
+    time = np.sort(rng.uniform(-20, 30, size=500))
+    # Leave a gap that must be interpolated
+    time = time[(time < 2) | (time > 4)]
+    data = pd.DataFrame({'time': time, 'intensity': rng.normal(100, 10, size=len(time))})
+
+    avg_data, std_data, count_data = get_avg_on_regular_time_mesh(data, dt, return_count=True)
+
+    time_mesh = get_regular_time_mesh(data, dt)
+    for i in range(len(time_mesh) - 1):
+        int = data[(data.time >= time_mesh[i]) & (data.time < time_mesh[i + 1])].intensity
+        assert count_data.intensity.iloc[i] == len(int)
+        if len(int) > 1:
+            assert np.isclose(avg_data.intensity.iloc[i], int.mean())
+            assert np.isclose(std_data.intensity.iloc[i], np.std(int, ddof=1))
+        elif not len(int):
+            assert np.isnan(std_data.intensity.iloc[i])
+
+    # The gap is interpolated
+    assert not avg_data.intensity.isna().any()
+
+
+def test_max_intensity_on_dataset_avg_trace():
+    rng = np.random.default_rng(1)
+    time = rng.uniform(-20, 30, size=2000)
+    data = pd.DataFrame({'dataset_id': 0, 'trace_id': 0, 'time': time,
+                         'intensity': 1000 - (time - 7)**2 + rng.normal(0, 10, size=len(time))})
+    table = TraceTable(data)
+
+    avg_traces = get_dataset_avg_trace(table, 0, dt_new)
+    assert get_dataset_avg_trace(table, 0, dt_new) is avg_traces
+
+    # For a nc spanning t = 0, the bins of the data set and of the nc coincide
+    nc_data = table.data[(table.data.time > -10) & (table.data.time < 20)]
+    assert np.allclose(get_max_intensity(nc_data, avg_traces[0]), get_max_intensity(nc_data))
+
+    # The maximum is searched within the nc only
+    nc_data = table.data[table.data.time < 0]
+    max_intensity, _ = get_max_intensity(nc_data, avg_traces[0])
+    assert max_intensity < 1000 - 49 + 30
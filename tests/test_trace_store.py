@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cache import load_data  # noqa: E402
+from synthetic import write_synthetic_data  # noqa: E402
+import trace_store  # noqa: E402
+from trace_store import TraceStore, open_trace_store  # noqa: E402
+
+
+def test_trace_store(tmp_path, monkeypatch):
+    filepath = os.path.join(tmp_path, 'data.csv')
+    write_synthetic_data(filepath, datasets=4, traces=10, rng=0)
+    store = open_trace_store(filepath)
+    data = load_data(filepath)
+
+    # The assembled table has the rows and the types of the loaded table
+    frame = store.to_frame()
+    expected = data.sort_values(['dataset_id', 'trace_id', 'time'], kind='stable').reset_index(drop=True)
+    assert list(frame.dtypes.astype(str)) == list(expected[frame.columns].dtypes.astype(str))
+    assert frame.astype(str).equals(expected[frame.columns].astype(str))
+
+    # Traces and data sets are views of the memory-mapped columns
+    i = store.find_trace(2, data[data.dataset_id == 2].trace_id.iloc[0])
+    trace = store.trace(i)
+    assert np.shares_memory(trace['intensity'], store.columns['intensity'])
+    trace_data = data[(data.dataset_id == 2) & (data.trace_id == store.traces.trace_id[i])].sort_values('time')
+    assert np.array_equal(trace['time'], trace_data.time.values)
+    assert np.isclose(store.traces.ap_mean[i], trace_data.ap_mean.iloc[0])
+
+    dataset = store.dataset(3)
+    assert np.shares_memory(dataset['time'], store.columns['time'])
+    assert len(dataset['time']) == (data.dataset_id == 3).sum()
+    assert len(store.dataset(10)['time']) == 0
+    assert store.find_trace(2, -1) is None
+    assert len(store) == data.groupby(['dataset_id', 'trace_id']).ngroups
+
+    # The store is reused until the input file changes
+    manifest_path = os.path.join(filepath + '.traces', 'manifest.json')
+    mtime = os.path.getmtime(manifest_path)
+    assert len(TraceStore(filepath + '.traces')) == len(store)
+    open_trace_store(filepath)
+    assert os.path.getmtime(manifest_path) == mtime
+
+    # An unchanged input file is not read again
+    def read_file(*args, **kwargs):
+        raise AssertionError('The input file was read')
+    with monkeypatch.context() as patch:
+        patch.setattr(trace_store, 'hash_file', read_file)
+        patch.setattr(trace_store, 'load_data', read_file)
+        assert len(open_trace_store(filepath)) == len(store)
+
+    # A touched file is hashed but the store is not rebuilt
+    os.utime(filepath, (mtime + 10, mtime + 10))
+    with monkeypatch.context() as patch:
+        patch.setattr(trace_store, 'load_data', read_file)
+        assert len(open_trace_store(filepath)) == len(store)
+    with monkeypatch.context() as patch:
+        patch.setattr(trace_store, 'hash_file', read_file)
+        open_trace_store(filepath)
+
+    write_synthetic_data(filepath, datasets=2, traces=10, rng=0)
+    assert len(open_trace_store(filepath).datasets) == 2
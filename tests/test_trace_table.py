@@ -0,0 +1,40 @@
+"""
+Check that the data set and nc blocks of the trace table correspond to the rows selected by a full-table scan
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from trace_table import TraceTable  # noqa: E402
+
+
+def test_trace_table():
+    rng = np.random.default_rng(0)
+    n = 500
+    data = pd.DataFrame({'dataset_id': rng.choice([0, 2, 5], n),
+                         'trace_id': rng.integers(0, 20, n),
+                         'time': rng.uniform(0, 10, n),
+                         'nc': rng.choice([11, 12, 13, np.nan], n),
+                         'gene': 'hb'})
+    table = TraceTable(data)
+
+    assert list(table.dataset_ids) == [0, 2, 5]
+    assert table.dataset(3).empty
+    assert table.nc(0, 14).empty
+
+    for dataset_id, dataset_data in table.datasets():
+        pd.testing.assert_frame_equal(
+            dataset_data.sort_index(), data[data.dataset_id == dataset_id].sort_index())
+        for nc in [11, 12, 13]:
+            pd.testing.assert_frame_equal(
+                table.nc(dataset_id, nc).sort_index(),
+                data[(data.dataset_id == dataset_id) & (data.nc == nc)].sort_index())
+
+    # Filtering keeps the blocks
+    filtered = table.filter(table.data.time.values < 5)
+    assert np.all(filtered.nc(2, 12).time < 5)
+    assert len(filtered.nc(2, 12)) == np.sum((data.dataset_id == 2) & (data.nc == 12) & (data.time < 5))
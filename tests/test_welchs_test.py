@@ -0,0 +1,103 @@
+"""
+Compare the vectorized Welch's tests and Bayes factors on the precomputed comparison table with test-by-test calculations
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from calculate import (get_bayes_factors, get_welch_tests,  # noqa: E402
+                       perform_welchs_test)
+from constants import gene_labels, n_pi  # noqa: E402
+from support import welchs_test  # noqa: E402
+
+
+def get_analyses(rng):
+    rows = []
+    for gene_id, gene in enumerate(gene_labels[:2]):
+        for construct in ['bac', 'no_pr', 'no_sh']:
+            for nc in [13, 14]:
+                # Mixed estimators are shared by all data sets of a group
+                shared = {quantity: rng.uniform(1, 2) for quantity in ['alpha_over_k_comb', 'tau', 'alpha_comb']}
+                for _ in range(rng.integers(2, 5)):
+                    row = {'gene': gene, 'gene_id': gene_id, 'construct': construct, 'nc': nc,
+                           'r': rng.normal(1, 0.2), 'j': rng.normal(2, 0.3)}
+                    for quantity, value in shared.items():
+                        row[quantity] = value
+                        row[quantity + 'V'] = value / 100
+                    rows.append(row)
+    analyses = pd.DataFrame(rows)
+    analyses.loc[0, 'r'] = np.nan
+    return analyses.set_index([np.arange(len(analyses)), 'nc'])
+
+
+def test_welch_tests():
+    analyses = get_analyses(np.random.default_rng(0))
+    tests = get_welch_tests(analyses)
+    # 2 genes x 2 ncs x 5 quantities + 2 genes x 3 constructs + 3 constructs x 2 ncs x 2 quantities
+    assert len(tests) == 20 + 6 + 12
+    assert tests.p.notna().sum() >= len(tests) - 1
+
+    nc = analyses.index.get_level_values(1)
+    for test in tests.itertuples():
+        summaries = []
+        for gene, construct, nc_test in [(test.gene1, test.construct1, test.nc1),
+                                         (test.gene2, test.construct2, test.nc2)]:
+            group = analyses[(analyses.gene == gene) & (analyses.construct == construct) & (nc == nc_test)]
+            values = group[test.quantity].dropna()
+            if test.quantity in ['r', 'j']:
+                summaries += [values.mean(), np.var(values, ddof=1), len(values)]
+            else:
+                summaries += [values.iloc[0], group[test.quantity + 'V'].iloc[0], len(values)]
+        p, t, nu = welchs_test(*summaries)
+        assert np.allclose([test.p, test.t, test.nu], [p, t, nu], equal_nan=True)
+
+    results = perform_welchs_test(analyses)
+    construct_tests = tests[(tests.comparison == 'construct') & (tests.quantity == 'tau')]
+    for test in construct_tests.itertuples():
+        rows = (results.gene == test.gene1) & (nc == test.nc1)
+        assert np.allclose(results.loc[rows, 'tau_p_value'], test.p)
+
+
+def test_welch_tests_missing_constructs():
+    analyses = get_analyses(np.random.default_rng(1))
+    analyses = analyses[analyses.construct != 'no_pr']
+    tests = get_welch_tests(analyses)
+    assert set(tests.comparison) == {'nc', 'gene'}
+    assert 'r_p_value' not in perform_welchs_test(analyses).columns
+
+
+def test_bayes_factors():
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'archive')))
+    from calculate_bayes_factor import calculate_bayes_factor
+
+    analyses = get_analyses(np.random.default_rng(2))
+    nc = analyses.index.get_level_values(1)
+    bayes_factors = get_bayes_factors(analyses, quantities=['r', 'j'])
+    # All pairs of the 2 x 3 x 2 groups for each quantity
+    assert len(bayes_factors) == 2 * 12 * 11 // 2
+
+    for quantity in ['r', 'j']:
+        values = analyses[quantity].dropna()
+        for row in bayes_factors[bayes_factors.quantity == quantity].itertuples():
+            samples = [analyses.loc[(analyses.gene == gene) & (analyses.construct == construct) & (nc == nc_row),
+                                    quantity].values
+                       for gene, construct, nc_row in [(row.gene1, row.construct1, row.nc1),
+                                                       (row.gene2, row.construct2, row.nc2)]]
+            log10_B = calculate_bayes_factor(*samples, n_pi=n_pi, mu_pi=values.mean(), V_pi=values.var(ddof=0))[0]
+            assert np.isclose(row.log10_B, log10_B)
+
+    # The Bayes factors are reported alongside the Welch's tests
+    tests = get_welch_tests(analyses)
+    assert tests.loc[tests.quantity.isin(['r', 'j']), 'log10_B'].notna().all()
+    assert tests.loc[~tests.quantity.isin(['r', 'j']), 'log10_B'].isna().all()
+
+    # The Bayes factors are returned next to the p-values by `perform_welchs_test`
+    results = perform_welchs_test(analyses)
+    for test in tests[(tests.comparison == 'construct') & tests.quantity.isin(['r', 'j'])].itertuples():
+        rows = (results.gene == test.gene1) & (nc == test.nc1)
+        assert np.allclose(results.loc[rows, test.quantity + '_log10_B'], test.log10_B)
+    assert 'tau_log10_B' not in results.columns
@@ -0,0 +1,219 @@
+"""
+This file contains an on-disk store of the fluorescence traces, opened as memory-mapped arrays.
+
+The rows are sorted by data set, trace and time, and each of the `row_columns` is saved as a separate `.npy` file.
+The traces are stored in the compressed sparse row (CSR) layout:
+- `trace_offsets`: trace i occupies rows trace_offsets[i]:trace_offsets[i+1],
+- `dataset_offsets`: data set j contains traces dataset_offsets[j]:dataset_offsets[j+1].
+The id, the data set id and the mean AP position of each trace are kept in a table with one row per trace, and the names, genes and constructs of the data sets in a table with one row per data set.
+
+Opening the store only reads the small tables. The rows of a trace or a data set are slices of the memory-mapped columns and are not copied.
+The store is rebuilt when the contents hash of the input file changes. The hash is only calculated if the modification time or the size of the file changed.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from cache import hash_file, load_data
+from trace_table import get_block_offsets
+
+trace_store_version = 1
+row_columns = {'time': np.float64, 'intensity': np.float32, 'ap': np.float32, 'frame': np.int32}
+dataset_columns = ['dataset', 'gene', 'gene_id', 'construct', 'construct_id']
+
+
+def get_trace_store_folder(filepath):
+    return filepath + '.traces'
+
+
+def write_trace_store(data, folder, source_hash=None, source_mtime=None, source_size=None):
+    """
+    Save an input data table into a trace store.
+
+    The trace ids must be unique within each data set.
+    The mean AP position of each trace is taken from the `ap_mean` column if present, and calculated otherwise.
+    """
+    data = data.sort_values(['dataset_id', 'trace_id', 'time'], kind='stable')
+    dataset_ids = data.dataset_id.values
+    trace_ids = data.trace_id.values
+    trace_offsets = get_block_offsets([dataset_ids, trace_ids])
+    trace_starts = trace_offsets[:-1]
+
+    if 'ap_mean' in data:
+        ap_means = data.ap_mean.values[trace_starts]
+    else:
+        ap = data.ap.values.astype(np.float64)
+        is_valid = ~np.isnan(ap)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ap_means = (np.add.reduceat(np.where(is_valid, ap, 0), trace_starts)
+                        / np.add.reduceat(is_valid.astype(int), trace_starts)) if len(data) else np.array([])
+    traces = pd.DataFrame({'trace_id': trace_ids[trace_starts].astype(np.int32),
+                           'dataset_id': dataset_ids[trace_starts].astype(np.int32),
+                           'ap_mean': np.asarray(ap_means, dtype=np.float32)})
+    dataset_offsets = get_block_offsets([traces.dataset_id.values])
+    datasets = data[['dataset_id'] + dataset_columns].iloc[trace_starts[dataset_offsets[:-1]]]
+
+    # Write into a temporary folder first so that an interrupted write does not leave a broken store
+    tmp_folder = folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for column, dtype in row_columns.items():
+        np.save(os.path.join(tmp_folder, column + '.npy'), data[column].values.astype(dtype))
+    np.save(os.path.join(tmp_folder, 'trace_offsets.npy'), trace_offsets.astype(np.int64))
+    np.save(os.path.join(tmp_folder, 'dataset_offsets.npy'), dataset_offsets.astype(np.int64))
+    for column in traces:
+        np.save(os.path.join(tmp_folder, f'trace_{column}.npy'), traces[column].values)
+    datasets.astype({column: str for column in ['dataset', 'gene', 'construct']}).to_csv(
+        os.path.join(tmp_folder, 'datasets.csv'), index=False, encoding='utf-8')
+
+    manifest = {'version': trace_store_version, 'source_hash': source_hash, 'source_mtime': source_mtime,
+                'source_size': source_size, 'rows': len(data), 'traces': len(traces), 'datasets': len(datasets)}
+    write_trace_store_manifest(tmp_folder, manifest)
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+
+def read_trace_store_manifest(folder):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_trace_store_manifest(folder, manifest):
+    manifest_path = os.path.join(folder, 'manifest.json')
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def open_trace_store(filepath, folder=None, use_cache=True):
+    """
+    Open the trace store of an input file, `.csv` or `.npz` (see `load_data`).
+    The store is (re)built from the input file if it does not exist or was built from another version of the file.
+
+    The input file is not read if its modification time and size are those saved in the store.
+    Otherwise, its contents hash is compared, so that a file touched without changes does not rebuild the store.
+
+    Return:
+    `TraceStore`
+    """
+    folder = get_trace_store_folder(filepath) if folder is None else folder
+    stat = os.stat(filepath)
+
+    manifest = read_trace_store_manifest(folder)
+    is_current = (use_cache and manifest is not None and manifest['version'] == trace_store_version
+                  and manifest['source_mtime'] == stat.st_mtime and manifest.get('source_size') == stat.st_size)
+    if not is_current:
+        source_hash = hash_file(filepath)
+        if use_cache and manifest is not None and manifest['version'] == trace_store_version \
+                and manifest['source_hash'] == source_hash:
+            # Same contents: save the new modification time and size
+            manifest.update(source_mtime=stat.st_mtime, source_size=stat.st_size)
+            write_trace_store_manifest(folder, manifest)
+        else:
+            write_trace_store(load_data(filepath, use_cache=use_cache), folder, source_hash=source_hash,
+                              source_mtime=stat.st_mtime, source_size=stat.st_size)
+    return TraceStore(folder)
+
+
+class TraceStore:
+    """
+    Memory-mapped traces sorted by (dataset_id, trace_id, time), with the CSR offsets of the traces and of the data sets.
+
+    The traces are numbered by their position i in the store, see `find_trace` for the conversion from (dataset_id, trace_id).
+    `trace(i)` and `dataset(dataset_id)` return dictionaries {column: array} of views of the memory-mapped columns.
+    The views are read-only.
+    """
+
+    def __init__(self, folder):
+        manifest = read_trace_store_manifest(folder)
+        if manifest is None or manifest['version'] != trace_store_version:
+            raise ValueError(f'No trace store of the current version in `{folder}`')
+        self.folder = folder
+        # Empty files cannot be memory-mapped
+        mmap_mode = 'r' if manifest['rows'] > 0 else None
+        self.columns = {column: np.load(os.path.join(folder, column + '.npy'), mmap_mode=mmap_mode)
+                        for column in row_columns}
+        self.trace_offsets = np.load(os.path.join(folder, 'trace_offsets.npy'))
+        self.dataset_offsets = np.load(os.path.join(folder, 'dataset_offsets.npy'))
+        self.traces = pd.DataFrame({column: np.load(os.path.join(folder, f'trace_{column}.npy'))
+                                    for column in ['trace_id', 'dataset_id', 'ap_mean']})
+        self.datasets = pd.read_csv(os.path.join(folder, 'datasets.csv'), encoding='utf-8',
+                                    dtype={'dataset': str, 'gene': str, 'construct': str}).set_index('dataset_id')
+
+    def __len__(self):
+        return len(self.trace_offsets) - 1
+
+    def get_rows(self, start, end):
+        return {column: values[start:end] for column, values in self.columns.items()}
+
+    def trace(self, i):
+        """
+        Return the rows of the trace i
+        """
+        return self.get_rows(self.trace_offsets[i], self.trace_offsets[i + 1])
+
+    def dataset_traces(self, dataset_id):
+        """
+        Return the range of the positions of the traces of a data set. The range is empty if the data set is absent
+        """
+        j = self.datasets.index.get_indexer([dataset_id])[0]
+        if j < 0:
+            return range(0)
+        return range(self.dataset_offsets[j], self.dataset_offsets[j + 1])
+
+    def dataset(self, dataset_id):
+        """
+        Return the rows of a data set. Empty arrays are returned if the data set is absent
+        """
+        traces = self.dataset_traces(dataset_id)
+        return self.get_rows(self.trace_offsets[traces.start], self.trace_offsets[traces.stop])
+
+    def find_trace(self, dataset_id, trace_id):
+        """
+        Return the position of a trace in the store, or None if it is absent
+        """
+        traces = self.dataset_traces(dataset_id)
+        trace_ids = self.traces.trace_id.values[traces.start:traces.stop]
+        i = np.searchsorted(trace_ids, trace_id)
+        if i < len(trace_ids) and trace_ids[i] == trace_id:
+            return traces.start + i
+        return None
+
+    def to_frame(self, dataset_ids=None):
+        """
+        Assemble the input data table of the selected data sets (all by default) in the format returned by `load_data`.
+        The table is a copy of the stored rows.
+        """
+        dataset_ids = self.datasets.index.values if dataset_ids is None else np.asarray(dataset_ids)
+        traces = np.concatenate([np.arange(self.dataset_traces(dataset_id).start,
+                                           self.dataset_traces(dataset_id).stop, dtype=np.int64)
+                                 for dataset_id in dataset_ids]) if len(dataset_ids) else np.array([], dtype=np.int64)
+        lengths = np.diff(self.trace_offsets)[traces]
+        # Row indices of the selected traces
+        starts = np.repeat(self.trace_offsets[traces] - np.cumsum(lengths) + lengths, lengths)
+        rows = starts + np.arange(lengths.sum())
+
+        trace_rows = np.repeat(traces, lengths)
+        data = {'trace_id': self.traces.trace_id.values[trace_rows],
+                'dataset_id': self.traces.dataset_id.values[trace_rows]}
+        datasets = self.datasets.loc[data['dataset_id']]
+        for column in dataset_columns:
+            if column.endswith('_id'):
+                data[column] = datasets[column].values.astype(np.int32)
+            else:
+                data[column] = pd.Categorical(datasets[column].values)
+        for column in row_columns:
+            data[column] = self.columns[column][rows]
+        data['ap_mean'] = self.traces.ap_mean.values[trace_rows]
+        return pd.DataFrame(data)
@@ -0,0 +1,114 @@
+"""
+This file contains the table of fluorescence traces used by all analysis stages.
+
+The rows are sorted once by data set, nc, trace and time.
+The offsets of the blocks of each data set and of each (data set, nc) pair are stored, so that these blocks are obtained as slices of the table without scanning the whole table.
+"""
+
+import numpy as np
+import pandas as pd
+
+sort_columns = ['dataset_id', 'nc', 'trace_id', 'time']
+
+
+def get_block_offsets(keys):
+    """
+    Find the blocks of equal consecutive rows in sorted key arrays.
+
+    Return the row offsets of the blocks, such that block i occupies rows offsets[i]:offsets[i+1].
+    """
+    rows_len = len(keys[0])
+    changes = np.zeros(max(rows_len - 1, 0), dtype=bool)
+    for key in keys:
+        changes |= key[1:] != key[:-1]
+    starts = np.flatnonzero(changes) + 1
+    return np.concatenate([[0], starts, [rows_len]]) if rows_len else np.array([0])
+
+
+class TraceTable:
+    """
+    A data table sorted by (dataset_id, nc, trace_id, time) with the offsets of the data set and nc blocks.
+
+    The original index of the rows is kept.
+    `dataset(dataset_id)` and `nc(dataset_id, nc)` return slices of the table.
+    Rows with no nc (nan) are placed at the end of each data set and do not belong to any nc block.
+
+    `avg_traces` stores the arrays derived from the rows of each data set, such as the average trace on a regular time mesh, so that they are calculated only once.
+    They are keyed by (dataset_id, dt) and are kept by `assign`, which does not change the rows.
+    """
+
+    def __init__(self, data, is_sorted=False, avg_traces=None):
+        if not is_sorted:
+            data = data.sort_values([col for col in sort_columns if col in data],
+                                    kind='stable', na_position='last')
+        self.data = data
+        self.avg_traces = {} if avg_traces is None else avg_traces
+
+        dataset_ids = data.dataset_id.values
+        offsets = get_block_offsets([dataset_ids])
+        self.dataset_ids = dataset_ids[offsets[:-1]]
+        self.dataset_offsets = offsets
+
+        # Blocks of each (dataset_id, nc) pair
+        self.nc_offsets = {}
+        if 'nc' in data:
+            ncs = data.nc.values.astype(float)
+            ncs_filled = np.where(np.isnan(ncs), np.inf, ncs)
+            offsets = get_block_offsets([dataset_ids, ncs_filled])
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                if not np.isnan(ncs[start]):
+                    self.nc_offsets[(dataset_ids[start], int(ncs[start]))] = (start, end)
+
+    def __len__(self):
+        return len(self.data)
+
+    def dataset(self, dataset_id):
+        """
+        Return the rows of a data set. An empty table is returned if the data set is absent
+        """
+        i = np.searchsorted(self.dataset_ids, dataset_id)
+        if i < len(self.dataset_ids) and self.dataset_ids[i] == dataset_id:
+            return self.data.iloc[self.dataset_offsets[i]:self.dataset_offsets[i + 1]]
+        return self.data.iloc[:0]
+
+    def datasets(self):
+        """
+        Iterate over the (dataset_id, rows) pairs of all data sets present in the table
+        """
+        for i, dataset_id in enumerate(self.dataset_ids):
+            yield dataset_id, self.data.iloc[self.dataset_offsets[i]:self.dataset_offsets[i + 1]]
+
+    def nc(self, dataset_id, nc):
+        """
+        Return the rows of a nc of a data set. An empty table is returned if the nc is absent
+        """
+        start, end = self.nc_offsets.get((dataset_id, nc), (0, 0))
+        return self.data.iloc[start:end]
+
+    def first(self, columns):
+        """
+        Return the values of the `columns` in the first row of each data set, indexed by dataset_id
+        """
+        first_rows = self.data[columns].iloc[self.dataset_offsets[:-1]]
+        first_rows.index = pd.Index(self.dataset_ids, name='dataset_id')
+        return first_rows
+
+    def per_dataset(self, values):
+        """
+        Repeat one value per data set for each row of the data set
+        """
+        return np.repeat(values, np.diff(self.dataset_offsets))
+
+    def filter(self, mask):
+        """
+        Keep the rows where `mask` is True. The rows stay sorted
+        """
+        return TraceTable(self.data[np.asarray(mask)], is_sorted=True)
+
+    def assign(self, **columns):
+        """
+        Add columns and sort again the rows if necessary.
+        The rows are the same, so the derived arrays are kept
+        """
+        return TraceTable(self.data.assign(**columns), is_sorted='nc' not in columns,
+                          avg_traces=self.avg_traces)